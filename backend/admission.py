@@ -0,0 +1,145 @@
+# backend/admission.py
+"""Controllo di ammissione per classi di costo (keygen, sign, decrypt, read).
+
+Ogni classe ha un limite di concorrenza e una coda limitata ordinata per priorità
+(numero più basso = servito prima, a parità in ordine di arrivo). Una classe satura
+non blocca le altre: le letture economiche non aspettano dietro una generazione RSA.
+La classe "read" copre tutte le operazioni economiche (letture e scritture senza crittografia).
+"""
+import heapq, itertools, math, os, threading, time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+ENABLED = os.environ.get("APS_ADMISSION", "on").lower() not in ("0", "off", "false")
+_CPU = os.cpu_count() or 1
+
+class Rejected(Exception):
+    """Richiesta non ammessa: `status` 429 (coda piena) o 503 (attesa scaduta)."""
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+class _Class:
+    def __init__(self, name: str, limit: int, queue: int, max_wait_s: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue = max(0, queue)
+        self.max_wait_s = max_wait_s
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting: List[list] = []        # heap di [priorità, seq]
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_depth = 0
+        self.wait_ms = deque(maxlen=1000)   # ultime attese in coda
+        self.service_ms = deque(maxlen=200) # ultime durate di servizio (per Retry-After)
+
+    def retry_after(self) -> int:
+        avg_s = (sum(self.service_ms) / len(self.service_ms) / 1000.0) if self.service_ms else 1.0
+        return max(1, math.ceil(avg_s * (len(self.waiting) + 1) / self.limit))
+
+    def acquire(self, priority: int, seq: int) -> float:
+        """Attende uno slot; ritorna i ms di attesa o solleva Rejected."""
+        t0 = time.perf_counter()
+        with self.cond:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                self.wait_ms.append(0.0)
+                return 0.0
+            if len(self.waiting) >= self.queue:
+                self.rejected += 1
+                raise Rejected(429, f"{self.name} queue full", self.retry_after())
+            entry = [priority, seq]
+            heapq.heappush(self.waiting, entry)
+            self.max_depth = max(self.max_depth, len(self.waiting))
+            deadline = t0 + self.max_wait_s
+            while not (self.waiting[0] is entry and self.active < self.limit):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.timed_out += 1
+                    self.cond.notify_all()
+                    raise Rejected(503, f"{self.name} queue wait timeout", self.retry_after())
+                self.cond.wait(remaining)
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self.admitted += 1
+            waited = (time.perf_counter() - t0) * 1000.0
+            self.wait_ms.append(waited)
+            self.cond.notify_all()
+            return waited
+
+    def release(self, service_ms: float):
+        with self.cond:
+            self.active -= 1
+            self.service_ms.append(service_ms)
+            self.cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "queued": len(self.waiting),
+                "maxQueue": self.queue,
+                "maxDepthSeen": self.max_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timedOut": self.timed_out,
+                "wait_ms": list(self.wait_ms),
+            }
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, str(default)))
+
+# limite di concorrenza / lunghezza coda / attesa massima per classe (override via env APS_ADM_<CLASSE>_*)
+CLASSES: Dict[str, _Class] = {
+    name: _Class(name,
+                 _env_int(f"APS_ADM_{name.upper()}_LIMIT", limit),
+                 _env_int(f"APS_ADM_{name.upper()}_QUEUE", queue),
+                 float(os.environ.get(f"APS_ADM_{name.upper()}_WAIT_S", str(wait))))
+    for name, limit, queue, wait in (
+        ("keygen",  max(1, _CPU // 2), 8,   30.0),
+        ("sign",    _CPU,              32,  10.0),
+        ("decrypt", _CPU * 2,          64,  10.0),
+        ("read",    32,                256,  5.0),
+    )
+}
+
+_seq = itertools.count()
+
+class Slot:
+    """Context manager: slot ammesso nella classe, rilasciato a fine richiesta."""
+
+    def __init__(self, cls_name: str, priority: int = 0):
+        self.cls: Optional[_Class] = CLASSES[cls_name] if ENABLED else None
+        self.priority = priority
+        self.waited_ms = 0.0
+
+    def __enter__(self):
+        if self.cls is not None:
+            self.waited_ms = self.cls.acquire(self.priority, next(_seq))
+            self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cls is not None:
+            self.cls.release((time.perf_counter() - self._t0) * 1000.0)
+        return False
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    return {name: c.snapshot() for name, c in CLASSES.items()}
+
+def in_flight() -> int:
+    """Richieste ammesse o in coda in tutte le classi (0 se l'ammissione è disattivata)."""
+    total = 0
+    for c in CLASSES.values():
+        with c.cond:
+            total += c.active + len(c.waiting)
+    return total
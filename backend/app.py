@@ -1,9 +1,17 @@
+import base64
+import gzip
+import hashlib
+import hmac
 import json
+import os
 import pathlib
 import secrets
+import threading
 import time
+import zlib
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import Any, Dict, Tuple, List, Optional
+from typing import Any, Callable, Dict, Tuple, List, Optional
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
@@ -12,17 +20,26 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from apscrypto import (
     decrypt_envelope,
     encrypt_for_recipients,
-    gen_rsa_keypair,
-    load_private_pem,
-    load_public_pem,
-    save_private_pem,
-    save_public_pem,
     sha256_bytes,
     sign_bytes,
     verify_signature,
+    commit_fields,
+    verify_disclosure,
+    sd_message,
+    leaf_hash,
+    merkle_tree,
+    merkle_root,
+    merkle_path,
+    merkle_verify,
+    root_message,
+    gen_group_key,
+    group_wrap,
+    group_unwrap,
+    chain_wrap,
+    chain_unwrap,
 )
 from apscrypto.hybrid import _unwrap_key, _wrap_key
-from apscrypto.utils import dumps, b64d
+from apscrypto.utils import dumps, b64d, b64e
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from ledger import (
@@ -34,20 +51,83 @@ from ledger import (
     lookup_grants,
     lookup_grants_for_report,
     get_publish,
+    in_version_chain,
+    current_version,
+    report_history,
+    reports_for_patient,
+    reports_for_recipient,
+    publish_group_key,
+    group_epochs,
+    group_current,
+    groups_for_member,
+    read_raw,
+    get_by_txid,
+    rebuild_indexes,
+    seal_pending as seal_ledger_segments,
+    shard_stats,
+    stats as ledger_stats,
+    version as ledger_version,
+    bloom_stats as ledger_bloom_stats,
+    state_as_of,
+    grants_as_of,
+    checkpoint_stats as ledger_checkpoint_stats,
+    SHARDS as LEDGER_SHARDS,
 )
+import replica
 
 from ca import enroll as ca_enroll, revoke as ca_revoke, get_cert, in_crl
+from singleflight import SingleFlight
+import admission
+import sessions
+import keystore
+import profiler
+import retention
+import rotation
+import synth
+import workload
+from bloom import BloomFilter
+from filelock import FileLock
 
 APP_DIR = pathlib.Path(__file__).parent
 DATA = APP_DIR / "store.json"
-KEYS_DIR = APP_DIR / "keys"
-KEYS_DIR.mkdir(exist_ok=True)
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# POST che non scrivono né ledger né store.json: il follower li serve come le GET
+FOLLOWER_READ_POSTS = frozenset({
+    "/api/keys/pub",
+    "/api/hosp/open",
+    "/api/sd/verify",
+    "/api/sd/proof_demo",
+    "/api/sd/disclose",
+    "/api/sd/check",
+})
+
+@app.before_request
+def _follower_read_only():
+    # Il follower serve solo letture: le scritture vanno al primario
+    if not replica.ENABLED or request.method in ("GET", "HEAD", "OPTIONS"):
+        return None
+    if request.method == "POST" and request.path in FOLLOWER_READ_POSTS:
+        return None
+    return jsonify({"ok": False, "error": "read-only follower", "primary": replica.PRIMARY}), 503
+
 # -------------------- DB helpers --------------------
 
+# Un solo lock (anche tra processi) per ogni scrittura di store.json: le route che fanno solo load_db → modifica →
+# save_db lo tengono per tutta la richiesta (@store_write); quelle che firmano o scrivono sul ledger lo prendono
+# solo attorno a load → modifica → save (_store_envelopes, _unrevoke), come collector di retention, rotazione e
+# synth attorno al controllo di versione e al salvataggio. Il file è sostituito atomicamente (temp + os.replace).
+STORE_LOCK = FileLock(DATA.with_name("store.lock"))
+
+def store_write(fn):
+    def wrapper(*a, **kw):
+        with STORE_LOCK:
+            return fn(*a, **kw)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
 def load_db() -> Dict[str, Any]:
     if DATA.exists():
         try:
@@ -60,22 +140,116 @@ def load_db() -> Dict[str, Any]:
     return {"envelopes": {}, "actors": {}, "revoked": {}}
 
 def save_db(db: Dict[str, Any]):
-    DATA.write_text(json.dumps(db, ensure_ascii=False, indent=2), encoding="utf-8")
+    with STORE_LOCK:
+        _users_bloom_store(db)   # prima dello store: un crash in mezzo lascia al più un falso positivo
+        tmp = DATA.with_name(DATA.name + ".tmp")
+        tmp.write_text(json.dumps(db, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, DATA)   # i lettori vedono il file vecchio o quello nuovo, mai uno a metà
+
+def _store_envelopes(envs: Dict[str, Dict[str, Any]]):
+    """Aggiunge envelope a store.json: solo lettura e scrittura sotto STORE_LOCK, la crittografia resta fuori."""
+    with STORE_LOCK:
+        db = load_db()
+        db["envelopes"].update(envs)
+        save_db(db)
+
+def _unrevoke(rid: str, target: str):
+    """Toglie `target` dalle revoche applicative del paziente su rid (dopo un nuovo GRANT), sotto STORE_LOCK."""
+    with STORE_LOCK:
+        db = load_db()
+        revoked = db.get("revoked") or {}
+        lst = set(revoked.get(rid) or [])
+        if target not in lst:
+            return
+        lst.discard(target)
+        revoked[rid] = sorted(lst)
+        db["revoked"] = revoked
+        save_db(db)
 
-def _key_paths(actor_id: str) -> Tuple[pathlib.Path, pathlib.Path]:
-    return KEYS_DIR / f"{actor_id}_priv.pem", KEYS_DIR / f"{actor_id}_pub.pem"
+# Filtro di Bloom sugli username, salvato accanto a store.json con il numero di utenti che copre: un login con
+# utente inesistente risponde senza caricare store.json. Ogni save_db aggiorna il filtro in modo incrementale
+# (gli utenti creati entrano con _users_bloom_add, un numero di utenti diverso dal previsto riaggiunge le chiavi
+# dal db già in memoria) e lo riscrive solo se è cambiato; gli altri processi lo rileggono quando cambia l'mtime.
+# store.json si ricarica per intero solo se il file manca (primo avvio, o invalidato da `synth.py` da CLI).
+USERS_BLOOM_FILE = APP_DIR / "users.bloom.json"
+_USERS_BLOOM: Dict[str, Any] = {"filter": None, "users": 0, "mtime": None, "dirty": False}
+_USERS_BLOOM_LOCK = threading.Lock()
+
+def _users_bloom_persist():
+    tmp = USERS_BLOOM_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"users": _USERS_BLOOM["users"], "filter": _USERS_BLOOM["filter"].to_dict()}),
+                   encoding="utf-8")
+    os.replace(tmp, USERS_BLOOM_FILE)
+    _USERS_BLOOM.update(mtime=USERS_BLOOM_FILE.stat().st_mtime_ns, dirty=False)
+
+def _users_bloom_replace(bf: BloomFilter, users: int, mtime: Optional[int]):
+    old = _USERS_BLOOM["filter"]
+    if old is not None:
+        # conserva i contatori osservati attraverso ricariche e ricostruzioni
+        bf.queries, bf.negatives, bf.false_positives = old.queries, old.negatives, old.false_positives
+    _USERS_BLOOM.update(filter=bf, users=users, mtime=mtime)
+
+def _users_bloom_sync() -> bool:
+    """Con _USERS_BLOOM_LOCK: allinea il filtro al file (riletto se cambiato). False se il file manca."""
+    try:
+        mtime = USERS_BLOOM_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+    if _USERS_BLOOM["filter"] is not None and mtime == _USERS_BLOOM["mtime"]:
+        return True
+    try:
+        saved = json.loads(USERS_BLOOM_FILE.read_text(encoding="utf-8"))
+        _users_bloom_replace(BloomFilter.from_dict("usernames", saved["filter"]), int(saved["users"]), mtime)
+    except (OSError, ValueError, KeyError):
+        return False
+    return True
+
+def _users_bloom() -> BloomFilter:
+    """Filtro corrente: dal file se presente, altrimenti ricostruito da store.json."""
+    with _USERS_BLOOM_LOCK:
+        if _users_bloom_sync():
+            return _USERS_BLOOM["filter"]
+    with STORE_LOCK:   # nessun utente aggiunto tra la lettura dello store e la scrittura del filtro
+        db = load_db()
+        with _USERS_BLOOM_LOCK:
+            if not _users_bloom_sync():
+                bf = BloomFilter("usernames")
+                for username in db.get("actors", {}):
+                    bf.add(username)
+                _users_bloom_replace(bf, len(db.get("actors", {})), None)
+                _users_bloom_persist()
+            return _USERS_BLOOM["filter"]
+
+def _users_bloom_add(username: str):
+    """Nuovo utente (sotto STORE_LOCK, prima del save_db che lo salva)."""
+    with _USERS_BLOOM_LOCK:
+        if _users_bloom_sync():   # senza file il filtro si ricostruisce al primo login, già con l'utente
+            _USERS_BLOOM["filter"].add(username)
+            _USERS_BLOOM["users"] += 1
+            _USERS_BLOOM["dirty"] = True
+
+def _users_bloom_store(db: Dict[str, Any]):
+    """Da save_db: il filtro su disco deve coprire gli utenti del db che sta per essere salvato."""
+    with _USERS_BLOOM_LOCK:
+        if not _users_bloom_sync():
+            return
+        actors = db.get("actors", {})
+        if len(actors) != _USERS_BLOOM["users"]:
+            # utenti aggiunti senza _users_bloom_add (es. synth): riaggiunta dal db in memoria, niente load_db
+            for username in actors:
+                _USERS_BLOOM["filter"].add(username)
+            _USERS_BLOOM["users"] = len(actors)
+            _USERS_BLOOM["dirty"] = True
+        if _USERS_BLOOM["dirty"]:
+            _users_bloom_persist()
 
 def ensure_actor_keys(actor_id: str):
-    ppriv, ppub = _key_paths(actor_id)
-    if not ppriv.exists() or not ppub.exists():
-        priv, pub = gen_rsa_keypair()
-        save_private_pem(priv, str(ppriv))
-        save_public_pem(pub, str(ppub))
+    # lookup in memoria nel keystore; keygen RSA solo per attori nuovi
+    keystore.ensure(actor_id)
 
 def _read_pub_pem(actor_id: str) -> str:
     ensure_actor_keys(actor_id)
-    _, ppub = _key_paths(actor_id)
-    return ppub.read_text(encoding="utf-8")
+    return keystore.public_pem(actor_id)
 
 def _normalize_role(role: str) -> str:
     role = (role or "").upper()
@@ -101,8 +275,7 @@ def require_fields(body: Dict[str, Any], fields: Tuple[str, ...]) -> Tuple[bool,
 
 def _effective_report_id(report_id: str) -> str:
     """Restituisce l'ID corrente dopo eventuali UPDATE su ledger."""
-    st = state_of(report_id)
-    return st.get("currentReportId", report_id)
+    return current_version(report_id)
 
 def _revoked_for(db: Dict[str, Any], report_id: str) -> set:
     """Insieme dei destinatari revocati (revoca applicativa) per il report corrente."""
@@ -119,9 +292,19 @@ METRICS: Dict[str, Any] = {
     "report_size_cipher": {},       # reportId -> bytes (ciphertext)
 }
 
+# Coalescenza (single-flight) delle pipeline costose per (reportId corrente, destinatario)
+_OPEN_FLIGHT = SingleFlight("hosp_open")
+_SD_FLIGHT = SingleFlight("sd_aes_key")
+
+# generazione delle metriche: cambia a ogni richiesta tranne quelle che leggono solo le metriche stesse
+_METRICS_GEN = [0]
+_METRICS_SELF = ("/api/metrics", "/api/ready")
+
 def _record_request_latency(key: str, ms: float):
     METRICS["requests"].setdefault(key, [])
     METRICS["requests"][key].append(ms)
+    if key not in _METRICS_SELF:
+        _METRICS_GEN[0] += 1
 
 def _percentile(vals: List[float], p: float) -> Optional[float]:
     if not vals: return None
@@ -146,21 +329,103 @@ def measure(route_key: str):
     def deco(fn):
         def wrapper(*a, **kw):
             t0 = time.perf_counter()
+            rv = None
             try:
-                return fn(*a, **kw)
+                rv = fn(*a, **kw)
+                return rv
             finally:
                 dt = (time.perf_counter() - t0) * 1000.0
                 _record_request_latency(route_key, dt)
+                if workload.RECORDER.active:
+                    workload.RECORDER.record(route_key, request, rv, t0, dt)
+        wrapper.__name__ = fn.__name__
+        return wrapper
+    return deco
+
+# il profiler riconosce il frame del wrapper di measure e ne legge la route (nessun costo a profiler spento)
+_MEASURE_CODE = measure("")(lambda: None).__code__
+
+def _route_of_frame(frame) -> Optional[str]:
+    return frame.f_locals.get("route_key") if frame.f_code is _MEASURE_CODE else None
+
+# Priorità dentro una classe di ammissione (più basso = prima)
+PRIO_INTERACTIVE, PRIO_NORMAL, PRIO_BATCH = 0, 1, 2
+
+def admit(cls_name: str, priority: int = PRIO_NORMAL):
+    """Ammissione per classe di costo: 429/503 con Retry-After quando la classe è satura."""
+    def deco(fn):
+        def wrapper(*a, **kw):
+            try:
+                with admission.Slot(cls_name, priority):
+                    return fn(*a, **kw)
+            except admission.Rejected as rej:
+                return (jsonify({"ok": False, "error": f"server busy: {rej.reason}"}), rej.status,
+                        {"Retry-After": str(rej.retry_after)})
         wrapper.__name__ = fn.__name__
         return wrapper
     return deco
 
+# required (default): token obbligatorio | optional: verificato solo se presente (demo) | off: ignora i token
+AUTH_MODE = os.environ.get("APS_AUTH", "required").lower()
+
+def _bearer_token() -> str:
+    auth = request.headers.get("Authorization", "")
+    return auth[7:].strip() if auth.lower().startswith("bearer ") else ""
+
+def session_error(token: str, roles: Tuple[str, ...] = (), actor: Optional[Any] = None,
+                  check_actor: bool = False) -> Optional[Tuple[Dict[str, Any], int]]:
+    """(body, status) se il token non autorizza la richiesta, altrimenti None (anche per la modalità async)."""
+    if AUTH_MODE == "off":
+        return None
+    if not token:
+        return ({"ok": False, "error": "missing session token"}, 401) if AUTH_MODE == "required" else None
+    try:
+        claims = sessions.verify(token)
+    except sessions.InvalidToken as exc:
+        return {"ok": False, "error": f"{exc}"}, 401
+    if roles and claims.get("role") not in roles:
+        return {"ok": False, "error": "role not allowed"}, 403
+    if check_actor and str(actor or "").strip() != claims.get("uid"):
+        return {"ok": False, "error": "token does not match actor"}, 403
+    return None
+
+def require_session(actor_field: Optional[str] = None, roles: Tuple[str, ...] = ()):
+    """Verifica il token di sessione (HMAC, solo memoria) e lo lega all'attore della richiesta."""
+    def deco(fn):
+        def wrapper(*a, **kw):
+            if AUTH_MODE != "off":
+                token = _bearer_token()
+                actor = None
+                if token and actor_field:
+                    actor = kw.get(actor_field) if actor_field in kw else get_json_body().get(actor_field)
+                err = session_error(token, roles, actor, check_actor=bool(actor_field))
+                if err is not None:
+                    return jsonify(err[0]), err[1]
+            return fn(*a, **kw)
+        wrapper.__name__ = fn.__name__
+        return wrapper
+    return deco
+
+# Endpoint di amministrazione: header X-Admin-Token = APS_ADMIN_TOKEN (se non impostato sono disattivati)
+ADMIN_TOKEN = os.environ.get("APS_ADMIN_TOKEN", "")
+
+def require_admin(fn):
+    def wrapper(*a, **kw):
+        if not ADMIN_TOKEN:
+            return jsonify({"ok": False, "error": "admin endpoints disabled (APS_ADMIN_TOKEN not set)"}), 403
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            return jsonify({"ok": False, "error": "admin token required"}), 403
+        return fn(*a, **kw)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
 # ---------------------------------------------------------
 
 # -------------------- KEYS / CA --------------------
 
 @app.post("/api/keys/init")
 @measure("/api/keys/init")
+@admit("keygen")
 def keys_init():
     body = get_json_body()
     actors = body.get("actors") or ["LAB-01", "PAT-123", "HOSP-01"]
@@ -171,14 +436,73 @@ def keys_init():
             ensure_actor_keys(a.strip())
     return jsonify({"ok": True, "generated": actors})
 
+# Le chiavi pubbliche cambiano solo se cambia la chiave: ETag = fingerprint, cache lunga lato client
+PUB_MAX_AGE_S = int(os.environ.get("APS_PUB_MAX_AGE_S", "3600"))
+PUB_BATCH_MAX = 1000
+
+def _conditional(etag: str, cache_control: str, build):
+    """ETag forte + Cache-Control; 304 senza costruire il corpo se il client ha già questa versione."""
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.make_response(build())
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+
 @app.get("/api/keys/pub/<actor_id>")
 @measure("/api/keys/pub")
+@admit("read")
 def get_pub(actor_id: str):
-    pem = _read_pub_pem(actor_id)
-    return (pem, 200, {"Content-Type": "text/plain; charset=utf-8"})
+    """PEM pubblico di un attore. Solo lettura: un attore senza chiavi è 404, nessuna generazione."""
+    der = keystore.public_der(actor_id)
+    if der is None:
+        return jsonify({"ok": False, "error": "no keys for actor"}), 404
+    return _conditional(hashlib.sha256(der).hexdigest(), f"public, max-age={PUB_MAX_AGE_S}",
+                        lambda: (keystore.pem_of(der), 200, {"Content-Type": "text/plain; charset=utf-8"}))
+
+@app.route("/api/keys/pub", methods=["GET", "POST"])
+@measure("/api/keys/pub_batch")
+@admit("read")
+def get_pub_batch():
+    """
+    Chiavi pubbliche di più attori in una risposta: GET ?ids=A,B,C oppure POST { ids: [...] }.
+    format=pem (default) | der (base64). Attori senza chiavi in `missing`, mai generati.
+    Con ?v=<ETag> la risposta è immutabile (il contenuto dipende solo dalle fingerprint).
+    """
+    b = get_json_body() if request.method == "POST" else {}
+    ids = b.get("ids") if request.method == "POST" else (request.args.get("ids") or "").split(",")
+    if not isinstance(ids, list):
+        return jsonify({"ok": False, "error": "ids deve essere lista"}), 400
+    ids = sorted({str(x).strip() for x in ids if str(x).strip()})
+    if not ids:
+        return jsonify({"ok": False, "error": "campi mancanti: ids"}), 400
+    if len(ids) > PUB_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"al massimo {PUB_BATCH_MAX} ids"}), 400
+    fmt = str(b.get("format") or request.args.get("format") or "pem").lower()
+    if fmt not in ("pem", "der"):
+        return jsonify({"ok": False, "error": "format deve essere pem o der"}), 400
+
+    ders = {a: keystore.public_der(a) for a in ids}
+    fps = {a: hashlib.sha256(d).hexdigest() for a, d in ders.items() if d is not None}
+    missing = [a for a in ids if a not in fps]
+    etag = hashlib.sha256(
+        (fmt + "\n" + "\n".join(f"{a}:{fps.get(a, '-')}" for a in ids)).encode("utf-8")).hexdigest()
+    immutable = request.args.get("v") == etag
+    cache_control = "public, max-age=31536000, immutable" if immutable else f"public, max-age={PUB_MAX_AGE_S}"
+
+    def build():
+        keys = {}
+        for a, fp in fps.items():
+            der = ders[a]
+            keys[a] = {"fingerprint": fp,
+                       fmt: keystore.pem_of(der) if fmt == "pem" else base64.b64encode(der).decode("ascii")}
+        return jsonify({"ok": True, "format": fmt, "keys": keys, "missing": missing, "version": etag})
+    return _conditional(etag, cache_control, build)
 
 @app.post("/api/ca/enroll")
 @measure("/api/ca/enroll")
+@admit("keygen")
 def ca_enroll_ep():
     b = get_json_body()
     ok, msg = require_fields(b, ("actorId",))
@@ -189,6 +513,7 @@ def ca_enroll_ep():
 
 @app.post("/api/ca/revoke")
 @measure("/api/ca/revoke")
+@admit("read")
 def ca_revoke_ep():
     b = get_json_body()
     ok, msg = require_fields(b, ("actorId",))
@@ -198,6 +523,7 @@ def ca_revoke_ep():
 
 @app.get("/api/ca/status/<actor_id>")
 @measure("/api/ca/status")
+@admit("read")
 def ca_status(actor_id: str):
     return jsonify({"ok": True, "cert": get_cert(actor_id), "revoked": in_crl(actor_id)})
 
@@ -205,6 +531,7 @@ def ca_status(actor_id: str):
 
 @app.post("/api/auth/register")
 @measure("/api/auth/register")
+@admit("keygen", PRIO_INTERACTIVE)
 def auth_register():
     db = load_db()
     b = get_json_body()
@@ -218,9 +545,7 @@ def auth_register():
     if not ok:
         return jsonify({"ok": False, "error": msg}), 400
 
-    # Idempotente: se l'utente esiste già, ritorniamo 200 con alreadyExists
-    if username in db["actors"]:
-        rec = db["actors"][username]
+    def already_exists(rec):
         return jsonify({
             "ok": True,
             "alreadyExists": True,
@@ -232,25 +557,37 @@ def auth_register():
             },
         }), 200
 
+    # Idempotente: se l'utente esiste già, ritorniamo 200 con alreadyExists
+    if username in db["actors"]:
+        return already_exists(db["actors"][username])
+
     uid = _rand_uid(role)
     ensure_actor_keys(uid)
+    password_hash = generate_password_hash(password)
+
+    with STORE_LOCK:
+        db = load_db()
+        if username in db["actors"]:
+            # registrato in concorrenza mentre generavamo le chiavi: vince il primo
+            return already_exists(db["actors"][username])
+        _users_bloom_add(username)
+        db["actors"][username] = {
+            "uid": uid,
+            "role": role,
+            "displayName": name,
+            "email": email,
+            "password": password_hash,
+            "hasKeys": True,
+        }
+        save_db(db)
 
-    db["actors"][username] = {
-        "uid": uid,
-        "role": role,
-        "displayName": name,
-        "email": email,
-        "password": generate_password_hash(password),
-        "hasKeys": True,
-    }
-    save_db(db)
-
-    return jsonify({"ok": True, "user": {"uid": uid, "role": role, "displayName": name, "hasKeys": True}}), 200
+    return jsonify({"ok": True, "user": {"uid": uid, "role": role, "displayName": name, "hasKeys": True},
+                    "session": sessions.issue(uid, role)}), 200
 
 @app.post("/api/auth/login")
 @measure("/api/auth/login")
+@admit("sign", PRIO_INTERACTIVE)
 def auth_login():
-    db = load_db()
     b = get_json_body()
     ok, msg = require_fields(b, ("username", "password"))
     if not ok:
@@ -259,7 +596,14 @@ def auth_login():
     username = str(b.get("username", "")).strip()
     password = str(b.get("password", "")).strip()
 
+    # username mai registrato: risposta dal filtro di Bloom, senza caricare store.json
+    users = _users_bloom()
+    if not users.might_contain(username):
+        return jsonify({"ok": False, "error": "Credenziali errate"}), 401
+    db = load_db()
     rec = db["actors"].get(username)
+    if not rec:
+        users.record_miss()
     if not rec or not check_password_hash(rec.get("password",""), password):
         return jsonify({"ok": False, "error": "Credenziali errate"}), 401
 
@@ -274,14 +618,120 @@ def auth_login():
             "displayName": rec["displayName"],
             "hasKeys": True,
         },
+        "session": sessions.issue(uid, rec["role"]),
     })
 
+@app.post("/api/auth/logout")
+@measure("/api/auth/logout")
+@admit("read")
+def auth_logout():
+    """Revoca il token presentato (lista di revoca fino alla scadenza naturale)."""
+    try:
+        claims = sessions.verify(_bearer_token())
+    except sessions.InvalidToken as exc:
+        return jsonify({"ok": False, "error": f"{exc}"}), 401
+    sessions.revoke(claims)
+    return jsonify({"ok": True})
+
+@app.get("/api/auth/session")
+@measure("/api/auth/session")
+@admit("read", PRIO_INTERACTIVE)
+def auth_session():
+    try:
+        return jsonify({"ok": True, "claims": sessions.verify(_bearer_token())})
+    except sessions.InvalidToken as exc:
+        return jsonify({"ok": False, "error": f"{exc}"}), 401
+
 # -------------------- LAB EMIT / REVOKE / UPDATE --------------------
 
+def _content_bytes(b: Dict[str, Any]) -> Optional[bytes]:
+    """Contenuto del referto (testo o base64 con contentIsBase64); None se il base64 non è valido."""
+    if b.get("contentIsBase64"):
+        try:
+            return base64.b64decode(str(b["content"]))
+        except Exception:
+            return None
+    return str(b["content"]).encode("utf-8")
+
+def _report_aad(b: Dict[str, Any], report_id: str, lab_id: str, patient: str, issued_at: str) -> Dict[str, str]:
+    aad = {
+        "reportId": report_id,
+        "labId": lab_id,
+        "patientRef": patient,
+        "issuedAt": issued_at,
+    }
+    for field in ("examType", "resultShort", "note"):
+        value = str(b.get(field, "")).strip()
+        if value:
+            aad[field] = value
+    return aad
+
+def _lab_message(env: Dict[str, Any]) -> bytes:
+    """Messaggio firmato dal LAB per un referto: H(ciphertext)||AAD (foglia di Merkle nei batch)."""
+    return sha256_bytes(b64d(env["ciphertext"])) + dumps(env["aad"]).encode("utf-8")
+
+# Radici di batch già verificate: (labId, root, firma); la firma RSA di un batch si verifica una volta sola
+_VERIFIED_ROOTS: "OrderedDict[Tuple[str, str, str], bool]" = OrderedDict()
+_VERIFIED_ROOTS_MAX = 4096
+_ROOTS_LOCK = threading.Lock()
+LAB_SIG_STATS = {"single": 0, "batch": 0, "rootCacheHits": 0}
+
+def _verify_signed_message(lab_id: str, msg: bytes, sig: str, batch: Optional[Dict[str, Any]]) -> bool:
+    """Firma diretta su `msg`, oppure prova di inclusione di `msg` + firma della radice del batch (in cache)."""
+    if not batch:
+        LAB_SIG_STATS["single"] += 1
+        return verify_signature(keystore.public_key(lab_id), msg, sig)
+    LAB_SIG_STATS["batch"] += 1
+    root = str(batch.get("root") or "")
+    if not merkle_verify(leaf_hash(msg), batch.get("path") or [], root):
+        return False
+    key = (lab_id, root, sig)
+    with _ROOTS_LOCK:
+        if key in _VERIFIED_ROOTS:
+            _VERIFIED_ROOTS.move_to_end(key)
+            LAB_SIG_STATS["rootCacheHits"] += 1
+            return True
+    ok = verify_signature(keystore.public_key(lab_id), root_message(root), sig)
+    if ok:
+        with _ROOTS_LOCK:
+            _VERIFIED_ROOTS[key] = True
+            while len(_VERIFIED_ROOTS) > _VERIFIED_ROOTS_MAX:
+                _VERIFIED_ROOTS.popitem(last=False)
+    return ok
+
+def _verify_lab_signature(lab_id: str, env: Dict[str, Any]) -> bool:
+    """Firma per referto (H(ct)||AAD) oppure prova di inclusione + firma della radice del batch."""
+    return _verify_signed_message(lab_id, _lab_message(env), env.get("sig_lab", ""), env.get("batch"))
+
+def _sd_fields(aad: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    """Campi impegnati: tutti i campi AAD + campi strutturati del contenuto (`fields` o content JSON oggetto)."""
+    fields: Dict[str, Any] = dict(aad)
+    extra = b.get("fields")
+    if extra is None and not b.get("contentIsBase64"):
+        try:
+            extra = json.loads(str(b.get("content", "")))
+        except ValueError:
+            extra = None
+    if isinstance(extra, dict):
+        fields.update({f"content.{k}": v for k, v in extra.items()})
+    return fields
+
+def _sd_aad(report_id: str) -> bytes:
+    return f"APS-SD|{report_id}".encode("utf-8")
+
+def _seal_sd(env: Dict[str, Any], fields: Dict[str, Any], aes_key: bytes) -> Dict[str, Any]:
+    """env["sd"]: radice degli impegni, nomi dei campi e aperture cifrate con la chiave del referto."""
+    root, openings = commit_fields(fields)
+    nonce = os.urandom(12)
+    sealed = AESGCM(aes_key).encrypt(nonce, dumps(openings).encode("utf-8"), _sd_aad(env["aad"]["reportId"]))
+    env["sd"] = {"root": root, "fields": sorted(fields), "openings": b64e(nonce + sealed)}
+    return env["sd"]
+
 @app.post("/api/lab/emit")
 @measure("/api/lab/emit")
+@require_session("labId", ("LAB",))
+@admit("sign")
 def lab_emit():
-    db = load_db()
     b = get_json_body()
 
     ok, msg = require_fields(b, ("reportId", "labId", "patientRef", "content"))
@@ -292,49 +742,36 @@ def lab_emit():
     lab_id = str(b["labId"]).strip()
     patient = str(b["patientRef"]).strip()
 
-    if b.get("contentIsBase64"):
-        try:
-            content = __import__("base64").b64decode(str(b["content"]))
-        except Exception:
-            return jsonify({"ok": False, "error": "content base64 non valido"}), 400
-    else:
-        content = str(b["content"]).encode("utf-8")
+    content = _content_bytes(b)
+    if content is None:
+        return jsonify({"ok": False, "error": "content base64 non valido"}), 400
 
     issued_at = datetime.now(timezone.utc).isoformat()
 
-    exam_type = str(b.get("examType", "")).strip()
-    result_short = str(b.get("resultShort", "")).strip()
-    note = str(b.get("note", "")).strip()
-
     ensure_actor_keys(lab_id)
     ensure_actor_keys(patient)
-    lab_priv = load_private_pem(str(_key_paths(lab_id)[0]))
-    pat_pub = load_public_pem(str(_key_paths(patient)[1]))
+    lab_priv = keystore.private_key(lab_id)
+    pat_pub = keystore.public_key(patient)
 
-    aad = {
-        "reportId": report_id,
-        "labId": lab_id,
-        "patientRef": patient,
-        "issuedAt": issued_at,
-    }
-    if exam_type: aad["examType"] = exam_type
-    if result_short: aad["resultShort"] = result_short
-    if note: aad["note"] = note
+    aad = _report_aad(b, report_id, lab_id, patient, issued_at)
 
     # ===== METRICS: misura latenza generazione (encrypt + sign) =====
     t0 = time.perf_counter()
 
+    aes_key = AESGCM.generate_key(bit_length=256)
     env = encrypt_for_recipients(
         plaintext=content,
         aad=aad,
         recipients={patient: pat_pub},
+        aes_key=aes_key,
     )
 
     # Firma su H(ciphertext_bytes)||AAD
     ct_bytes = b64d(env["ciphertext"])
-    h_ct = sha256_bytes(ct_bytes)
-    tosig = h_ct + dumps(env["aad"]).encode("utf-8")
-    env["sig_lab"] = sign_bytes(lab_priv, tosig)
+    env["sig_lab"] = sign_bytes(lab_priv, _lab_message(env))
+    # Impegni per campo (divulgazione selettiva): radice firmata a parte
+    sd = _seal_sd(env, _sd_fields(aad, b), aes_key)
+    sd["sig"] = sign_bytes(lab_priv, sd_message(sd["root"]))
 
     gen_ms = (time.perf_counter() - t0) * 1000.0
     METRICS["generate_latency_ms"].append(gen_ms)
@@ -344,8 +781,7 @@ def lab_emit():
     METRICS["report_size_cipher"][report_id] = len(ct_bytes)
 
     # Persisti envelope e pubblica evento PUBLISH_REPORT
-    db["envelopes"][report_id] = env
-    save_db(db)
+    _store_envelopes({report_id: env})
 
     hash_referto_hex = sha256_bytes(ct_bytes).hex()
     publish_report(
@@ -355,12 +791,105 @@ def lab_emit():
         hash_referto=hash_referto_hex,
         sig_lab=env["sig_lab"],
         issuedAt=issued_at,
+        sd_root=sd["root"],
     )
 
     return jsonify({"ok": True, "envelope": env, "metrics": {"generate_ms": gen_ms}})
 
+LAB_BATCH_MAX = int(os.environ.get("APS_LAB_BATCH_MAX", "10000"))
+
+@app.post("/api/lab/emit_batch")
+@measure("/api/lab/emit_batch")
+@require_session("labId", ("LAB",))
+@admit("sign", PRIO_BATCH)
+def lab_emit_batch():
+    """
+    Emissione a lotti: una sola firma RSA-PSS per N referti.
+    Il LAB firma la radice di Merkle delle foglie H(ct)||AAD (più le radici SD dei referti); ogni envelope
+    e ogni PUBLISH_REPORT porta la propria prova di inclusione in "batch": {"root", "path"}.
+    Input: { labId, items: [{ reportId, patientRef, content, contentIsBase64?, examType?, resultShort?, note? }] }
+    """
+    b = get_json_body()
+    ok, msg = require_fields(b, ("labId", "items"))
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 400
+    items = b["items"]
+    if not isinstance(items, list) or not items:
+        return jsonify({"ok": False, "error": "items deve essere una lista non vuota"}), 400
+    if len(items) > LAB_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"al massimo {LAB_BATCH_MAX} referti per batch"}), 400
+    lab_id = str(b["labId"]).strip()
+
+    contents: Dict[str, bytes] = {}
+    for i, it in enumerate(items):
+        ok, msg = require_fields(it if isinstance(it, dict) else {}, ("reportId", "patientRef", "content"))
+        if not ok:
+            return jsonify({"ok": False, "error": f"items[{i}]: {msg}"}), 400
+        rid = str(it["reportId"]).strip()
+        if rid in contents:
+            return jsonify({"ok": False, "error": f"items[{i}]: reportId duplicato"}), 400
+        contents[rid] = _content_bytes(it)
+        if contents[rid] is None:
+            return jsonify({"ok": False, "error": f"items[{i}]: content base64 non valido"}), 400
+
+    ensure_actor_keys(lab_id)
+    lab_priv = keystore.private_key(lab_id)
+    issued_at = datetime.now(timezone.utc).isoformat()
+
+    t0 = time.perf_counter()
+    envs = []
+    for it in items:
+        report_id = str(it["reportId"]).strip()
+        patient = str(it["patientRef"]).strip()
+        content = contents[report_id]
+        ensure_actor_keys(patient)
+        aes_key = AESGCM.generate_key(bit_length=256)
+        env = encrypt_for_recipients(
+            plaintext=content,
+            aad=_report_aad(it, report_id, lab_id, patient, issued_at),
+            recipients={patient: keystore.public_key(patient)},
+            aes_key=aes_key,
+        )
+        _seal_sd(env, _sd_fields(env["aad"], it), aes_key)
+        envs.append((report_id, patient, content, env))
+
+    # foglie 0..n-1: H(ct)||AAD; foglie n..2n-1: radici SD (stessa firma per entrambe)
+    n = len(envs)
+    levels = merkle_tree([leaf_hash(_lab_message(env)) for _, _, _, env in envs] +
+                         [leaf_hash(sd_message(env["sd"]["root"])) for _, _, _, env in envs])
+    root = merkle_root(levels).hex()
+    sig = sign_bytes(lab_priv, root_message(root))
+    gen_ms = (time.perf_counter() - t0) * 1000.0
+
+    for i, (report_id, patient, content, env) in enumerate(envs):
+        env["sig_lab"] = sig
+        env["batch"] = {"root": root, "path": merkle_path(levels, i)}
+        env["sd"].update({"sig": sig, "batch": {"root": root, "path": merkle_path(levels, n + i)}})
+        # latenza ammortizzata per referto
+        METRICS["generate_latency_ms"].append(gen_ms / len(envs))
+        METRICS["report_size_plain"][report_id] = len(content)
+        METRICS["report_size_cipher"][report_id] = len(b64d(env["ciphertext"]))
+    _store_envelopes({report_id: env for report_id, _, _, env in envs})
+
+    for report_id, patient, _, env in envs:
+        publish_report(
+            reportId=report_id,
+            labId=lab_id,
+            patientRef=patient,
+            hash_referto=sha256_bytes(b64d(env["ciphertext"])).hex(),
+            sig_lab=sig,
+            issuedAt=issued_at,
+            batch=env["batch"],
+            sd_root=env["sd"]["root"],
+        )
+
+    return jsonify({"ok": True, "root": root, "reportIds": [rid for rid, _, _, _ in envs],
+                    "metrics": {"generate_ms": gen_ms, "per_report_ms": gen_ms / len(envs)}})
+
 @app.post("/api/lab/revoke")
 @measure("/api/lab/revoke")
+@require_session("labId", ("LAB",))
+@admit("read")
 def lab_revoke():
     b = get_json_body()
     ok, msg = require_fields(b, ("reportId", "labId"))
@@ -377,8 +906,18 @@ def lab_revoke():
     ev = revoke_report(b["reportId"], b["labId"], b.get("reason",""))
     return jsonify({"ok": True, "event": ev})
 
+def _report_owner(report_id: str, db: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """(labId, patientRef) dal PUBLISH sul ledger o dall'AAD dell'envelope; None se l'ID non è mai stato emesso."""
+    pub = get_publish(report_id)
+    if pub:
+        return pub.get("labId"), pub.get("patientRef")
+    aad = (db["envelopes"].get(report_id) or {}).get("aad")
+    return (aad.get("labId"), aad.get("patientRef")) if aad else None
+
 @app.post("/api/lab/update")
 @measure("/api/lab/update")
+@require_session("labId", ("LAB",))
+@admit("read")
 def lab_update():
     b = get_json_body()
     ok, msg = require_fields(b, ("oldReportId", "newReportId", "labId", "envelope"))
@@ -393,8 +932,15 @@ def lab_update():
         return jsonify({"ok": False, "error": "cannot update a revoked report"}), 409
 
     db = load_db()
-    db["envelopes"][b["newReportId"]] = b["envelope"]
-    save_db(db)
+    # la catena di versioni resta lineare: la nuova versione non può essere già in una catena né
+    # appartenere a un altro lab/paziente (un ID appena emesso con /lab/emit per lo stesso referto va bene)
+    if b["newReportId"] == b["oldReportId"] or in_version_chain(b["newReportId"]):
+        return jsonify({"ok": False, "error": "newReportId already in a version chain"}), 409
+    pat_old = (_report_owner(b["oldReportId"], db) or (None, None))[1]
+    owner_new = _report_owner(b["newReportId"], db)
+    if owner_new is not None and (owner_new[0] != b["labId"] or (pat_old is not None and owner_new[1] != pat_old)):
+        return jsonify({"ok": False, "error": "newReportId belongs to another lab or patient"}), 409
+    _store_envelopes({b["newReportId"]: b["envelope"]})
 
     # ===== METRICS: aggiorna size anche per nuova versione =====
     try:
@@ -405,12 +951,17 @@ def lab_update():
         pass
 
     ev = update_report(b["oldReportId"], b["newReportId"], b["labId"])
+    # due UPDATE concorrenti dalla stessa versione: il ledger tiene solo il primo
+    if state_of(b["oldReportId"]).get("currentReportId") != b["newReportId"]:
+        return jsonify({"ok": False, "error": "report updated concurrently"}), 409
     return jsonify({"ok": True, "event": ev})
 
 # -------------------- PATIENT SHARE / UNSHARE --------------------
 
 @app.post("/api/patient/share")
 @measure("/api/patient/share")
+@require_session("patientId", ("PAT",))
+@admit("sign", PRIO_INTERACTIVE)
 def patient_share():
     """Condivisione: GRANT firmato dal PAT sulla VERSIONE CORRENTE del referto."""
     db = load_db()
@@ -432,8 +983,8 @@ def patient_share():
 
     ensure_actor_keys(pid)
     ensure_actor_keys(hid)
-    pat_priv = load_private_pem(str(_key_paths(pid)[0]))
-    hosp_pub = load_public_pem(str(_key_paths(hid)[1]))
+    pat_priv = keystore.private_key(pid)
+    hosp_pub = keystore.public_key(hid)
 
     # unwrap della chiave del paziente sul CURRENT
     b64wrap = (env.get("ek_for") or {}).get(pid)
@@ -441,7 +992,7 @@ def patient_share():
         return jsonify({"ok": False, "error": "no key for patient in envelope"}), 400
 
     try:
-        aes_key = _unwrap_key(pat_priv, b64wrap)   # bytes
+        aes_key = rotation.unwrap_any(pid, b64wrap, (env.get("ek_gen") or {}).get(pid))   # bytes
     except Exception as exc:
         return jsonify({"ok": False, "error": f"unwrap failed: {exc}"}), 400
 
@@ -457,18 +1008,16 @@ def patient_share():
     ev = grant_access(rid, pid, hid, ek_h_b64, sig_pat)
 
     # Se esisteva una revoca applicativa per questo destinatario sulla versione corrente, rimuovila
-    revoked = db.get("revoked") or {}
-    cur = set(revoked.get(rid) or [])
-    if hid in cur:
-        cur.discard(hid)
-        revoked[rid] = sorted(cur)
-        db["revoked"] = revoked
-        save_db(db)
+    if hid in _revoked_for(db, rid):
+        _unrevoke(rid, hid)
 
     return jsonify({"ok": True, "grant": ev, "currentReportId": rid})
 
 @app.post("/api/patient/unshare")
 @measure("/api/patient/unshare")
+@require_session("patientId", ("PAT",))
+@admit("read")
+@store_write
 def patient_unshare():
     """Revoca 'soft' lato paziente: blocca nuove aperture per il destinatario su questo referto (versione corrente)."""
     db = load_db()
@@ -501,45 +1050,297 @@ def patient_unshare():
 
     return jsonify({"ok": True, "revokedFor": rid, "target": hid})
 
+# -------------------- GRUPPI DI DESTINATARI --------------------
+
+# Privata X25519 per (gruppo, epoca): un solo unwrap RSA da parte di un membro, poi riuso
+_GROUP_PRIV: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+_GROUP_PRIV_MAX = 4096
+_VERIFIED_GROUP_EPOCHS: set = set()   # txId delle epoche con firma dell'owner già verificata
+_GROUPS_LOCK = threading.Lock()
+GROUP_STATS = {"keyUnwraps": 0, "keyCacheHits": 0}
+
+def _group_body(ev: Dict[str, Any]) -> bytes:
+    fields = ("groupId", "epoch", "owner", "members", "pub", "ek_members", "ek_prev")
+    return dumps({k: ev.get(k) for k in fields}).encode("utf-8")
+
+def _group_summary(ev: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: ev.get(k) for k in ("groupId", "epoch", "owner", "members", "pub", "ts", "txId")}
+
+def _group_epoch_valid(ev: Dict[str, Any]) -> bool:
+    """Firma dell'owner sull'epoca del gruppo (verificata una volta per txId)."""
+    with _GROUPS_LOCK:
+        if ev.get("txId") in _VERIFIED_GROUP_EPOCHS:
+            return True
+    owner = str(ev.get("owner") or "")
+    if not keystore.has(owner) or not rotation.verify_any(owner, _group_body(ev), ev.get("sig_owner", "")):
+        return False
+    with _GROUPS_LOCK:
+        _VERIFIED_GROUP_EPOCHS.add(ev.get("txId"))
+    return True
+
+def _cache_group_priv(group_id: str, epoch: int, priv: bytes):
+    with _GROUPS_LOCK:
+        _GROUP_PRIV[(group_id, epoch)] = priv
+        while len(_GROUP_PRIV) > _GROUP_PRIV_MAX:
+            _GROUP_PRIV.popitem(last=False)
+
+def _group_priv(group_id: str, epoch: int, member: str, epochs: Optional[List[Dict[str, Any]]] = None) -> Optional[bytes]:
+    """Privata del gruppo all'epoca `epoch` per un membro dell'epoca corrente: unwrap RSA + catena verso il passato."""
+    with _GROUPS_LOCK:
+        priv = _GROUP_PRIV.get((group_id, epoch))
+        if priv is not None:
+            _GROUP_PRIV.move_to_end((group_id, epoch))
+            GROUP_STATS["keyCacheHits"] += 1
+            return priv
+    epochs = epochs if epochs is not None else group_epochs(group_id)
+    if not 0 <= epoch < len(epochs):
+        return None
+    cur = epochs[-1]
+    wrapped = (cur.get("ek_members") or {}).get(member)
+    if not wrapped or not _group_epoch_valid(cur):
+        return None
+    priv = rotation.unwrap_any(member, wrapped)
+    GROUP_STATS["keyUnwraps"] += 1
+    e = cur["epoch"]
+    _cache_group_priv(group_id, e, priv)
+    while e > epoch:
+        priv = chain_unwrap(priv, epochs[e]["ek_prev"], f"{group_id}|{e}")
+        e -= 1
+        _cache_group_priv(group_id, e, priv)
+    return priv
+
+def _new_group_epoch(group_id: str, owner: str, members: List[str], epochs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Nuova epoca: coppia X25519 nuova incapsulata per ogni membro e catena verso la privata precedente."""
+    epoch = len(epochs)
+    priv, pub = gen_group_key()
+    prev = _group_priv(group_id, epoch - 1, owner, epochs) if epochs else None
+    body = {
+        "groupId": group_id,
+        "epoch": epoch,
+        "owner": owner,
+        "members": members,
+        "pub": b64e(pub),
+        "ek_members": {m: _wrap_key(keystore.public_key(m), priv) for m in members},
+        "ek_prev": chain_wrap(priv, prev, f"{group_id}|{epoch}") if prev else None,
+    }
+    body["sig_owner"] = sign_bytes(keystore.private_key(owner), _group_body(body))
+    ev = publish_group_key(**body)
+    _cache_group_priv(group_id, epoch, priv)
+    return ev
+
+def _group_grant_key(rid: str, hid: str) -> Tuple[Optional[bytes], str, int]:
+    """Chiave AES del referto da un GRANT verso un gruppo di cui `hid` è membro corrente: (chiave, errore, status)."""
+    revoked = _revoked_for(load_db(), rid)
+    err = "no grant for hospital"
+    for gid in groups_for_member(hid):
+        grants = lookup_grants(rid, gid)
+        if not grants:
+            continue
+        if gid in revoked:
+            err = "access revoked by patient"
+            continue
+        last = grants[-1]
+        pat = str(last.get("from") or "")
+        content = {k: last.get(k) for k in ("reportId", "from", "to", "ek_to", "epoch")}
+        if not keystore.has(pat) or not rotation.verify_any(pat, dumps(content).encode("utf-8"), last.get("sig_pat", ""),
+                                                            (last.get("keyGen") or {}).get("from")):
+            return None, "invalid grant signature", 400
+        epoch = int(last.get("epoch") or 0)
+        priv = _group_priv(gid, epoch, hid)
+        if priv is None:
+            continue
+        try:
+            return group_unwrap(priv, last["ek_to"], f"{rid}|{gid}|{epoch}"), "", 200
+        except Exception as exc:
+            return None, f"unwrap failed: {exc}", 400
+    return None, err, 403
+
+def _member_list(value: Any) -> Optional[set]:
+    if not isinstance(value, list):
+        return None
+    return {str(m).strip() for m in value if str(m).strip()}
+
+@app.post("/api/groups")
+@measure("/api/groups/create")
+@require_session("ownerId", ("HOSP",))
+@admit("sign")
+def group_create():
+    """Crea un gruppo di destinatari (es. un reparto): epoca 0, chiave di gruppo incapsulata per ogni membro."""
+    b = get_json_body()
+    ok, msg = require_fields(b, ("ownerId", "members"))
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 400
+    owner = str(b["ownerId"]).strip()
+    members = _member_list(b["members"])
+    if members is None:
+        return jsonify({"ok": False, "error": "members deve essere lista"}), 400
+    gid = str(b.get("groupId") or f"GRP-{secrets.token_hex(3).upper()}").strip()
+    if group_current(gid):
+        return jsonify({"ok": False, "error": "group already exists"}), 409
+    members = sorted(members | {owner})
+    missing = [m for m in members if not keystore.has(m)]
+    if missing:
+        return jsonify({"ok": False, "error": f"members without keys: {', '.join(missing)}"}), 400
+    ev = _new_group_epoch(gid, owner, members, [])
+    return jsonify({"ok": True, "group": _group_summary(ev)})
+
+@app.post("/api/groups/<group_id>/members")
+@measure("/api/groups/members")
+@require_session("ownerId", ("HOSP",))
+@admit("sign")
+def group_members(group_id: str):
+    """Aggiunge/rimuove membri: nuova epoca (rotazione della chiave); i rimossi non aprono più le condivisioni del gruppo."""
+    b = get_json_body()
+    ok, msg = require_fields(b, ("ownerId",))
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 400
+    owner = str(b["ownerId"]).strip()
+    epochs = group_epochs(group_id)
+    if not epochs:
+        return jsonify({"ok": False, "error": "group not found"}), 404
+    if epochs[0].get("owner") != owner:
+        return jsonify({"ok": False, "error": "not owner"}), 403
+    add, remove = _member_list(b.get("add", [])), _member_list(b.get("remove", []))
+    if add is None or remove is None:
+        return jsonify({"ok": False, "error": "add/remove devono essere liste"}), 400
+    current = set(epochs[-1].get("members") or ())
+    members = ((current | add) - remove) | {owner}
+    if members == current:
+        return jsonify({"ok": True, "group": _group_summary(epochs[-1]), "rotated": False})
+    missing = [m for m in sorted(members) if not keystore.has(m)]
+    if missing:
+        return jsonify({"ok": False, "error": f"members without keys: {', '.join(missing)}"}), 400
+    ev = _new_group_epoch(group_id, owner, sorted(members), epochs)
+    return jsonify({"ok": True, "group": _group_summary(ev), "rotated": True})
+
+@app.get("/api/groups/<group_id>")
+@measure("/api/groups/get")
+@admit("read")
+def group_get(group_id: str):
+    cur = group_current(group_id)
+    if not cur:
+        return jsonify({"ok": False, "error": "group not found"}), 404
+    return jsonify({"ok": True, "group": _group_summary(cur)})
+
+@app.get("/api/recipient/<recipient_id>/groups")
+@measure("/api/recipient/groups")
+@require_session("recipient_id", ("HOSP", "DOC"))
+@admit("read")
+def recipient_groups(recipient_id: str):
+    items = [_group_summary(group_current(gid)) for gid in groups_for_member(recipient_id)]
+    return jsonify({"ok": True, "items": items})
+
+@app.post("/api/patient/share_group")
+@measure("/api/patient/share_group")
+@require_session("patientId", ("PAT",))
+@admit("sign", PRIO_INTERACTIVE)
+def patient_share_group():
+    """Condivisione verso un gruppo: un solo GRANT con un solo wrap (verso la chiave pubblica dell'epoca corrente)."""
+    db = load_db()
+    b = get_json_body()
+    ok, msg = require_fields(b, ("reportId", "patientId", "groupId"))
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 400
+
+    pid = str(b["patientId"]).strip()
+    gid = str(b["groupId"]).strip()
+    rid = _effective_report_id(str(b["reportId"]).strip())
+
+    env = db["envelopes"].get(rid)
+    if not env:
+        return jsonify({"ok": False, "error": "report not found"}), 404
+    cur = group_current(gid)
+    if not cur:
+        return jsonify({"ok": False, "error": "group not found"}), 404
+    if not _group_epoch_valid(cur):
+        return jsonify({"ok": False, "error": "invalid group key signature"}), 400
+
+    b64wrap = (env.get("ek_for") or {}).get(pid)
+    if not b64wrap:
+        return jsonify({"ok": False, "error": "no key for patient in envelope"}), 400
+    pat_priv = keystore.private_key(pid)
+    try:
+        aes_key = rotation.unwrap_any(pid, b64wrap, (env.get("ek_gen") or {}).get(pid))
+    except Exception as exc:
+        return jsonify({"ok": False, "error": f"unwrap failed: {exc}"}), 400
+
+    epoch = cur["epoch"]
+    ek_g_b64 = group_wrap(b64d(cur["pub"]), aes_key, f"{rid}|{gid}|{epoch}")
+    grant_obj = {"reportId": rid, "from": pid, "to": gid, "ek_to": ek_g_b64, "epoch": epoch}
+    sig_pat = sign_bytes(pat_priv, dumps(grant_obj).encode("utf-8"))
+    ev = grant_access(rid, pid, gid, ek_g_b64, sig_pat, epoch=epoch)
+
+    if gid in _revoked_for(db, rid):
+        _unrevoke(rid, gid)
+
+    return jsonify({"ok": True, "grant": ev, "currentReportId": rid, "members": cur.get("members")})
+
 # -------------------- HOSP/DOC OPEN --------------------
 
 @app.post("/api/hosp/open")
 @measure("/api/hosp/open")
+@require_session("hospitalId", ("HOSP", "DOC"))
+@admit("decrypt", PRIO_INTERACTIVE)
 def hosp_open():
-    db = load_db()
-    b = get_json_body()
+    found, err = open_lookup(get_json_body())
+    if err is not None:
+        return jsonify(err[0]), err[1]
+    env, rid_effective, hid, status = found
+    # Verifica + unwrap + decrypt: richieste identiche concorrenti condividono un solo calcolo
+    out, code = _OPEN_FLIGHT.do((rid_effective, hid), lambda: _open_verified(env, rid_effective, hid))
+    if code != 200:
+        return jsonify(out), code
+    return jsonify({**out, "state": status})
+
+def open_lookup(b: Dict[str, Any], read_db: Callable[[], Dict[str, Any]] = load_db
+                ) -> Tuple[Optional[Tuple[Dict[str, Any], str, str, str]], Optional[Tuple[Dict[str, Any], int]]]:
+    """
+    Parte di /hosp/open che legge ledger e store (niente crittografia):
+    ((envelope, versione corrente, destinatario, stato), None) oppure (None, (body, status)).
+    `read_db` è usato in sola lettura (la modalità async passa uno snapshot condiviso).
+    """
     # labId NON serve più: lo ricaviamo e verifichiamo dall'AAD e dal ledger
     ok, msg = require_fields(b, ("reportId", "hospitalId"))
     if not ok:
-        return jsonify({"ok": False, "error": msg}), 400
+        return None, ({"ok": False, "error": msg}, 400)
 
     rid = str(b["reportId"]).strip()
     hid = str(b["hospitalId"]).strip()
 
-    # Stato ledger: indirizza sempre alla versione corrente
+    # Stato ledger: indirizza sempre alla versione corrente (reportId sconosciuto: nessun load_db)
     st = state_of(rid)
     if st["status"] in ("REVOKED", "UNKNOWN"):
-        return jsonify({"ok": False, "error": f"report state {st['status']}"}), 409
+        return None, ({"ok": False, "error": f"report state {st['status']}"}, 409)
     rid_effective = st["currentReportId"]
+    db = read_db()
 
     # Enforcement revoca applicativa del paziente sulla versione corrente
     if hid in _revoked_for(db, rid_effective):
-        return jsonify({"ok": False, "error": "access revoked by patient"}), 403
+        return None, ({"ok": False, "error": "access revoked by patient"}, 403)
 
     # Envelope corrente
     env = db["envelopes"].get(rid_effective)
     if not env:
-        return jsonify({"ok": False, "error": "report not found"}), 404
+        return None, ({"ok": False, "error": "report not found"}, 404)
+    if retention.is_stub(env):
+        return None, ({"ok": False, "error": "report ciphertext retired by retention policy"}, 410)
 
     aad = env.get("aad") or {}
     lab_id = str(aad.get("labId") or "").strip()
     patient_ref = str(aad.get("patientRef") or "").strip()
     if not lab_id or not patient_ref:
-        return jsonify({"ok": False, "error": "invalid envelope (missing AAD fields)"}), 400
+        return None, ({"ok": False, "error": "invalid envelope (missing AAD fields)"}, 400)
 
     # (Opzionale) verifica CA/CRL del LAB
     if in_crl(lab_id):
-        return jsonify({"ok": False, "error": "lab certificate revoked (CRL)"}), 403
+        return None, ({"ok": False, "error": "lab certificate revoked (CRL)"}, 403)
+    return (env, rid_effective, hid, st["status"]), None
+
+def _open_verified(env: Dict[str, Any], rid_effective: str, hid: str) -> Tuple[Dict[str, Any], int]:
+    """Pipeline costosa di /hosp/open (ledger, firme, unwrap RSA, AES-GCM). Ritorna (body, status)."""
+    aad = env.get("aad") or {}
+    lab_id = str(aad.get("labId") or "").strip()
+    patient_ref = str(aad.get("patientRef") or "").strip()
 
     # Verifica coerenza con ledger (hash + binding lab/patient)
     ct_bytes = b64d(env["ciphertext"])
@@ -547,62 +1348,71 @@ def hosp_open():
 
     pub_ev = get_publish(rid_effective)
     if not pub_ev:
-        return jsonify({"ok": False, "error": "publish event not found on ledger"}), 400
+        return {"ok": False, "error": "publish event not found on ledger"}, 400
 
     if str(pub_ev.get("hash")) != h_ct_hex:
-        return jsonify({"ok": False, "error": "ledger hash mismatch"}), 400
+        return {"ok": False, "error": "ledger hash mismatch"}, 400
     if str(pub_ev.get("labId")) != lab_id:
-        return jsonify({"ok": False, "error": "ledger/labId mismatch"}), 400
+        return {"ok": False, "error": "ledger/labId mismatch"}, 400
     if str(pub_ev.get("patientRef")) != patient_ref:
-        return jsonify({"ok": False, "error": "ledger/patientRef mismatch"}), 400
+        return {"ok": False, "error": "ledger/patientRef mismatch"}, 400
+
+    if env.get("batch") and (pub_ev.get("batch") or {}).get("root") != env["batch"].get("root"):
+        return {"ok": False, "error": "ledger/batch root mismatch"}, 400
 
-    # Verifica firma del LAB su H(ct)||AAD
-    ensure_actor_keys(lab_id)  # chiavi già presenti se il LAB ha emesso
-    lab_pub = load_public_pem(str(_key_paths(lab_id)[1]))
-    tover = sha256_bytes(ct_bytes) + dumps(aad).encode("utf-8")
-    if not verify_signature(lab_pub, tover, env.get("sig_lab", "")):
-        return jsonify({"ok": False, "error": "invalid lab signature"}), 400
+    # Verifica firma del LAB su H(ct)||AAD (per referto, o prova di Merkle + firma della radice del batch)
+    if not keystore.has(lab_id):
+        return {"ok": False, "error": "unknown lab key"}, 400
+    if not _verify_lab_signature(lab_id, env):
+        return {"ok": False, "error": "invalid lab signature"}, 400
 
     # Decrittazione: prima prova con chiave incapsulata direttamente nell’envelope (se mai presente);
     # in alternativa usa l’ultimo GRANT valido sul current.
     ensure_actor_keys(hid)
-    hosp_priv = load_private_pem(str(_key_paths(hid)[0]))
 
+    # generazione della chiave HOSP/DOC usata per il wrap (nota dopo una rotazione, altrimenti si prova la corrente)
     b64wrap = (env.get("ek_for") or {}).get(hid)
+    wrap_gen = (env.get("ek_gen") or {}).get(hid)
+    aes_key = None
     if not b64wrap:
-        # Nessuna chiave diretta per HOSP/DOC → cerca GRANT correnti
+        # Nessuna chiave diretta per HOSP/DOC → cerca GRANT correnti (diretti, poi verso i suoi gruppi)
         grants = lookup_grants(rid_effective, hid)
         if not grants:
-            return jsonify({"ok": False, "error": "no grant for hospital"}), 403
+            aes_key, err, code = _group_grant_key(rid_effective, hid)
+            if aes_key is None:
+                return {"ok": False, "error": err}, code
+    if not b64wrap and aes_key is None:
         last = grants[-1]
         patId = last.get("from")
         # Verifica firma PAT sul GRANT
         ensure_actor_keys(patId)
         from apscrypto.utils import dumps as _dumps  # evita shadowing
-        pat_pub = load_public_pem(str(_key_paths(patId)[1]))
         grant_content = {
             "reportId": last["reportId"],
             "from": patId,
             "to": hid,
             "ek_to": last["ek_to"],
         }
-        if not verify_signature(pat_pub, _dumps(grant_content).encode("utf-8"), last["sig_pat"]):
-            return jsonify({"ok": False, "error": "invalid grant signature"}), 400
+        key_gen = last.get("keyGen") or {}
+        if not rotation.verify_any(patId, _dumps(grant_content).encode("utf-8"), last["sig_pat"], key_gen.get("from")):
+            return {"ok": False, "error": "invalid grant signature"}, 400
         b64wrap = last["ek_to"]
+        wrap_gen = key_gen.get("to")
 
     # Decifra
     try:
-        aes_key = _unwrap_key(hosp_priv, b64wrap)
+        if aes_key is None:
+            aes_key = rotation.unwrap_any(hid, b64wrap, wrap_gen)
         aesgcm = AESGCM(aes_key)
         nonce = b64d(env["nonce"])
         aad_bytes = dumps(aad).encode("utf-8")
         ct = b64d(env["ciphertext"])
         pt = aesgcm.decrypt(nonce, ct, aad_bytes)
     except Exception as exc:
-        return jsonify({"ok": False, "error": f"decrypt failed: {exc}"}), 400
+        return {"ok": False, "error": f"decrypt failed: {exc}"}, 400
 
     b64 = __import__("base64").b64encode(pt).decode("ascii")
-    return jsonify({"ok": True, "contentB64": b64, "reportId": rid_effective, "state": st["status"]})
+    return {"ok": True, "contentB64": b64, "reportId": rid_effective}, 200
 
 # -------------------- SD VERIFY (simulata per metriche) --------------------
 
@@ -634,36 +1444,50 @@ def _resolve_aes_key_for_hospital(report_id: str, hospital_id: str) -> Tuple[boo
         return False, None, "ledger mismatch"
 
     ensure_actor_keys(hospital_id)
-    hosp_priv = load_private_pem(str(_key_paths(hospital_id)[0]))
 
     b64wrap = (env.get("ek_for") or {}).get(hospital_id)
+    wrap_gen = (env.get("ek_gen") or {}).get(hospital_id)
     if not b64wrap:
         grants = lookup_grants(rid, hospital_id)
         if not grants:
-            return False, None, "no grant for hospital"
+            aes_key, err, _ = _group_grant_key(rid, hospital_id)
+            return (True, aes_key, "") if aes_key is not None else (False, None, err)
         last = grants[-1]
         patId = last.get("from")
         ensure_actor_keys(patId)
         from apscrypto.utils import dumps as _dumps
-        pat_pub = load_public_pem(str(_key_paths(patId)[1]))
         grant_content = {
             "reportId": last["reportId"],
             "from": patId,
             "to": hospital_id,
             "ek_to": last["ek_to"],
         }
-        if not verify_signature(pat_pub, _dumps(grant_content).encode("utf-8"), last["sig_pat"]):
+        key_gen = last.get("keyGen") or {}
+        if not rotation.verify_any(patId, _dumps(grant_content).encode("utf-8"), last["sig_pat"], key_gen.get("from")):
             return False, None, "invalid grant signature"
         b64wrap = last["ek_to"]
+        wrap_gen = key_gen.get("to")
 
     try:
-        aes_key = _unwrap_key(hosp_priv, b64wrap)  # bytes
+        aes_key = rotation.unwrap_any(hospital_id, b64wrap, wrap_gen)  # bytes
         return True, aes_key, ""
     except Exception as exc:
         return False, None, f"unwrap failed: {exc}"
 
+def _resolve_aes_key_coalesced(report_id: str, hospital_id: str) -> Tuple[bool, Optional[bytes], str]:
+    """Controlli di accesso per ogni chiamante; la risoluzione della chiave è condivisa tra richieste concorrenti."""
+    st = state_of(report_id)
+    if st["status"] in ("REVOKED", "UNKNOWN"):
+        return False, None, f"report state {st['status']}"
+    rid = st["currentReportId"]
+    if hospital_id in _revoked_for(load_db(), rid):
+        return False, None, "access revoked by patient"
+    return _SD_FLIGHT.do((rid, hospital_id), lambda: _resolve_aes_key_for_hospital(rid, hospital_id))
+
 @app.post("/api/sd/verify")
 @measure("/api/sd/verify")
+@require_session("hospitalId", ("HOSP", "DOC"))
+@admit("decrypt")
 def sd_verify():
     """
     Verifica SD simulata per metriche.
@@ -681,7 +1505,7 @@ def sd_verify():
     proof = str(b.get("proof") or "").strip().lower()
 
     t0 = time.perf_counter()
-    ok_r, aes_key, err = _resolve_aes_key_for_hospital(report_id, hospital_id)
+    ok_r, aes_key, err = _resolve_aes_key_coalesced(report_id, hospital_id)
     if not ok_r:
         return jsonify({"ok": False, "error": err}), 403
 
@@ -695,23 +1519,204 @@ def sd_verify():
 # (OPZIONALE – solo per demo locale) genera il proof atteso per test veloci
 @app.post("/api/sd/proof_demo")
 @measure("/api/sd/proof_demo")
+@require_session("hospitalId", ("HOSP", "DOC"))
+@admit("decrypt")
 def sd_proof_demo():
     b = get_json_body()
     ok, msg = require_fields(b, ("reportId", "hospitalId", "subsetKeys"))
     if not ok:
         return jsonify({"ok": False, "error": msg}), 400
-    ok_r, aes_key, err = _resolve_aes_key_for_hospital(str(b["reportId"]).strip(), str(b["hospitalId"]).strip())
+    ok_r, aes_key, err = _resolve_aes_key_coalesced(str(b["reportId"]).strip(), str(b["hospitalId"]).strip())
     if not ok_r:
         return jsonify({"ok": False, "error": err}), 403
     subset = list(map(str, b.get("subsetKeys") or []))
     expected_hex = sha256_bytes(aes_key + b"|" + ",".join(sorted(subset)).encode("utf-8")).hex()
     return jsonify({"ok": True, "proof": expected_hex})
 
+# -------------------- SD reale: impegni salati per campo --------------------
+
+@app.post("/api/sd/disclose")
+@measure("/api/sd/disclose")
+@require_session("patientId", ("PAT",))
+@admit("decrypt", PRIO_INTERACTIVE)
+def sd_disclose():
+    """
+    Il paziente rivela solo alcuni campi del referto: valore, sale e prova di inclusione per campo.
+    Input: { reportId, patientId, fields: ["examType", "content.glucosio", ...] } → { disclosure }
+    """
+    db = load_db()
+    b = get_json_body()
+    ok, msg = require_fields(b, ("reportId", "patientId", "fields"))
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 400
+    rid = str(b["reportId"]).strip()
+    pid = str(b["patientId"]).strip()
+    names = b["fields"]
+    if not isinstance(names, list) or not names:
+        return jsonify({"ok": False, "error": "fields deve essere una lista non vuota"}), 400
+
+    env = db["envelopes"].get(rid)
+    if not env:
+        return jsonify({"ok": False, "error": "report not found"}), 404
+    aad = env.get("aad") or {}
+    if str(aad.get("patientRef")) != pid:
+        return jsonify({"ok": False, "error": "not owner"}), 403
+    sd = env.get("sd")
+    if not sd:
+        return jsonify({"ok": False, "error": "report without selective-disclosure commitments"}), 409
+
+    b64wrap = (env.get("ek_for") or {}).get(pid)
+    if not b64wrap:
+        return jsonify({"ok": False, "error": "no key for patient in envelope"}), 400
+    try:
+        aes_key = rotation.unwrap_any(pid, b64wrap, (env.get("ek_gen") or {}).get(pid))
+        raw = b64d(sd["openings"])
+        openings = json.loads(AESGCM(aes_key).decrypt(raw[:12], raw[12:], _sd_aad(rid)))
+    except Exception as exc:
+        return jsonify({"ok": False, "error": f"openings decrypt failed: {exc}"}), 400
+
+    unknown = [n for n in names if n not in openings]
+    if unknown:
+        return jsonify({"ok": False, "error": f"campi sconosciuti: {', '.join(map(str, unknown))}"}), 400
+    disclosure = {
+        "v": 1,
+        "reportId": rid,
+        "labId": aad.get("labId"),
+        "sdRoot": sd["root"],
+        "sig": sd["sig"],
+        "fields": {n: openings[n] for n in names},
+    }
+    if sd.get("batch"):
+        disclosure["batch"] = sd["batch"]
+    return jsonify({"ok": True, "disclosure": disclosure})
+
+@app.post("/api/sd/check")
+@measure("/api/sd/check")
+@admit("read")
+def sd_check():
+    """
+    Verifica di una divulgazione: nessun unwrap RSA e nessuna decrittazione del referto.
+    Radice uguale a quella pubblicata sul ledger, firma del LAB sulla radice (in cache per i batch),
+    poi O(k log n) hash per i k campi rivelati.
+    """
+    b = get_json_body()
+    d = b.get("disclosure")
+    if not isinstance(d, dict) or not isinstance(d.get("fields"), dict):
+        return jsonify({"ok": False, "error": "campi mancanti: disclosure"}), 400
+
+    t0 = time.perf_counter()
+    rid = str(d.get("reportId") or "")
+    pub_ev = get_publish(rid)
+    if not pub_ev:
+        return jsonify({"ok": False, "error": "publish event not found on ledger"}), 404
+    lab_id = str(pub_ev.get("labId") or "")
+    root = str(d.get("sdRoot") or "")
+    if not root or pub_ev.get("sdRoot") != root:
+        return jsonify({"ok": False, "error": "ledger/sdRoot mismatch"}), 400
+    if not keystore.has(lab_id):
+        return jsonify({"ok": False, "error": "unknown lab key"}), 400
+    valid = (_verify_signed_message(lab_id, sd_message(root), str(d.get("sig") or ""), d.get("batch"))
+             and verify_disclosure(root, d["fields"]))
+    dt_ms = (time.perf_counter() - t0) * 1000.0
+    METRICS["verify_latency_ms"].append(dt_ms)
+
+    return jsonify({
+        "ok": bool(valid),
+        "reportId": rid,
+        "labId": lab_id,
+        "status": state_of(rid)["status"],
+        "fields": {n: op.get("value") for n, op in d["fields"].items()} if valid else {},
+        "latency_ms": dt_ms,
+    })
+
+# -------------------- RISPOSTE VERSIONATE (ETag + compressione) --------------------
+
+# Corpo JSON serializzato una volta per versione dei dati sottostanti (store.json / ledger / metriche);
+# copia gzip o deflate compressa al primo client che la chiede e riusata fino al cambio di versione.
+RESP_CACHE_MAX = 64
+_RESP_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_RESP_LOCK = threading.Lock()
+_RESP_FLIGHT = SingleFlight("versioned_json")
+RESP_CACHE_STATS = {"hits": 0, "builds": 0, "compressions": 0}
+_COMPRESS = {"gzip": lambda raw: gzip.compress(raw, 6), "deflate": lambda raw: zlib.compress(raw, 6)}
+
+def _store_version() -> str:
+    """Versione di store.json: mtime + dimensione (cambia a ogni save_db, anche da altri processi)."""
+    try:
+        st = DATA.stat()
+    except FileNotFoundError:
+        return "0"
+    return f"{st.st_mtime_ns:x}.{st.st_size:x}"
+
+def _accepted_encoding() -> Optional[str]:
+    for enc in ("gzip", "deflate"):
+        if request.accept_encodings[enc]:
+            return enc
+    return None
+
+def _versioned_body(name: str, version: str, build, enc: Optional[str]) -> bytes:
+    with _RESP_LOCK:
+        entry = _RESP_CACHE.get(name)
+        if entry is not None and entry["version"] == version:
+            _RESP_CACHE.move_to_end(name)
+            RESP_CACHE_STATS["hits"] += 1
+    if entry is None or entry["version"] != version:
+        def _build():
+            RESP_CACHE_STATS["builds"] += 1
+            return {"version": version, "identity": app.json.dumps(build()).encode("utf-8")}
+        entry = _RESP_FLIGHT.do((name, version), _build)
+        with _RESP_LOCK:
+            _RESP_CACHE[name] = entry
+            _RESP_CACHE.move_to_end(name)
+            while len(_RESP_CACHE) > RESP_CACHE_MAX:
+                _RESP_CACHE.popitem(last=False)
+    key = enc or "identity"
+    if key not in entry:
+        # più thread possono comprimere la stessa versione: risultato identico, l'ultimo vince
+        entry[key] = _COMPRESS[key](entry["identity"])
+        RESP_CACHE_STATS["compressions"] += 1
+    return entry[key]
+
+def _versioned_json(name: str, version: str, build):
+    """
+    Risposta JSON in cache per (name, version): ETag forte derivato da versione e codifica,
+    304 senza costruire né serializzare il corpo, gzip/deflate negoziati con Accept-Encoding.
+    `build()` ritorna il payload (dict) ed è chiamato solo quando la versione cambia.
+    """
+    enc = _accepted_encoding()
+    etag = hashlib.sha256(f"{name}|{version}".encode("utf-8")).hexdigest()[:32] + (f"-{enc}" if enc else "")
+
+    def body():
+        headers = {"Content-Type": "application/json"}
+        if enc:
+            headers["Content-Encoding"] = enc
+        return _versioned_body(name, version, build, enc), 200, headers
+
+    resp = _conditional(etag, "no-cache", body)
+    resp.vary.add("Accept-Encoding")
+    return resp
+
 # -------------------- METRICS endpoint --------------------
 
+# replica, ammissione, keystore, retention, rotazione... cambiano senza nuove richieste:
+# la versione delle metriche scade comunque ogni METRICS_CACHE_S secondi (0 = mai in cache)
+METRICS_CACHE_S = float(os.environ.get("APS_METRICS_CACHE_S", "1"))
+
 @app.get("/api/metrics")
 @measure("/api/metrics")
+@admit("read")
 def metrics():
+    """
+    Metriche aggregate, in cache finché non arriva un'altra richiesta (le letture di /api/metrics
+    e /api/ready non cambiano la versione) e al più per METRICS_CACHE_S secondi.
+    ?byReport=0 omette le dimensioni per referto.
+    """
+    by_report = request.args.get("byReport", "1").lower() not in ("0", "false", "no")
+    bucket = int(time.time() // METRICS_CACHE_S) if METRICS_CACHE_S > 0 else time.monotonic_ns()
+    version = f"{_METRICS_GEN[0]}.{ledger_version()}.{_store_version()}.{bucket}"
+    return _versioned_json(f"metrics|{int(by_report)}", version, lambda: _metrics_payload(by_report))
+
+def _metrics_payload(by_report: bool) -> Dict[str, Any]:
     reqs = {k: _agg(v) for k, v in METRICS["requests"].items()}
     gen = _agg(METRICS["generate_latency_ms"])
     ver = _agg(METRICS["verify_latency_ms"])
@@ -735,33 +1740,100 @@ def metrics():
             "max_bytes": max(cipher_sizes),
         }
 
-    return jsonify({
+    sizes = {
+        "plaintext": {"overall": size_plain_stats},
+        "ciphertext": {"overall": size_cipher_stats},
+    }
+    if by_report:
+        sizes["plaintext"]["by_report"] = [{"reportId": k, "bytes": v} for k, v in METRICS["report_size_plain"].items()]
+        sizes["ciphertext"]["by_report"] = [{"reportId": k, "bytes": v} for k, v in METRICS["report_size_cipher"].items()]
+
+    return {
         "ok": True,
         "requests": reqs,
         "generate_latency_ms": gen,
         "verify_latency_ms": ver,
-        "report_size_bytes": {
-            "plaintext": {
-                "overall": size_plain_stats,
-                "by_report": [{"reportId": k, "bytes": v} for k, v in METRICS["report_size_plain"].items()]
-            },
-            "ciphertext": {
-                "overall": size_cipher_stats,
-                "by_report": [{"reportId": k, "bytes": v} for k, v in METRICS["report_size_cipher"].items()]
-            }
-        }
-    })
+        "replication": replica.status() if replica.ENABLED else None,
+        "coalescing": {f.name: f.stats() for f in (_OPEN_FLIGHT, _SD_FLIGHT)},
+        "keystore": keystore.stats(),
+        "lab_signatures": {**LAB_SIG_STATS, "verifiedRoots": len(_VERIFIED_ROOTS)},
+        "groups": {**GROUP_STATS, "cachedKeys": len(_GROUP_PRIV)},
+        "admission": {
+            name: {**{k: v for k, v in snap.items() if k != "wait_ms"}, "wait_ms": _agg(snap["wait_ms"])}
+            for name, snap in admission.snapshot().items()
+        },
+        "responseCache": {**RESP_CACHE_STATS, "entries": len(_RESP_CACHE)},
+        "ledgerCheckpoints": ledger_checkpoint_stats(),
+        "retention": RETENTION.stats(),
+        "keyRotation": ROTATION.stats(),
+        "workloadRecorder": workload.RECORDER.stats(),
+        "bloom": {**ledger_bloom_stats(),
+                  "usernames": _USERS_BLOOM["filter"].stats() if _USERS_BLOOM["filter"] is not None else None},
+        "report_size_bytes": sizes,
+    }
 
 # -------------------- REPORT STATE / DEBUG --------------------
 
+def _as_of_args() -> Tuple[Optional[int], Optional[str], Optional[str]]:
+    """(ts, txId, errore) da ?as_of=<unix s | ISO-8601> oppure ?as_of_tx=<txId>; (None, None, None) = presente."""
+    tx = request.args.get("as_of_tx")
+    raw = request.args.get("as_of")
+    if tx:
+        return None, tx.strip(), None
+    if not raw:
+        return None, None, None
+    try:
+        return int(raw), None, None
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    except ValueError:
+        return None, None, "as_of deve essere un timestamp unix o ISO-8601"
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp()), None, None
+
 @app.get("/api/report/state/<report_id>")
 @measure("/api/report/state")
+@admit("read", PRIO_INTERACTIVE)
 def report_state(report_id: str):
-    return jsonify({"ok": True, **state_of(report_id)})
+    """Stato corrente, oppure storico con ?as_of= / ?as_of_tx= (checkpoint + replay parziale)."""
+    ts, tx, err = _as_of_args()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+    if ts is None and tx is None:
+        return jsonify({"ok": True, **state_of(report_id)})
+    try:
+        return jsonify({"ok": True, **state_as_of(report_id, ts, tx)})
+    except KeyError:
+        return jsonify({"ok": False, "error": "txId not found"}), 404
+
+@app.get("/api/report/history/<report_id>")
+@measure("/api/report/history")
+@admit("read")
+def report_history_ep(report_id: str):
+    """Lineage completa delle versioni (dall'indice del grafo UPDATE, senza riscansione)."""
+    items = report_history(report_id)
+    return jsonify({"ok": True, "items": items, "currentReportId": items[-1]["reportId"]})
 
 @app.get("/api/report/grants/<report_id>")
 @measure("/api/report/grants")
+@admit("read")
 def report_grants(report_id: str):
+    """GRANT sul ledger; con ?as_of= / ?as_of_tx= quelli della versione corrente a quel punto (chi poteva aprire)."""
+    ts, tx, err = _as_of_args()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+    if ts is not None or tx is not None:
+        try:
+            st = grants_as_of(report_id, ts, tx)
+        except KeyError:
+            return jsonify({"ok": False, "error": "txId not found"}), 404
+        items = [{"reportId": g.get("reportId"), "from": g.get("from"), "to": g.get("to"), "ts": g.get("ts")}
+                 for g in st["grants"]]
+        return jsonify({"ok": True, "items": items, "status": st["status"],
+                        "currentReportId": st["currentReportId"], "asOf": st["asOf"]})
     items = []
     try:
         grants = lookup_grants_for_report(report_id)
@@ -778,15 +1850,136 @@ def report_grants(report_id: str):
 
 @app.get("/api/report/revoked/<report_id>")
 @measure("/api/report/revoked")
+@admit("read")
 def report_revoked(report_id: str):
-    db = load_db()
     rid = _effective_report_id(report_id)
+    if state_of(rid)["status"] == "UNKNOWN":
+        return jsonify({"ok": True, "items": [], "currentReportId": rid})
+    db = load_db()
     items = sorted(list(_revoked_for(db, rid)))
     return jsonify({"ok": True, "items": items, "currentReportId": rid})
 
+# -------------------- LISTE PER ATTORE (paziente / destinatario) --------------------
+
+def _grant_items(report_id: str) -> List[Dict[str, Any]]:
+    return [{"from": g.get("from"), "to": g.get("to"), "ts": g.get("ts")} for g in lookup_grants_for_report(report_id)]
+
+def _report_summary(db: Dict[str, Any], report_id: str) -> Optional[Dict[str, Any]]:
+    """Riepilogo di un referto: AAD, stato/versione corrente, GRANT e revoche applicative sul current."""
+    env = db["envelopes"].get(report_id)
+    if not env:
+        return None
+    st = state_of(report_id)
+    cur = st.get("currentReportId", report_id)
+    cur_env = db["envelopes"].get(cur) or {}
+    grants = _grant_items(report_id)
+    return {
+        "reportId": report_id,
+        "aad": env.get("aad"),
+        "hasSig": bool(env.get("sig_lab")),
+        "ekFor": list((env.get("ek_for") or {}).keys()),
+        "cipherLen": len(env.get("ciphertext", "")),
+        "retention": env.get("retention"),
+        "status": st.get("status"),
+        "currentReportId": cur,
+        "grants": grants,
+        "currentEkFor": list((cur_env.get("ek_for") or {}).keys()),
+        "currentGrants": grants if cur == report_id else _grant_items(cur),
+        "revoked": sorted(_revoked_for(db, cur)),
+    }
+
+@app.get("/api/patient/<patient_id>/reports")
+@measure("/api/patient/reports")
+@require_session("patient_id", ("PAT",))
+@admit("read", PRIO_INTERACTIVE)
+def patient_reports(patient_id: str):
+    """Tutti i referti del paziente (versioni incluse) in una sola risposta, dall'indice per paziente."""
+    db = load_db()
+    items = [x for x in (_report_summary(db, rid) for rid in reports_for_patient(patient_id)) if x]
+    return jsonify({"ok": True, "items": items})
+
+@app.get("/api/recipient/<recipient_id>/reports")
+@measure("/api/recipient/reports")
+@require_session("recipient_id", ("HOSP", "DOC"))
+@admit("read", PRIO_INTERACTIVE)
+def recipient_reports(recipient_id: str):
+    """Referti per cui il destinatario (HOSP/DOC) ha ricevuto almeno un GRANT."""
+    rids = dict.fromkeys(reports_for_recipient(recipient_id))
+    via: Dict[str, str] = {}   # referti condivisi con un gruppo di cui il destinatario è membro
+    for gid in groups_for_member(recipient_id):
+        for rid in reports_for_recipient(gid):
+            if rid not in rids:
+                rids[rid] = None
+                via[rid] = gid
+    if not rids:
+        return jsonify({"ok": True, "items": []})
+    db = load_db()
+    items = []
+    for rid in rids:
+        x = _report_summary(db, rid)
+        if x:
+            x["revokedForRecipient"] = recipient_id in x["revoked"] or via.get(rid) in x["revoked"]
+            if rid in via:
+                x["viaGroup"] = via[rid]
+            items.append(x)
+    return jsonify({"ok": True, "items": items})
+
+# -------------------- LEDGER SHIPPING (primario → follower) --------------------
+
+@app.get("/api/ledger/segment")
+@measure("/api/ledger/segment")
+@admit("read", PRIO_BATCH)
+def ledger_segment():
+    """Righe NDJSON grezze del ledger a partire da un offset in byte (per i follower)."""
+    if not replica.TOKEN:
+        return jsonify({"ok": False, "error": "ledger shipping disabled (APS_REPLICA_TOKEN not set)"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Replica-Token", "").encode("utf-8"), replica.TOKEN.encode("utf-8")):
+        return jsonify({"ok": False, "error": "replica token required"}), 403
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        max_bytes = min(max(1, int(request.args.get("max", 1 << 20))), 8 << 20)
+        shard = int(request.args.get("shard", 0))
+    except ValueError:
+        return jsonify({"ok": False, "error": "offset/max/shard non validi"}), 400
+    if not 0 <= shard < LEDGER_SHARDS:
+        return jsonify({"ok": False, "error": "shard inesistente"}), 404
+    data, size = read_raw(offset, max_bytes, shard)
+    return (data, 200, {
+        "Content-Type": "application/x-ndjson",
+        "X-Ledger-Offset": str(offset),
+        "X-Ledger-Next": str(offset + len(data)),
+        "X-Ledger-Size": str(size),
+        "X-Ledger-Events": str(shard_stats(shard)["events"]),
+        "X-Ledger-Shards": str(LEDGER_SHARDS),
+    })
+
+@app.get("/api/ledger/tx/<tx_id>")
+@measure("/api/ledger/tx")
+@admit("read")
+def ledger_tx(tx_id: str):
+    ev = get_by_txid(tx_id)
+    if not ev:
+        return jsonify({"ok": False, "error": "txId not found"}), 404
+    return jsonify({"ok": True, "event": ev})
+
+@app.get("/api/ledger/status")
+@measure("/api/ledger/status")
+@admit("read")
+def ledger_status():
+    return jsonify({
+        "ok": True,
+        "role": "follower" if replica.ENABLED else "primary",
+        "ledger": ledger_stats(),
+        "replication": replica.status() if replica.ENABLED else None,
+    })
+
 @app.get("/api/debug/envelopes")
 @measure("/api/debug/envelopes")
+@admit("read", PRIO_BATCH)
 def debug_envelopes():
+    return _versioned_json("debug_envelopes", _store_version(), _debug_envelopes_payload)
+
+def _debug_envelopes_payload() -> Dict[str, Any]:
     db = load_db()
     out = []
     for rid, env in db.get("envelopes", {}).items():
@@ -798,13 +1991,18 @@ def debug_envelopes():
                 "hasSig": bool(env.get("sig_lab")),
                 "ekFor": ek_for,
                 "cipherLen": len(env.get("ciphertext", "")),
+                "retention": env.get("retention"),
             }
         )
-    return jsonify({"ok": True, "items": out})
+    return {"ok": True, "items": out}
 
 @app.get("/api/debug/actors")
 @measure("/api/debug/actors")
+@admit("read", PRIO_BATCH)
 def debug_actors():
+    return _versioned_json("debug_actors", _store_version(), _debug_actors_payload)
+
+def _debug_actors_payload() -> Dict[str, Any]:
     db = load_db()
     items = []
     for username, rec in db.get("actors", {}).items():
@@ -817,12 +2015,16 @@ def debug_actors():
                 "hasKeys": True,
             }
         )
-    return jsonify({"ok": True, "items": items})
+    return {"ok": True, "items": items}
 
 @app.get("/api/debug/ledgerview")
 @measure("/api/debug/ledgerview")
+@admit("read", PRIO_BATCH)
 def debug_ledgerview():
     """Snapshot ledger: per ogni report noto (anche aggiornato) mostra stato e grants correnti."""
+    return _versioned_json("debug_ledgerview", f"{_store_version()}.{ledger_version()}", _debug_ledgerview_payload)
+
+def _debug_ledgerview_payload() -> Dict[str, Any]:
     db = load_db()
     report_ids = list(db.get("envelopes", {}).keys())
     out = []
@@ -857,12 +2059,151 @@ def debug_ledgerview():
             "currentReportId": eff,
             "grants": grants,
         })
-    return jsonify({"ok": True, "items": out})
+    return {"ok": True, "items": out}
+
+@app.get("/api/debug/profile")
+@measure("/api/debug/profile")
+@require_admin
+@admit("read", PRIO_BATCH)
+def debug_profile():
+    """
+    Profilo a campionamento di tutti i thread per ?seconds=N (default 5) a ?hz= (default 100).
+    ?format=collapsed → testo per flamegraph.pl; ?all=1 include i thread che non servono una route.
+    """
+    try:
+        seconds = float(request.args.get("seconds", "5"))
+        hz = float(request.args.get("hz", "100"))
+    except ValueError:
+        return jsonify({"ok": False, "error": "seconds/hz non numerici"}), 400
+    all_threads = request.args.get("all", "0").lower() in ("1", "true", "yes")
+    try:
+        prof = profiler.sample(seconds, hz, route_of=_route_of_frame, all_threads=all_threads)
+    except profiler.Busy as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 409
+    if request.args.get("format") == "collapsed":
+        return prof["collapsed"] + "\n", 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return jsonify({"ok": True, **prof})
+
+# -------------------- REGISTRAZIONE DEL TRAFFICO (replay con workload.py) --------------------
+
+# APS_RECORD=1 registra dall'avvio (traccia in traces/), oppure APS_RECORD=<percorso del file>
+RECORD_ON_START = os.environ.get("APS_RECORD", "")
+
+def _record_on_start():
+    if RECORD_ON_START and RECORD_ON_START.lower() not in ("0", "off", "false"):
+        workload.RECORDER.start(None if RECORD_ON_START.lower() in ("1", "on", "true") else RECORD_ON_START)
+
+@app.get("/api/workload/record")
+@measure("/api/workload/record")
+@require_admin
+@admit("read")
+def workload_record_status():
+    return jsonify({"ok": True, **workload.RECORDER.stats()})
+
+@app.post("/api/workload/record")
+@measure("/api/workload/record")
+@require_admin
+@admit("read", PRIO_BATCH)
+def workload_record():
+    """{"action": "start", "file"?: percorso} avvia la registrazione in una traccia; {"action": "stop"} la chiude."""
+    b = get_json_body()
+    action = str(b.get("action", "")).strip()
+    try:
+        if action == "start":
+            path = workload.RECORDER.start(b.get("file"))
+            return jsonify({"ok": True, "file": str(path)})
+        if action == "stop":
+            return jsonify({"ok": True, **workload.RECORDER.stop()})
+    except workload.Busy as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 409
+    return jsonify({"ok": False, "error": "action deve essere start o stop"}), 400
+
+# -------------------- RETENTION (GC in background) --------------------
+
+def _retention_collected(report_id: str):
+    # le dimensioni per referto seguono gli envelope vivi: le versioni ritirate escono dalle metriche
+    METRICS["report_size_plain"].pop(report_id, None)
+    METRICS["report_size_cipher"].pop(report_id, None)
+
+# il collector cede il passo finché ci sono richieste ammesse o in coda (con APS_ADMISSION=off vale solo il duty cycle)
+RETENTION = retention.Collector(load_db, save_db, _store_version,
+                                busy=lambda: admission.in_flight() > 0, on_collected=_retention_collected,
+                                store_lock=STORE_LOCK)
+
+@app.get("/api/retention")
+@measure("/api/retention")
+@admit("read")
+def retention_status():
+    """Regole correnti e avanzamento del collector (passate, envelope ritirati, byte liberati, archivio)."""
+    try:
+        rules: Any = retention.load_rules()
+    except (ValueError, AttributeError) as exc:
+        rules = {"error": str(exc)}
+    return jsonify({"ok": True, "rules": rules, **RETENTION.stats()})
+
+@app.post("/api/retention/run")
+@measure("/api/retention/run")
+@require_admin
+@admit("read", PRIO_BATCH)
+def retention_run():
+    """{"dryRun": true} → candidati calcolati subito, senza scritture; altrimenti sveglia il collector (202)."""
+    b = get_json_body()
+    if b.get("dryRun"):
+        try:
+            plan = RETENTION.run_pass(dry_run=True)
+        except retention.Busy as exc:
+            return jsonify({"ok": False, "error": str(exc)}), 409
+        except (ValueError, AttributeError) as exc:
+            return jsonify({"ok": False, "error": f"regole non valide: {exc}"}), 400
+        return jsonify({"ok": True, **plan})
+    RETENTION.start()
+    RETENTION.wake()
+    return jsonify({"ok": True, "started": True}), 202
+
+# -------------------- ROTAZIONE CHIAVI (re-wrap in background) --------------------
+
+ROTATION = rotation.Rotator(load_db, save_db, store_lock=STORE_LOCK)
+
+@app.post("/api/keys/rotate")
+@measure("/api/keys/rotate")
+@require_session("actorId", ("PAT", "HOSP", "DOC"))
+@admit("keygen")
+def keys_rotate():
+    """
+    Nuova chiave RSA per un paziente o un destinatario (registrata presso la CA) e job di re-wrap
+    in background. Le letture funzionano con entrambe le chiavi finché il job non ha finito.
+    """
+    b = get_json_body()
+    ok, msg = require_fields(b, ("actorId",))
+    if not ok:
+        return jsonify({"ok": False, "error": msg}), 400
+    actor = str(b["actorId"]).strip()
+    if not keystore.has(actor):
+        return jsonify({"ok": False, "error": "unknown actor key"}), 404
+    if actor.split("-", 1)[0] not in ("PAT", "HOSP", "DOC"):
+        return jsonify({"ok": False, "error": "rotation supported for PAT/HOSP/DOC keys only"}), 400
+    try:
+        job = ROTATION.start(actor)
+    except rotation.Busy as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 409
+    return jsonify({"ok": True, "rotation": job}), 202
+
+@app.get("/api/keys/rotation/<actor_id>")
+@measure("/api/keys/rotation")
+@admit("read")
+def keys_rotation(actor_id: str):
+    """Avanzamento del job di re-wrap: cursore, referti reincapsulati, GRANT sostituiti/rifirmati, errori, ETA."""
+    job = ROTATION.progress(actor_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "no rotation for actor"}), 404
+    return jsonify({"ok": True, "rotation": job, "generations": keystore.generations(actor_id)})
 
 # -------------------- DEV SEED (demo utenti + 3 referti) --------------------
 
 @app.post("/api/dev/seed")
 @measure("/api/dev/seed")
+@admit("keygen", PRIO_BATCH)
+@store_write
 def dev_seed():
     """
     Crea utenti demo (pat1/lab1/hosp1/doc1) + 3 referti DEMO-R-0001..3.
@@ -878,6 +2219,7 @@ def dev_seed():
             return uid
         uid = _rand_uid(role)
         ensure_actor_keys(uid)
+        _users_bloom_add(username)
         db["actors"][username] = {
             "uid": uid,
             "role": role,
@@ -913,19 +2255,21 @@ def dev_seed():
             "note": note,
         }
 
-        lab_priv = load_private_pem(str(_key_paths(lab_uid)[0]))
-        pat_pub = load_public_pem(str(_key_paths(pat_uid)[1]))
+        lab_priv = keystore.private_key(lab_uid)
+        pat_pub = keystore.public_key(pat_uid)
 
         t0 = time.perf_counter()
+        aes_key = AESGCM.generate_key(bit_length=256)
         env = encrypt_for_recipients(
             plaintext=content.encode("utf-8"),
             aad=aad,
             recipients={pat_uid: pat_pub},
+            aes_key=aes_key,
         )
         ct_bytes = b64d(env["ciphertext"])
-        h_ct = sha256_bytes(ct_bytes)
-        tosig = h_ct + dumps(env["aad"]).encode("utf-8")
-        env["sig_lab"] = sign_bytes(lab_priv, tosig)
+        env["sig_lab"] = sign_bytes(lab_priv, _lab_message(env))
+        sd = _seal_sd(env, dict(aad), aes_key)
+        sd["sig"] = sign_bytes(lab_priv, sd_message(sd["root"]))
         gen_ms = (time.perf_counter() - t0) * 1000.0
         METRICS["generate_latency_ms"].append(gen_ms)
         METRICS["report_size_plain"][report_id] = len(content.encode("utf-8"))
@@ -941,13 +2285,14 @@ def dev_seed():
             hash_referto=sha256_bytes(ct_bytes).hex(),
             sig_lab=env["sig_lab"],
             issuedAt=issued_at,
+            sd_root=sd["root"],
         )
 
         # Condivisioni demo (via GRANT)
-        pat_priv = load_private_pem(str(_key_paths(pat_uid)[0]))
+        pat_priv = keystore.private_key(pat_uid)
 
         if share_with_hosp:
-            hosp_pub = load_public_pem(str(_key_paths(hosp_uid)[1]))
+            hosp_pub = keystore.public_key(hosp_uid)
             wrap_pat = (env.get("ek_for") or {}).get(pat_uid)
             aes_key = _unwrap_key(pat_priv, wrap_pat)
             ek_h_b64 = _wrap_key(hosp_pub, aes_key)
@@ -956,7 +2301,7 @@ def dev_seed():
             grant_access(report_id, pat_uid, hosp_uid, ek_h_b64, sig_pat)
 
         if share_with_doc:
-            doc_pub = load_public_pem(str(_key_paths(doc_uid)[1]))
+            doc_pub = keystore.public_key(doc_uid)
             wrap_pat = (env.get("ek_for") or {}).get(pat_uid)
             aes_key = _unwrap_key(pat_priv, wrap_pat)
             ek_d_b64 = _wrap_key(doc_pub, aes_key)
@@ -1000,11 +2345,97 @@ def dev_seed():
         "seeded": seeded
     })
 
+# -------------------- DEV SYNTH (dataset sintetici, vedi synth.py) --------------------
+
+SYNTH_MAX_REPORTS = int(os.environ.get("APS_SYNTH_MAX_REPORTS", "5000"))
+_SYNTH_LOCK = threading.Lock()
+
+@app.post("/api/dev/synth")
+@measure("/api/dev/synth")
+@require_admin
+@admit("keygen", PRIO_BATCH)
+def dev_synth():
+    """
+    Genera un dataset sintetico (parametri di synth.DEFAULTS in camelCase, es. {"labs": 2, "reportsPerLab": 100}).
+    Pensato per un server di sviluppo a riposo; i dataset grandi si generano dalla CLI a server fermo.
+    Scrive store e ledger senza sessione: serve l'header X-Admin-Token (APS_ADMIN_TOKEN).
+    """
+    b = get_json_body()
+    try:
+        p = synth.params(b)
+    except synth.SynthError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    if p["labs"] * p["reportsPerLab"] > SYNTH_MAX_REPORTS:
+        return jsonify({"ok": False, "error": f"al massimo {SYNTH_MAX_REPORTS} referti (usare python synth.py)"}), 400
+    if not _SYNTH_LOCK.acquire(blocking=False):
+        return jsonify({"ok": False, "error": "synth already running"}), 409
+
+    try:
+        summary = synth.generate(b, load_db, save_db, store_lock=STORE_LOCK)   # ricarica e salva sotto il lock
+    except synth.SynthError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 409
+    finally:
+        _SYNTH_LOCK.release()
+    return jsonify({"ok": True, **summary})
+
 # -------------------- MAIN --------------------
 
+# -------------------- AVVIO RAPIDO / READINESS --------------------
+
+# APS_FAST_START=1: il server risponde subito; indici e keystore si scaldano in background,
+# le chiavi demo sono generate al primo uso (la keygen RSA tiene il GIL: non va fatta al boot)
+FAST_START = os.environ.get("APS_FAST_START", "off").lower() in ("1", "on", "true")
+DEMO_ACTORS = ("LAB-01", "PAT-123", "HOSP-01", "DOC-01")
+_BOOT_T0 = time.perf_counter()
+READINESS: Dict[str, Any] = {"ready": False, "fastStart": FAST_START, "phases": {}, "error": None}
+
+def _warm(name: str, fn):
+    READINESS["phases"][name] = None   # in corso
+    t0 = time.perf_counter()
+    fn()
+    READINESS["phases"][name] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+def warm_up(demo_keys: bool = True):
+    """Indici del ledger, indice del keystore, store ed eventualmente chiavi demo. Le richieste che arrivano
+    prima non aspettano il warm-up: usano gli stessi percorsi lazy (keygen per attore in single-flight)."""
+    try:
+        _warm("ledgerSegments", seal_ledger_segments)   # rotazione interrotta da un crash
+        _warm("ledgerIndex", rebuild_indexes if LEDGER_SHARDS > 1 else ledger_stats)
+        _warm("keystore", keystore.store)
+        _warm("store", load_db)
+        if demo_keys:
+            _warm("demoKeys", lambda: [ensure_actor_keys(a) for a in DEMO_ACTORS])
+    except Exception as exc:
+        READINESS["error"] = f"{type(exc).__name__}: {exc}"
+        return
+    READINESS["readyAfterMs"] = round((time.perf_counter() - _BOOT_T0) * 1000.0, 1)
+    READINESS["ready"] = True
+
+@app.get("/api/ready")
+@measure("/api/ready")
+def ready():
+    """Readiness: 200 quando cache e indici sono caldi, altrimenti 503 con lo stato delle fasi."""
+    body = {"ok": READINESS["ready"], **READINESS, "uptimeMs": round((time.perf_counter() - _BOOT_T0) * 1000.0, 1)}
+    return jsonify(body), 200 if READINESS["ready"] else 503
+
 if __name__ == "__main__":
-    ensure_actor_keys("LAB-01")
-    ensure_actor_keys("PAT-123")
-    ensure_actor_keys("HOSP-01")
-    ensure_actor_keys("DOC-01")
-    app.run(host="127.0.0.1", port=8000, debug=True)
+    if replica.ENABLED:
+        # follower: nessuna chiave demo, replica in background e niente reloader (un solo thread di replica)
+        seal_ledger_segments()
+        replica.start()
+        READINESS["ready"] = True
+        app.run(host="127.0.0.1", port=int(os.environ.get("APS_PORT", "8001")), debug=True, use_reloader=False)
+    elif FAST_START:
+        # un solo processo (niente reloader) e warm-up in background: prima risposta in pochi ms
+        threading.Thread(target=warm_up, args=(False,), name="aps-warmup", daemon=True).start()
+        RETENTION.start()
+        ROTATION.ensure_running()   # riprende i job interrotti da un riavvio
+        _record_on_start()
+        app.run(host="127.0.0.1", port=int(os.environ.get("APS_PORT", "8000")), debug=True, use_reloader=False)
+    else:
+        warm_up()   # avvio classico: indici (in parallelo se shard) e chiavi demo prima di servire
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            RETENTION.start()   # solo nel processo servito dal reloader, non nel supervisore
+            ROTATION.ensure_running()
+            _record_on_start()
+        app.run(host="127.0.0.1", port=int(os.environ.get("APS_PORT", "8000")), debug=True)
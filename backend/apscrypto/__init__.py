@@ -4,10 +4,17 @@ from .keys import (
     save_public_pem,
     load_private_pem,
     load_public_pem,
+    private_der,
+    public_der,
+    load_private_der,
+    load_public_der,
 )
 from .digest import sha256_bytes
 from .sign import sign_bytes, verify_signature
 from .hybrid import encrypt_for_recipients, decrypt_envelope
+from .groups import gen_group_key, group_wrap, group_unwrap, chain_wrap, chain_unwrap
+from .sd import commit_fields, verify_disclosure, sd_message
+from .merkle import leaf_hash, merkle_tree, merkle_root, merkle_path, merkle_verify, root_message
 
 __all__ = [
     "gen_rsa_keypair",
@@ -15,9 +22,27 @@ __all__ = [
     "save_public_pem",
     "load_private_pem",
     "load_public_pem",
+    "private_der",
+    "public_der",
+    "load_private_der",
+    "load_public_der",
     "sha256_bytes",
     "sign_bytes",
     "verify_signature",
     "encrypt_for_recipients",
     "decrypt_envelope",
+    "gen_group_key",
+    "group_wrap",
+    "group_unwrap",
+    "chain_wrap",
+    "chain_unwrap",
+    "leaf_hash",
+    "merkle_tree",
+    "merkle_root",
+    "merkle_path",
+    "merkle_verify",
+    "root_message",
+    "commit_fields",
+    "verify_disclosure",
+    "sd_message",
 ]
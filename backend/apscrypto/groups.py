@@ -0,0 +1,57 @@
+"""Chiavi di gruppo di destinatari: una coppia X25519 per gruppo ed epoca.
+
+La privata (32 byte) è incapsulata RSA-OAEP una volta per membro; chi condivide cifra la chiave
+del referto verso la pubblica del gruppo (X25519 effimera + HKDF-SHA256 + AES-256-GCM), una sola volta.
+Ogni nuova epoca incapsula la privata dell'epoca precedente (regressione di chiave): con la chiave
+corrente si aprono anche le condivisioni fatte con le epoche passate.
+"""
+import os
+from typing import Tuple
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from .utils import b64e, b64d
+
+def gen_group_key() -> Tuple[bytes, bytes]:
+    """(privata, pubblica) X25519 grezze, 32 byte ciascuna."""
+    priv = X25519PrivateKey.generate()
+    return priv.private_bytes_raw(), priv.public_key().public_bytes_raw()
+
+def _kdf(secret: bytes, info: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(secret)
+
+def group_wrap(group_pub: bytes, key: bytes, context: str) -> str:
+    """Cifra `key` verso la pubblica del gruppo; `context` (es. reportId|groupId|epoca) è legato come AAD."""
+    eph = X25519PrivateKey.generate()
+    eph_pub = eph.public_key().public_bytes_raw()
+    shared = eph.exchange(X25519PublicKey.from_public_bytes(group_pub))
+    k = _kdf(shared + eph_pub, b"APS-GROUP-WRAP-v1|" + context.encode("utf-8"))
+    nonce = os.urandom(12)
+    return b64e(eph_pub + nonce + AESGCM(k).encrypt(nonce, key, context.encode("utf-8")))
+
+def group_unwrap(group_priv: bytes, b64wrapped: str, context: str) -> bytes:
+    raw = b64d(b64wrapped)
+    eph_pub, nonce, ct = raw[:32], raw[32:44], raw[44:]
+    shared = X25519PrivateKey.from_private_bytes(group_priv).exchange(X25519PublicKey.from_public_bytes(eph_pub))
+    k = _kdf(shared + eph_pub, b"APS-GROUP-WRAP-v1|" + context.encode("utf-8"))
+    return AESGCM(k).decrypt(nonce, ct, context.encode("utf-8"))
+
+def chain_wrap(new_priv: bytes, old_priv: bytes, context: str) -> str:
+    """Privata dell'epoca precedente cifrata sotto quella nuova."""
+    nonce = os.urandom(12)
+    k = _kdf(new_priv, b"APS-GROUP-CHAIN-v1|" + context.encode("utf-8"))
+    return b64e(nonce + AESGCM(k).encrypt(nonce, old_priv, context.encode("utf-8")))
+
+def chain_unwrap(new_priv: bytes, b64wrapped: str, context: str) -> bytes:
+    raw = b64d(b64wrapped)
+    k = _kdf(new_priv, b"APS-GROUP-CHAIN-v1|" + context.encode("utf-8"))
+    return AESGCM(k).decrypt(raw[:12], raw[12:], context.encode("utf-8"))
+
+__all__ = [
+    "gen_group_key",
+    "group_wrap",
+    "group_unwrap",
+    "chain_wrap",
+    "chain_unwrap",
+]
@@ -1,5 +1,5 @@
 import os
-from typing import Dict
+from typing import Dict, Optional
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
@@ -27,8 +27,9 @@ def _unwrap_key(priv, b64wrapped: str) -> bytes:
         ),
     )
 
-def encrypt_for_recipients(plaintext: bytes, aad: Dict[str, str], recipients: Dict[str, object]) -> Dict:
-    aes_key = AESGCM.generate_key(bit_length=256)
+def encrypt_for_recipients(plaintext: bytes, aad: Dict[str, str], recipients: Dict[str, object],
+                           aes_key: Optional[bytes] = None) -> Dict:
+    aes_key = aes_key or AESGCM.generate_key(bit_length=256)
     aesgcm = AESGCM(aes_key)
     nonce = os.urandom(12)
     aad_bytes = dumps(aad).encode("utf-8")
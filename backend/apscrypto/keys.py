@@ -35,10 +35,33 @@ def load_public_pem(path: str):
         data = f.read()
     return serialization.load_pem_public_key(data)
 
+def private_der(priv) -> bytes:
+    return priv.private_bytes(
+        serialization.Encoding.DER,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+def public_der(pub) -> bytes:
+    return pub.public_bytes(
+        serialization.Encoding.DER,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+
+def load_private_der(data: bytes):
+    return serialization.load_der_private_key(data, password=None)
+
+def load_public_der(data: bytes):
+    return serialization.load_der_public_key(data)
+
 __all__ = [
     "gen_rsa_keypair",
     "save_private_pem",
     "save_public_pem",
     "load_private_pem",
     "load_public_pem",
+    "private_der",
+    "public_der",
+    "load_private_der",
+    "load_public_der",
 ]
@@ -0,0 +1,62 @@
+import hashlib
+from typing import List, Sequence
+
+# Prefissi distinti per foglie e nodi interni (evita collisioni foglia/nodo)
+_LEAF, _NODE = b"\x00", b"\x01"
+ROOT_DOMAIN = b"APS-MERKLE-ROOT-v1|"
+
+def leaf_hash(data: bytes) -> bytes:
+    return hashlib.sha256(_LEAF + data).digest()
+
+def _node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(_NODE + left + right).digest()
+
+def merkle_tree(leaves: Sequence[bytes]) -> List[List[bytes]]:
+    """Livelli dell'albero dalle foglie (già hashate) alla radice; un nodo dispari sale invariato."""
+    if not leaves:
+        raise ValueError("albero di Merkle vuoto")
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        cur = levels[-1]
+        nxt = [_node(cur[i], cur[i + 1]) for i in range(0, len(cur) - 1, 2)]
+        if len(cur) % 2:
+            nxt.append(cur[-1])
+        levels.append(nxt)
+    return levels
+
+def merkle_root(levels: List[List[bytes]]) -> bytes:
+    return levels[-1][0]
+
+def merkle_path(levels: List[List[bytes]], index: int) -> List[List[str]]:
+    """Prova di inclusione: [["L"|"R", fratello hex], ...] dalla foglia verso la radice."""
+    path = []
+    for level in levels[:-1]:
+        sib = index ^ 1
+        if sib < len(level):
+            path.append(["L" if sib < index else "R", level[sib].hex()])
+        index //= 2
+    return path
+
+def merkle_verify(leaf: bytes, path: Sequence[Sequence[str]], root_hex: str) -> bool:
+    """O(log n) hash: ricostruisce la radice dalla foglia e dalla prova."""
+    h = leaf
+    try:
+        for side, sib_hex in path:
+            sib = bytes.fromhex(sib_hex)
+            h = _node(sib, h) if side == "L" else _node(h, sib)
+    except (TypeError, ValueError):
+        return False
+    return h.hex() == str(root_hex).lower()
+
+def root_message(root_hex: str) -> bytes:
+    """Messaggio firmato per una radice di batch (separazione di dominio dalle firme per referto)."""
+    return ROOT_DOMAIN + bytes.fromhex(root_hex)
+
+__all__ = [
+    "leaf_hash",
+    "merkle_tree",
+    "merkle_root",
+    "merkle_path",
+    "merkle_verify",
+    "root_message",
+]
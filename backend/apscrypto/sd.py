@@ -0,0 +1,44 @@
+"""Divulgazione selettiva: impegno salato per campo, impegni come foglie di un albero di Merkle.
+
+Il LAB firma solo la radice; chi possiede le aperture (valore + sale + prova) di alcuni campi
+li rivela senza rivelare gli altri. La verifica costa O(k log n) hash più la firma della radice.
+"""
+import os
+from typing import Any, Dict, Tuple
+from .merkle import leaf_hash, merkle_path, merkle_root, merkle_tree, merkle_verify
+from .utils import b64e, b64d, dumps
+
+SD_DOMAIN = b"APS-SD-ROOT-v1|"
+
+def _commitment(name: str, value: Any, salt: bytes) -> bytes:
+    return leaf_hash(salt + dumps([name, value]).encode("utf-8"))
+
+def commit_fields(fields: Dict[str, Any]) -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    """(radice hex, aperture {campo: {"value", "salt", "path"}}); foglie in ordine di nome."""
+    names = sorted(fields)
+    salts = {n: os.urandom(16) for n in names}
+    levels = merkle_tree([_commitment(n, fields[n], salts[n]) for n in names])
+    openings = {
+        n: {"value": fields[n], "salt": b64e(salts[n]), "path": merkle_path(levels, i)}
+        for i, n in enumerate(names)
+    }
+    return merkle_root(levels).hex(), openings
+
+def verify_disclosure(root_hex: str, disclosed: Dict[str, Dict[str, Any]]) -> bool:
+    """Ogni campo rivelato deve ricondurre alla radice: un impegno + |path| hash per campo."""
+    if not disclosed:
+        return False
+    for name, op in disclosed.items():
+        try:
+            leaf = _commitment(name, op["value"], b64d(op["salt"]))
+        except (KeyError, TypeError, ValueError):
+            return False
+        if not merkle_verify(leaf, op.get("path") or [], root_hex):
+            return False
+    return True
+
+def sd_message(root_hex: str) -> bytes:
+    """Messaggio firmato (o foglia di batch) per la radice degli impegni di un referto."""
+    return SD_DOMAIN + bytes.fromhex(root_hex)
+
+__all__ = ["commit_fields", "verify_disclosure", "sd_message"]
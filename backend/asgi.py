@@ -0,0 +1,402 @@
+# backend/asgi.py
+"""Modalità asincrona dell'API: applicazione ASGI 3 + server HTTP/1.1 su asyncio (solo stdlib).
+
+Avvio (dalla cartella backend):
+    python asgi.py                         # server integrato su 127.0.0.1:8000 (APS_PORT)
+    uvicorn asgi:app --port 8000           # oppure un server ASGI qualsiasi, se installato
+
+Il server sincrono (app.run, threaded) dedica un thread a ogni connessione per tutta la richiesta, anche
+mentre aspetta una firma RSA o il parse di store.json. Qui ogni connessione è una coroutine e i thread sono
+solo quelli di tre pool limitati:
+
+- CRYPTO (APS_ASYNC_CRYPTO_WORKERS, default CPU): verifica delle firme, unwrap RSA e AES-GCM di /hosp/open.
+  Le primitive di pyca/cryptography girano in codice nativo, quindi i thread lavorano in parallelo;
+- IO (APS_ASYNC_IO_WORKERS, default 8): stato dal ledger, store.json e CRL;
+- WSGI (APS_ASYNC_WSGI_WORKERS, default 16): tutte le altre route, servite dall'app Flask così com'è
+  (stessi decoratori: metriche, registrazione, sessioni, ammissione).
+
+/api/hosp/open è nativo: lookup nel pool IO (store.json letto da uno snapshot in sola lettura, riletto solo
+quando cambia la versione del file), pipeline crittografica nel pool CRYPTO, richieste identiche coalescenti.
+Al posto della classe di ammissione `decrypt`, che bloccherebbe il loop, oltre APS_ASYNC_MAX_PENDING
+aperture in corso risponde 429 con Retry-After. Contatori dei pool: GET /api/async.
+"""
+import argparse, asyncio, http, io, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from urllib.parse import unquote
+
+from werkzeug.wrappers import Request
+
+import app as aps
+import workload
+
+CRYPTO_WORKERS = int(os.environ.get("APS_ASYNC_CRYPTO_WORKERS", str(os.cpu_count() or 1)))
+IO_WORKERS = int(os.environ.get("APS_ASYNC_IO_WORKERS", "8"))
+WSGI_WORKERS = int(os.environ.get("APS_ASYNC_WSGI_WORKERS", "16"))
+MAX_PENDING = int(os.environ.get("APS_ASYNC_MAX_PENDING", "4096"))
+MAX_BODY = int(os.environ.get("APS_ASYNC_MAX_BODY", str(64 << 20)))
+HEADER_LIMIT = 64 << 10
+KEEPALIVE_S = 75.0
+
+Response = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+
+class Pool:
+    """Executor a thread limitato: il lavoro oltre `workers` aspetta in coda senza occupare thread."""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.ex = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"aps-{name}")
+        # contatori aggiornati solo dal thread del loop
+        self.submitted = 0
+        self.completed = 0
+        self.max_pending = 0
+        self.busy_ms = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        self.submitted += 1
+        self.max_pending = max(self.max_pending, self.submitted - self.completed)
+        try:
+            result, ms = await asyncio.get_running_loop().run_in_executor(self.ex, _timed, fn, args)
+        finally:
+            self.completed += 1
+        self.busy_ms += ms
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"workers": self.workers, "pending": self.submitted - self.completed, "maxPending": self.max_pending,
+                "completed": self.completed, "busyMs": round(self.busy_ms, 1)}
+
+def _timed(fn: Callable[..., Any], args: Tuple[Any, ...]) -> Tuple[Any, float]:
+    t0 = time.perf_counter()
+    return fn(*args), (time.perf_counter() - t0) * 1000.0
+
+class AsyncFlight:
+    """Single-flight per coroutine (come singleflight.SingleFlight, senza bloccare thread in attesa)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._calls.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        fut = self._calls[key] = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())   # nessun "exception never retrieved"
+        self.executed += 1
+        try:
+            result = await fn()
+            fut.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as exc:
+            fut.set_exception(exc)
+            raise
+        finally:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"executed": self.executed, "coalesced": self.coalesced, "inFlight": len(self._calls)}
+
+CRYPTO = Pool("crypto", CRYPTO_WORKERS)
+IO = Pool("io", IO_WORKERS)
+WSGI = Pool("wsgi", WSGI_WORKERS)
+OPEN_FLIGHT = AsyncFlight("hosp_open")
+STATS = {"connections": 0, "maxConnections": 0, "requests": 0, "openPending": 0, "openRejected": 0}
+
+# -------------------- store.json in sola lettura --------------------
+
+_SNAPSHOT: Dict[str, Any] = {"version": None, "db": None}
+_SNAPSHOT_LOCK = threading.Lock()
+
+def read_db() -> Dict[str, Any]:
+    """Snapshot condiviso di store.json (da NON modificare), riletto solo quando cambia mtime/dimensione."""
+    ver = aps._store_version()
+    if _SNAPSHOT["version"] != ver:
+        with _SNAPSHOT_LOCK:
+            if _SNAPSHOT["version"] != ver:
+                _SNAPSHOT.update(db=aps.load_db(), version=ver)
+    return _SNAPSHOT["db"]
+
+# -------------------- ASGI → WSGI / Request --------------------
+
+def _environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    server = scope.get("server") or ("127.0.0.1", 80)
+    client = scope.get("client") or ("127.0.0.1", 0)
+    raw_path = scope.get("raw_path") or scope["path"].encode("utf-8")
+    env = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": unquote(raw_path.decode("latin-1"), encoding="latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": str(client[0]),
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", ()):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            env["CONTENT_TYPE"] = value
+        elif key != "CONTENT_LENGTH":
+            key = "HTTP_" + key
+            env[key] = f"{env[key]},{value}" if key in env else value
+    return env
+
+def _call_wsgi(environ: Dict[str, Any]) -> Response:
+    """Esegue l'app Flask fino all'ultimo byte (nel pool WSGI)."""
+    started: Dict[str, Any] = {}
+
+    def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+        started["status"], started["headers"] = int(status.split(" ", 1)[0]), headers
+        return lambda data: None
+
+    result = aps.app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in started["headers"]
+               if k.lower() != "content-length"]
+    return started["status"], headers + [(b"content-length", str(len(body)).encode("ascii"))], body
+
+def _json_response(req: Request, body: Dict[str, Any], status: int, extra: Optional[Dict[str, str]] = None) -> Response:
+    data = (aps.app.json.dumps(body, separators=(",", ":")) + "\n").encode("utf-8")
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode("ascii"))]
+    if req.headers.get("Origin"):
+        headers.append((b"access-control-allow-origin", b"*"))   # come flask_cors con origins "*"
+    for k, v in (extra or {}).items():
+        headers.append((k.lower().encode("latin-1"), v.encode("latin-1")))
+    return status, headers, data
+
+# -------------------- route native --------------------
+
+async def hosp_open(req: Request) -> Response:
+    b = req.get_json(silent=True) if req.is_json else None
+    if not isinstance(b, dict):
+        b = dict(req.form) if req.form else {}
+    auth = req.headers.get("Authorization", "")
+    token = auth[7:].strip() if auth.lower().startswith("bearer ") else ""
+    err = aps.session_error(token, ("HOSP", "DOC"), b.get("hospitalId"), check_actor=True)
+    if err is not None:
+        return _json_response(req, *err)
+    if STATS["openPending"] >= MAX_PENDING:
+        STATS["openRejected"] += 1
+        return _json_response(req, {"ok": False, "error": "server busy: queue full"}, 429, {"Retry-After": "1"})
+    STATS["openPending"] += 1
+    try:
+        found, err = await IO.run(aps.open_lookup, b, read_db)
+        if err is not None:
+            return _json_response(req, *err)
+        env, rid_effective, hid, status = found
+        out, code = await OPEN_FLIGHT.do((rid_effective, hid),
+                                         lambda: CRYPTO.run(aps._open_verified, env, rid_effective, hid))
+    finally:
+        STATS["openPending"] -= 1
+    if code != 200:
+        return _json_response(req, out, code)
+    return _json_response(req, {**out, "state": status}, 200)
+
+async def async_stats(req: Request) -> Response:
+    return _json_response(req, {"ok": True, **STATS, "pools": {p.name: p.stats() for p in (CRYPTO, IO, WSGI)},
+                                "coalescing": OPEN_FLIGHT.stats(), "maxPending": MAX_PENDING}, 200)
+
+# (metodo, path) → (handler, chiave di misura); tutto il resto passa dall'app Flask
+NATIVE: Dict[Tuple[str, str], Tuple[Callable[[Request], Awaitable[Response]], str]] = {
+    ("POST", "/api/hosp/open"): (hosp_open, "/api/hosp/open"),
+    ("GET", "/api/async"): (async_stats, "/api/async"),
+}
+
+async def _native(handler: Callable[[Request], Awaitable[Response]], route: str, environ: Dict[str, Any]) -> Response:
+    """Equivalente di measure per le route native: latenza nelle metriche e, se attiva, registrazione."""
+    req = Request(environ)
+    t0 = time.perf_counter()
+    rv: Optional[Response] = None
+    try:
+        rv = await handler(req)
+        return rv
+    finally:
+        dt = (time.perf_counter() - t0) * 1000.0
+        aps._record_request_latency(route, dt)
+        if workload.RECORDER.active:
+            workload.RECORDER.record(route, req, (rv[2], rv[0]) if rv else None, t0, dt)
+
+# -------------------- applicazione ASGI --------------------
+
+async def startup():
+    # come APS_FAST_START: si risponde subito, indici e keystore si scaldano in background
+    threading.Thread(target=aps.warm_up, args=(False,), name="aps-warmup", daemon=True).start()
+    aps.RETENTION.start()
+    aps.ROTATION.ensure_running()
+    aps._record_on_start()
+
+async def shutdown():
+    if workload.RECORDER.active:
+        await IO.run(workload.RECORDER.stop)
+    for pool in (CRYPTO, IO, WSGI):
+        pool.ex.shutdown(wait=False, cancel_futures=True)
+
+async def app(scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]],
+              send: Callable[[Dict[str, Any]], Awaitable[None]]):
+    if scope["type"] == "lifespan":
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    chunks = []
+    size = 0
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            return
+        chunks.append(msg.get("body", b""))
+        size += len(chunks[-1])
+        if size > MAX_BODY:
+            await send({"type": "http.response.start", "status": 413, "headers": [(b"content-length", b"0")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if not msg.get("more_body"):
+            break
+    environ = _environ(scope, b"".join(chunks))
+    STATS["requests"] += 1
+    native = NATIVE.get((scope["method"], scope["path"]))
+    if native is not None:
+        status, headers, body = await _native(native[0], native[1], environ)
+    else:
+        status, headers, body = await WSGI.run(_call_wsgi, environ)
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+# -------------------- server HTTP/1.1 integrato --------------------
+
+def _head(status: int, headers: List[Tuple[bytes, bytes]], keep_alive: bool) -> bytes:
+    try:
+        reason = http.HTTPStatus(status).phrase
+    except ValueError:
+        reason = ""
+    lines = [f"HTTP/1.1 {status} {reason}".encode("latin-1")]
+    lines += [k + b": " + v for k, v in headers if k != b"connection"]
+    lines.append(b"connection: keep-alive" if keep_alive else b"connection: close")
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+async def _connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    STATS["connections"] += 1
+    STATS["maxConnections"] = max(STATS["maxConnections"], STATS["connections"])
+    peer = writer.get_extra_info("peername")
+    sock = writer.get_extra_info("sockname")
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_S)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            lines = head[:-4].decode("latin-1").split("\r\n")
+            parts = lines[0].split(" ")
+            if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+                writer.write(_head(400, [(b"content-length", b"0")], False))
+                return
+            method, target, version = parts
+            headers = []
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers.append((name.strip().lower().encode("latin-1"), value.strip().encode("latin-1")))
+            h = dict(headers)
+            if b"chunked" in h.get(b"transfer-encoding", b"").lower():
+                writer.write(_head(411, [(b"content-length", b"0")], False))   # solo Content-Length
+                return
+            # Content-Length: solo cifre ASCII (niente segno, spazi o esadecimale) e valori ripetuti tutti uguali
+            lengths = {v for k, v in headers if k == b"content-length"}
+            if len(lengths) > 1 or (lengths and not next(iter(lengths)).isdigit()):
+                writer.write(_head(400, [(b"content-length", b"0")], False))
+                return
+            length = int(lengths.pop()) if lengths else 0
+            if length > MAX_BODY:
+                writer.write(_head(413, [(b"content-length", b"0")], False))
+                return
+            body = await reader.readexactly(length) if length else b""
+            conn = h.get(b"connection", b"").lower()
+            keep_alive = conn != b"close" if version == "HTTP/1.1" else conn == b"keep-alive"
+            path, _, query = target.partition("?")
+            scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": version[5:], "method": method,
+                     "scheme": "http", "path": unquote(path), "raw_path": path.encode("latin-1"),
+                     "query_string": query.encode("latin-1"), "root_path": "", "headers": headers,
+                     "client": peer[:2] if peer else None, "server": sock[:2] if sock else None}
+            response: Dict[str, Any] = {"status": 500, "headers": [], "body": []}
+
+            async def receive() -> Dict[str, Any]:
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            async def send(msg: Dict[str, Any]):
+                if msg["type"] == "http.response.start":
+                    response["status"], response["headers"] = msg["status"], list(msg.get("headers", ()))
+                elif msg["type"] == "http.response.body":
+                    response["body"].append(msg.get("body", b""))
+
+            try:
+                await app(scope, receive, send)
+            except Exception as exc:
+                print(f"[asgi] {method} {path}: {type(exc).__name__}: {exc}", file=sys.stderr)
+                response = {"status": 500, "headers": [], "body": [b"internal error"]}
+            payload = b"".join(response["body"])
+            out_headers = [(k, v) for k, v in response["headers"] if k != b"content-length"]
+            out_headers.append((b"content-length", str(len(payload)).encode("ascii")))
+            writer.write(_head(response["status"], out_headers, keep_alive) + (b"" if method == "HEAD" else payload))
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):   # client chiuso a metà richiesta o corpo troncato
+        pass
+    finally:
+        STATS["connections"] -= 1
+        writer.close()
+
+async def serve(host: str, port: int, ready: Optional[Callable[[], None]] = None):
+    await startup()
+    server = await asyncio.start_server(_connection, host, port, limit=HEADER_LIMIT, backlog=1024)
+    if ready is not None:
+        ready()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await shutdown()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Server asincrono dell'API APS (ASGI su asyncio)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=int(os.environ.get("APS_PORT", "8000")))
+    args = ap.parse_args(argv)
+    print(f"[asgi] http://{args.host}:{args.port}  crypto={CRYPTO.workers} io={IO.workers} wsgi={WSGI.workers}",
+          file=sys.stderr)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
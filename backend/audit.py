@@ -0,0 +1,303 @@
+# backend/audit.py
+"""Audit offline del ledger: txId, hash e firme rispetto agli envelope salvati.
+
+Uso (dalla cartella backend, anche a server fermo):
+    python audit.py                          # audit completo, report JSON su stdout
+    python audit.py --resume                 # riparte dal checkpoint: solo eventi nuovi (audit notturni)
+    python audit.py --workers 8 --out audit_report.json
+
+Legge i segmenti di ogni shard a blocchi; i controlli economici (txId, hash del ciphertext, AAD,
+prove di inclusione) girano nel processo principale, le verifiche RSA-PSS sono distribuite
+a lotti su un pool di processi. Le firme di radice dei batch sono verificate una sola volta.
+Controlli:
+  * ogni evento: txId = SHA256(evento canonico senza txId)
+  * PUBLISH_REPORT: envelope presente, hash = H(ciphertext), AAD coerente, sig_lab (singola o batch), sdRoot
+    (per gli envelope ritirati dalla retention l'envelope completo è riletto dall'archivio)
+  * GRANT: sig_pat del paziente (con epoca per i GRANT verso gruppi)
+  * GROUP_KEY: sig_owner dell'owner
+Avanzamento e throughput su stderr; exit code 1 se ci sono findings.
+Ledger, keystore e store.json sono aperti in sola lettura: l'audit non modifica i dati che verifica
+(l'unico file scritto è il checkpoint).
+"""
+import argparse, hashlib, json, os, pathlib, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import ledger
+import keystore
+import retention
+from apscrypto import leaf_hash, merkle_verify, root_message, sd_message
+from apscrypto.utils import dumps, b64d
+
+APP_DIR = pathlib.Path(__file__).parent
+STORE_FILE = APP_DIR / "store.json"
+CHECKPOINT_FILE = pathlib.Path(os.environ.get("APS_AUDIT_CHECKPOINT") or APP_DIR / "audit_checkpoint.json")
+READ_CHUNK = 4 << 20
+SIG_BATCH = 256          # firme per task inviato al pool
+
+# -------------------- messaggi firmati (stessa serializzazione di app.py) --------------------
+
+def _lab_message(env: Dict[str, Any]) -> bytes:
+    return hashlib.sha256(b64d(env["ciphertext"])).digest() + dumps(env["aad"]).encode("utf-8")
+
+def _grant_message(ev: Dict[str, Any]) -> bytes:
+    keys = ("reportId", "from", "to", "ek_to") + (("epoch",) if "epoch" in ev else ())
+    return dumps({k: ev.get(k) for k in keys}).encode("utf-8")
+
+def _group_message(ev: Dict[str, Any]) -> bytes:
+    fields = ("groupId", "epoch", "owner", "members", "pub", "ek_members", "ek_prev")
+    return dumps({k: ev.get(k) for k in fields}).encode("utf-8")
+
+# -------------------- worker: verifica RSA-PSS --------------------
+
+_KEYS: Dict[bytes, Any] = {}   # DER → chiave pubblica caricata (per processo)
+
+def _verify_one(der: bytes, msg: bytes, sig: str) -> bool:
+    from apscrypto import load_public_der, verify_signature
+    key = _KEYS.get(der)
+    if key is None:
+        key = _KEYS[der] = load_public_der(der)
+    try:
+        return bool(verify_signature(key, msg, sig))
+    except Exception:
+        return False
+
+def _verify_chunk(items: List[Tuple[Tuple[bytes, ...], bytes, str]]) -> List[bool]:
+    """Ogni firma è valida se verifica con una delle generazioni della chiave dell'attore (corrente per prima)."""
+    return [any(_verify_one(der, msg, sig) for der in ders) for ders, msg, sig in items]
+
+# -------------------- audit --------------------
+
+class Audit:
+    def __init__(self, workers: Optional[int], checkpoint: Optional[Dict[str, Any]], progress: bool = True):
+        self.workers = workers or os.cpu_count() or 1
+        self.progress = progress
+        self.envelopes = self._load_envelopes()
+        self.keys = self._open_keystore()
+        self.archive = retention.load_archive() if any(map(retention.is_stub, self.envelopes.values())) else {}
+        self.findings: List[Dict[str, Any]] = []
+        self.counts = {"events": 0, "txId": 0, "hash": 0, "signatures": 0, "rootsCached": 0, "archived": 0}
+        self.offsets = [0] * ledger.SHARDS
+        self.roots: Dict[str, None] = {}   # H(lab|root|sig) delle radici già verificate (anche nei run precedenti)
+        if checkpoint:
+            if checkpoint.get("shards") == ledger.SHARDS:
+                self.offsets = list(checkpoint.get("offsets") or self.offsets)
+            self.roots = dict.fromkeys(checkpoint.get("roots") or ())
+        self.start_offsets = list(self.offsets)
+        self._pending: List[Tuple[Dict[str, Any], Tuple[bytes, ...], bytes, str]] = []   # (contesto, DER per generazione, msg, sig)
+        self._pending_roots: Dict[str, Dict[str, Any]] = {}
+        self._futures: List[Tuple[Any, List[Dict[str, Any]]]] = []
+        self._t0 = time.perf_counter()
+        self._last_print = 0.0
+
+    @staticmethod
+    def _open_keystore() -> Optional[keystore.Keystore]:
+        """Keystore in sola lettura: l'audit non crea il file e non ne tocca la coda."""
+        try:
+            return keystore.Keystore(keystore.KEYSTORE_FILE, read_only=True)
+        except (FileNotFoundError, keystore.KeystoreError):
+            return None
+
+    @staticmethod
+    def _load_envelopes() -> Dict[str, Any]:
+        if not STORE_FILE.exists():
+            return {}
+        return json.loads(STORE_FILE.read_text(encoding="utf-8")).get("envelopes", {})
+
+    def _finding(self, ctx: Dict[str, Any], check: str, detail: str):
+        self.findings.append({**ctx, "check": check, "detail": detail})
+
+    def _sig(self, ctx: Dict[str, Any], check: str, actor: str, msg: bytes, sig: str):
+        ks = self.keys
+        ders = tuple(ks.public_der(actor, g) for g in ks.generations(actor)) if actor and ks else ()
+        if not ders:
+            self._finding(ctx, check, f"chiave pubblica sconosciuta per {actor!r}")
+            return
+        self._pending.append(({**ctx, "check": check}, ders, msg, str(sig or "")))
+
+    def _signed(self, ctx: Dict[str, Any], check: str, actor: str, msg: bytes, sig: str,
+                batch: Optional[Dict[str, Any]]):
+        """Firma diretta su msg, oppure prova di inclusione + firma della radice (una volta per radice)."""
+        if not batch:
+            self._sig(ctx, check, actor, msg, sig)
+            return
+        root = str(batch.get("root") or "")
+        if not merkle_verify(leaf_hash(msg), batch.get("path") or [], root):
+            self._finding(ctx, check, "prova di inclusione non valida")
+            return
+        rkey = hashlib.sha256(f"{actor}|{root}|{sig}".encode("utf-8")).hexdigest()
+        if rkey in self.roots or rkey in self._pending_roots:
+            self.counts["rootsCached"] += 1
+            return
+        self._pending_roots[rkey] = ctx
+        try:
+            self._sig({**ctx, "root": root, "rootKey": rkey}, check, actor, root_message(root), sig)
+        except ValueError:
+            self._finding(ctx, check, "radice del batch non valida")
+
+    def _check_publish(self, ev: Dict[str, Any], ctx: Dict[str, Any]):
+        rid = ev.get("reportId")
+        env = self.envelopes.get(rid)
+        if env is None:
+            self._finding(ctx, "envelope", "envelope assente in store.json")
+            return
+        if retention.is_stub(env):
+            stub_hash = (env.get("retention") or {}).get("hash")
+            if stub_hash != ev.get("hash"):
+                self._finding(ctx, "hash", "hash dello stub di retention diverso dal ledger")
+            env = self.archive.get(rid)
+            if env is None:
+                self._finding(ctx, "archive", "envelope ritirato assente dall'archivio")
+                return
+            self.counts["archived"] += 1
+        self.counts["hash"] += 1
+        try:
+            if hashlib.sha256(b64d(env["ciphertext"])).hexdigest() != ev.get("hash"):
+                self._finding(ctx, "hash", "hash del ledger diverso da H(ciphertext)")
+        except (KeyError, ValueError):
+            self._finding(ctx, "hash", "ciphertext mancante o non decodificabile")
+            return
+        aad = env.get("aad") or {}
+        for k_ev, k_aad in (("reportId", "reportId"), ("labId", "labId"), ("patientRef", "patientRef")):
+            if aad.get(k_aad) != ev.get(k_ev):
+                self._finding(ctx, "aad", f"{k_ev} del ledger diverso dall'AAD dell'envelope")
+        if env.get("sig_lab") != ev.get("sig_lab"):
+            self._finding(ctx, "sig_lab", "sig_lab del ledger diversa da quella dell'envelope")
+        lab = str(ev.get("labId") or "")
+        self._signed(ctx, "sig_lab", lab, _lab_message(env), ev.get("sig_lab", ""), ev.get("batch"))
+        sd_root = ev.get("sdRoot")
+        if sd_root:
+            sd = env.get("sd") or {}
+            if sd.get("root") != sd_root:
+                self._finding(ctx, "sdRoot", "sdRoot del ledger diversa da quella dell'envelope")
+            else:
+                try:
+                    self._signed(ctx, "sd_sig", lab, sd_message(sd_root), sd.get("sig", ""), sd.get("batch"))
+                except ValueError:
+                    self._finding(ctx, "sdRoot", "sdRoot non esadecimale")
+
+    def _check_event(self, ev: Dict[str, Any], shard: int, offset: int):
+        ctx = {"shard": shard, "offset": offset, "txId": ev.get("txId"), "type": ev.get("type"),
+               "reportId": ev.get("reportId") or ev.get("oldReportId") or ev.get("groupId")}
+        self.counts["events"] += 1
+        self.counts["txId"] += 1
+        if ledger.tx_id_of(ev) != ev.get("txId"):
+            self._finding(ctx, "txId", "txId diverso da SHA256 dell'evento canonico")
+        t = ev.get("type")
+        if t == "PUBLISH_REPORT":
+            self._check_publish(ev, ctx)
+        elif t == "GRANT":
+            self._sig(ctx, "sig_pat", str(ev.get("from") or ""), _grant_message(ev), ev.get("sig_pat", ""))
+        elif t == "GROUP_KEY":
+            self._sig(ctx, "sig_owner", str(ev.get("owner") or ""), _group_message(ev), ev.get("sig_owner", ""))
+
+    def _submit(self, ex: ProcessPoolExecutor, force: bool = False):
+        while len(self._pending) >= SIG_BATCH or (force and self._pending):
+            chunk, self._pending = self._pending[:SIG_BATCH], self._pending[SIG_BATCH:]
+            fut = ex.submit(_verify_chunk, [(ders, msg, sig) for _, ders, msg, sig in chunk])
+            self._futures.append((fut, [c for c, _, _, _ in chunk]))
+        # limita i task in volo (memoria costante su ledger grandi)
+        while len(self._futures) > self.workers * 4 or (force and self._futures):
+            self._collect(*self._futures.pop(0))
+
+    def _collect(self, fut, ctxs: List[Dict[str, Any]]):
+        for ctx, ok in zip(ctxs, fut.result()):
+            self.counts["signatures"] += 1
+            rkey = ctx.pop("rootKey", None)
+            if ok:
+                if rkey:
+                    self.roots[rkey] = None
+                continue
+            check = ctx.pop("check")
+            self._finding(ctx, check, "firma della radice del batch non valida" if rkey else "firma non valida")
+
+    def _report_progress(self, final: bool = False):
+        now = time.perf_counter()
+        if not self.progress or (not final and now - self._last_print < 2.0):
+            return
+        self._last_print = now
+        dt = max(now - self._t0, 1e-9)
+        print(f"[audit] eventi {self.counts['events']}  firme {self.counts['signatures']}  "
+              f"{self.counts['events'] / dt:.0f} ev/s  {self.counts['signatures'] / dt:.0f} firme/s  "
+              f"findings {len(self.findings)}", file=sys.stderr)
+
+    def _scan_shard(self, ex: ProcessPoolExecutor, shard: int):
+        log = ledger.open_log(ledger.LEDGER_FILE, shard)   # solo letture: i .pending non sigillati si leggono in chiaro
+        off = self.offsets[shard]
+        if log.size() < off:
+            self._finding({"shard": shard, "offset": off}, "checkpoint", "ledger più corto del checkpoint: audit da capo")
+            off = 0
+        while True:
+            data = log.read(off, READ_CHUNK)
+            if not data:
+                break
+            pos = off
+            for line in data.splitlines(keepends=True):
+                if line.strip():
+                    try:
+                        self._check_event(json.loads(line), shard, pos)
+                    except ValueError:
+                        self._finding({"shard": shard, "offset": pos}, "json", "riga NDJSON non valida")
+                pos += len(line)
+            off += len(data)
+            self._submit(ex)
+            self._report_progress()
+        self._submit(ex, force=True)
+        self.offsets[shard] = off
+
+    def run(self) -> Dict[str, Any]:
+        with ProcessPoolExecutor(max_workers=self.workers) as ex:
+            for shard in range(ledger.SHARDS):
+                self._scan_shard(ex, shard)
+        self._report_progress(final=True)
+        elapsed = time.perf_counter() - self._t0
+        return {
+            "ok": not self.findings,
+            "ledger": str(ledger.LEDGER_FILE),
+            "shards": ledger.SHARDS,
+            "counts": self.counts,
+            "elapsed_s": round(elapsed, 3),
+            "events_per_s": round(self.counts["events"] / max(elapsed, 1e-9), 1),
+            "signatures_per_s": round(self.counts["signatures"] / max(elapsed, 1e-9), 1),
+            "resumedFrom": self.start_offsets if any(self.start_offsets) else None,
+            "findings": self.findings,
+        }
+
+    def checkpoint(self) -> Dict[str, Any]:
+        return {"v": 1, "at": int(time.time()), "shards": ledger.SHARDS, "offsets": self.offsets,
+                "roots": list(self.roots)}
+
+def load_checkpoint(path: pathlib.Path = CHECKPOINT_FILE) -> Optional[Dict[str, Any]]:
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+def save_checkpoint(cp: Dict[str, Any], path: pathlib.Path = CHECKPOINT_FILE):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(cp, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, path)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Audit offline del ledger APS")
+    ap.add_argument("--workers", type=int, default=None, help="processi per la verifica delle firme (default: CPU)")
+    ap.add_argument("--resume", action="store_true", help="riparte dal checkpoint (solo eventi nuovi)")
+    ap.add_argument("--checkpoint", default=str(CHECKPOINT_FILE), help="file di checkpoint")
+    ap.add_argument("--out", default=None, help="scrive il report JSON su file invece che su stdout")
+    ap.add_argument("--quiet", action="store_true", help="niente avanzamento su stderr")
+    args = ap.parse_args(argv)
+
+    cp_path = pathlib.Path(args.checkpoint)
+    audit = Audit(args.workers, load_checkpoint(cp_path) if args.resume else None, progress=not args.quiet)
+    report = audit.run()
+    # il checkpoint avanza anche con findings: sono nel report, non vanno ricontrollati ogni notte
+    save_checkpoint(audit.checkpoint(), cp_path)
+    report["checkpoint"] = str(cp_path)
+    out = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        pathlib.Path(args.out).write_text(out, encoding="utf-8")
+    else:
+        print(out)
+    return 0 if report["ok"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
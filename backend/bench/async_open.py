@@ -0,0 +1,200 @@
+# backend/bench/async_open.py
+"""Benchmark /hosp/open ad alta concorrenza: server sincrono (app.py, thread per connessione) vs asgi.py.
+
+Uso (dalla cartella backend):
+    python bench/async_open.py                                # 64 e 512 connessioni, 1500 aperture per livello
+    python bench/async_open.py --concurrency 128 1024 --requests 4000 --reports 500
+
+Il backend è copiato in una directory temporanea e popolato con synth.py (un lab, GRANT verso HOSP);
+i due server girano uno alla volta sugli stessi dati con APS_ADMISSION=off (nessun 429 dal lato sync)
+e APS_AUTH=optional.
+Il client è asincrono (una coroutine per connessione, keep-alive quando il server lo consente) e apre
+coppie (referto, ospedale) distinte a rotazione. Per ogni livello: throughput, p50/p95/p99, errori e
+picco di thread e di RSS del processo server (da /proc).
+"""
+import argparse, asyncio, json, os, pathlib, shutil, signal, subprocess, sys, tempfile, threading, time
+import urllib.error, urllib.request
+
+BACKEND = pathlib.Path(__file__).resolve().parent.parent
+
+def _copy_backend(dst: pathlib.Path):
+    for p in BACKEND.glob("*.py"):
+        shutil.copy2(p, dst / p.name)
+    shutil.copytree(BACKEND / "apscrypto", dst / "apscrypto", ignore=shutil.ignore_patterns("__pycache__"))
+
+def _env(port: int):
+    # aperture senza login: token verificato solo se presente
+    env = {**os.environ, "APS_PORT": str(port), "APS_FAST_START": "1", "APS_ADMISSION": "off", "APS_AUTH": "optional"}
+    for k in ("APS_LEDGER_FILE", "APS_KEYSTORE_FILE", "APS_RECORD"):
+        env.pop(k, None)
+    return env
+
+def _pairs(workdir: pathlib.Path):
+    """(reportId, destinatario) dai GRANT del ledger generato."""
+    out = []
+    for path in sorted(workdir.glob("ledger*.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                ev = json.loads(line)
+                if ev.get("type") == "GRANT":
+                    out.append((ev["reportId"], ev["to"]))
+    return out
+
+def _wait_ready(port: int, timeout_s: float = 120.0):
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout_s:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/ready", timeout=1) as r:
+                if r.status == 200:
+                    return
+        except urllib.error.HTTPError:
+            pass
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("server non pronto")
+
+class _ProcWatch(threading.Thread):
+    """Picco di thread e RSS del processo server durante un livello di carico."""
+
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.stop = threading.Event()
+        self.threads = 0
+        self.rss_kb = 0
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                for line in pathlib.Path(f"/proc/{self.pid}/status").read_text().splitlines():
+                    if line.startswith("Threads:"):
+                        self.threads = max(self.threads, int(line.split()[1]))
+                    elif line.startswith("VmRSS:"):
+                        self.rss_kb = max(self.rss_kb, int(line.split()[1]))
+            except OSError:
+                return
+            self.stop.wait(0.05)
+
+async def _request(port: int, conn, body: bytes):
+    """Una POST su una connessione (riaperta se il server l'ha chiusa). Ritorna (status, connessione)."""
+    for attempt in (0, 1):
+        if conn is None:
+            conn = await asyncio.open_connection("127.0.0.1", port)
+        reader, writer = conn
+        try:
+            writer.write(b"POST /api/hosp/open HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            status = int(lines[0].split(" ")[1])
+            h = {k.strip().lower(): v.strip() for k, _, v in (l.partition(":") for l in lines[1:] if l)}
+            if "content-length" in h:
+                await reader.readexactly(int(h["content-length"]))
+                keep = h.get("connection", "").lower() != "close" and lines[0].startswith("HTTP/1.1")
+            else:
+                await reader.read()   # HTTP/1.0 senza lunghezza: il corpo finisce alla chiusura
+                keep = False
+            if not keep:
+                writer.close()
+                conn = None
+            return status, conn
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            conn = None
+            if attempt:
+                raise
+    raise AssertionError("unreachable")
+
+async def _load(port: int, pairs, concurrency: int, total: int):
+    lat, errors, statuses = [], 0, {}
+    counter = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        conn = None
+        for i in counter:
+            rid, hid = pairs[i % len(pairs)]
+            body = json.dumps({"reportId": rid, "hospitalId": hid}).encode()
+            t0 = time.perf_counter()
+            try:
+                status, conn = await _request(port, conn, body)
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                conn = None
+                continue
+            lat.append((time.perf_counter() - t0) * 1000.0)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status != 200:
+                errors += 1
+        if conn is not None:
+            conn[1].close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return lat, errors, statuses, time.perf_counter() - t0
+
+def _pct(vals, p):
+    if not vals:
+        return None
+    s = sorted(vals)
+    return round(s[min(len(s) - 1, int(round((len(s) - 1) * p)))], 1)
+
+def _run_mode(workdir: pathlib.Path, mode: str, port: int, pairs, levels, total: int):
+    cmd = [sys.executable, "app.py"] if mode == "sync" else [sys.executable, "asgi.py", "--port", str(port)]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=_env(port), start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    rows = []
+    try:
+        _wait_ready(port)
+        asyncio.run(_load(port, pairs, 8, min(total, 200)))   # riscaldamento: chiavi in cache, indici caldi
+        for c in levels:
+            watch = _ProcWatch(proc.pid)
+            watch.start()
+            lat, errors, statuses, dt = asyncio.run(_load(port, pairs, c, total))
+            watch.stop.set()
+            watch.join()
+            rows.append({"mode": mode, "concurrency": c, "requests": total, "ok": statuses.get(200, 0),
+                         "errors": errors, "statuses": statuses, "seconds": round(dt, 2),
+                         "rps": round(statuses.get(200, 0) / dt, 1), "p50_ms": _pct(lat, 0.50),
+                         "p95_ms": _pct(lat, 0.95), "p99_ms": _pct(lat, 0.99),
+                         "peakThreads": watch.threads, "peakRssMB": round(watch.rss_kb / 1024, 1)})
+            r = rows[-1]
+            print(f"{mode:>5} {c:>6} {r['rps']:>8} {r['p50_ms']!s:>9} {r['p95_ms']!s:>9} {r['p99_ms']!s:>9} "
+                  f"{r['errors']:>7} {r['peakThreads']:>8} {r['peakRssMB']:>8}", flush=True)
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+    return rows
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[64, 512])
+    ap.add_argument("--requests", type=int, default=1500, help="aperture per livello di concorrenza")
+    ap.add_argument("--reports", type=int, default=300, help="referti sintetici (GRANT verso 1-3 ospedali)")
+    ap.add_argument("--key-bits", type=int, default=3072)
+    ap.add_argument("--port", type=int, default=8300)
+    ap.add_argument("--modes", nargs="+", default=["sync", "async"], choices=["sync", "async"])
+    ap.add_argument("--out", default=None, help="scrive le righe JSON su file")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = pathlib.Path(tmp)
+        _copy_backend(work)
+        subprocess.run([sys.executable, "synth.py", "--labs", "1", "--reports-per-lab", str(args.reports),
+                        "--patients", "50", "--hospitals", "20", "--doctors", "0", "--update-rate", "0",
+                        "--revoke-rate", "0", "--pool-size", "8", "--key-bits", str(args.key_bits), "--quiet"],
+                       cwd=work, env=_env(args.port), check=True, stdout=subprocess.DEVNULL)
+        pairs = _pairs(work)
+        print(f"{len(pairs)} coppie (referto, ospedale); {os.cpu_count()} CPU")
+        print(f"{'modo':>5} {'conc':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errori':>7} "
+              f"{'thread':>8} {'RSS MB':>8}")
+        rows = []
+        for mode in args.modes:
+            rows += _run_mode(work, mode, args.port, pairs, args.concurrency, args.requests)
+    if args.out:
+        pathlib.Path(args.out).write_text("\n".join(json.dumps(r) for r in rows) + "\n", encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
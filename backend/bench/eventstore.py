@@ -0,0 +1,84 @@
+# backend/bench/eventstore.py
+"""Benchmark EventStore colonnare vs lista di dict: memoria per evento, tempo di caricamento, scansione filtrata.
+
+Uso (dalla cartella backend):
+    python bench/eventstore.py                      # 200000 eventi sintetici
+    python bench/eventstore.py --events 2000000 --no-dicts
+
+Gli eventi (PUBLISH_REPORT + 3 GRANT per referto, firme e wrap di dimensione RSA-3072) sono scritti
+in un ledger temporaneo; il ledger reale non viene toccato. La memoria è misurata con tracemalloc.
+"""
+import argparse, hashlib, json, os, pathlib, sys, tempfile, time, tracemalloc
+
+BACKEND = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND))
+
+from eventstore import EventStore   # noqa: E402
+from segments import SegmentedLog   # noqa: E402
+
+def _write_ledger(path: pathlib.Path, n: int):
+    ek, sig = "E" * 512, "S" * 512   # wrap RSA-3072 / firma PSS in base64
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            rid = f"R-{i // 4:08d}"
+            if i % 4 == 0:
+                ev = {"type": "PUBLISH_REPORT", "reportId": rid, "labId": f"LAB-{i % 17}", "patientRef": f"PAT-{i % 5003}",
+                      "hash": hashlib.sha256(rid.encode()).hexdigest(), "sig_lab": sig, "issuedAt": "2025-01-01T00:00:00+00:00"}
+            else:
+                ev = {"type": "GRANT", "reportId": rid, "from": f"PAT-{(i // 4) % 5003}", "to": f"HOSP-{i % 211}",
+                      "ek_to": ek, "sig_pat": sig}
+            ev["ts"] = 1735689600 + i
+            ev["txId"] = hashlib.sha256(str(i).encode()).hexdigest()
+            f.write(json.dumps(ev, separators=(",", ":"), sort_keys=True) + "\n")
+
+def _measure(build):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    obj = build()
+    dt = time.perf_counter() - t0
+    cur, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, dt, cur
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=200000)
+    ap.add_argument("--no-dicts", action="store_true", help="salta il confronto con la lista di dict")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp) / "ledger.jsonl"
+        _write_ledger(path, args.events)
+        log = SegmentedLog(path)
+
+        def build_store():
+            st = EventStore([log])
+            st.refresh()
+            return st
+        store, load_s, mem = _measure(build_store)
+        t0 = time.perf_counter()
+        n_grants = sum(1 for _ in store.select(type="GRANT", actor="HOSP-7"))
+        scan_ms = (time.perf_counter() - t0) * 1000.0
+        t0 = time.perf_counter()
+        sigs = [ev.get("sig_pat") for _, ev in zip(range(100), store.select(type="GRANT", actor="HOSP-7"))]
+        lazy_ms = (time.perf_counter() - t0) * 1000.0
+        rows = [("columnar", load_s, mem, scan_ms)]
+
+        if not args.no_dicts:
+            def build_dicts():
+                with open(path, "rb") as f:
+                    return [json.loads(l) for l in f]
+            dicts, dl_s, dmem = _measure(build_dicts)
+            t0 = time.perf_counter()
+            assert n_grants == sum(1 for ev in dicts if ev["type"] == "GRANT" and "HOSP-7" in (ev["from"], ev["to"]))
+            rows.append(("dicts", dl_s, dmem, (time.perf_counter() - t0) * 1000.0))
+            del dicts
+
+    print(f"{'repr':>9} {'eventi':>9} {'load s':>8} {'MB':>9} {'B/evento':>9} {'scan ms':>9}")
+    for name, s, m, scan in rows:
+        print(f"{name:>9} {args.events:>9} {s:>8.2f} {m / 1e6:>9.1f} {m / args.events:>9.0f} {scan:>9.1f}")
+    print(f"GRANT verso HOSP-7: {n_grants}; prime {len(sigs)} firme lette lazy dal log in {lazy_ms:.1f} ms")
+    print(json.dumps(store.memory()))
+
+if __name__ == "__main__":
+    main()
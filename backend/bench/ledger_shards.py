@@ -0,0 +1,76 @@
+# backend/bench/ledger_shards.py
+"""Benchmark ledger partizionato: throughput di ingest e tempo di ricostruzione indici per K shard.
+
+Uso (dalla cartella backend):
+    python bench/ledger_shards.py                 # K = 1, 4, 16; 20000 eventi; 8 thread
+    python bench/ledger_shards.py --events 100000 --shards 1 4 16 --threads 16
+
+Ogni K gira in un processo separato (la configurazione degli shard è letta all'import di ledger)
+su una directory temporanea; il ledger reale non viene toccato.
+"""
+import argparse, json, os, pathlib, subprocess, sys, tempfile, threading, time
+
+BACKEND = pathlib.Path(__file__).resolve().parent.parent
+
+def _worker(n_events: int, n_threads: int):
+    sys.path.insert(0, str(BACKEND))
+    import ledger
+
+    ek, sig = "E" * 512, "S" * 512   # dimensioni tipiche di wrap RSA-3072 / firma PSS in base64
+    per_thread = n_events // n_threads
+
+    def ingest(t: int):
+        for i in range(per_thread):
+            rid = f"R-{t}-{i // 4}"
+            if i % 4 == 0:
+                ledger.publish_report(rid, "LAB-B", f"PAT-{i % 97}", "h" * 64, sig, "2025-01-01T00:00:00+00:00")
+            else:
+                ledger.grant_access(rid, f"PAT-{i % 97}", f"HOSP-{i % 13}", ek, sig)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=ingest, args=(t,)) for t in range(n_threads)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    ingest_s = time.perf_counter() - t0
+
+    seq_s = ledger.rebuild_indexes(processes=1)
+    par_s = ledger.rebuild_indexes()
+    t0 = time.perf_counter()
+    n_rec = len(ledger.reports_for_recipient("HOSP-1"))
+    merge_ms = (time.perf_counter() - t0) * 1000.0
+    print(json.dumps({
+        "shards": ledger.SHARDS,
+        "events": per_thread * n_threads,
+        "ingest_s": ingest_s,
+        "ingest_events_per_s": per_thread * n_threads / ingest_s,
+        "rebuild_sequential_s": seq_s,
+        "rebuild_parallel_s": par_s,
+        "recipient_merge_ms": merge_ms,
+        "recipient_reports": n_rec,
+    }))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=20000)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--shards", type=int, nargs="+", default=[1, 4, 16])
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.worker:
+        return _worker(args.events, args.threads)
+
+    results = []
+    for k in args.shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {**os.environ, "APS_LEDGER_SHARDS": str(k), "APS_LEDGER_FILE": str(pathlib.Path(tmp) / "ledger.jsonl")}
+            out = subprocess.run([sys.executable, __file__, "--worker", "--events", str(args.events),
+                                  "--threads", str(args.threads)], env=env, check=True, capture_output=True, text=True)
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"{'K':>3} {'eventi':>8} {'ingest ev/s':>12} {'rebuild seq s':>14} {'rebuild par s':>14} {'merge ms':>9}")
+    for r in results:
+        print(f"{r['shards']:>3} {r['events']:>8} {r['ingest_events_per_s']:>12.0f} "
+              f"{r['rebuild_sequential_s']:>14.3f} {r['rebuild_parallel_s']:>14.3f} {r['recipient_merge_ms']:>9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# backend/bench/startup.py
+"""Benchmark di avvio: time-to-first-response (TTFR) e tempo di readiness del server.
+
+Uso (dalla cartella backend):
+    python bench/startup.py                   # avvio classico vs APS_FAST_START=1, 3 ripetizioni
+    python bench/startup.py --runs 5 --port 8100
+
+Ogni modalità gira su una copia del backend in una directory temporanea: il primo avvio è "freddo"
+(keystore vuoto: keygen RSA delle 4 chiavi demo), i successivi sono "caldi" (chiavi già nel keystore).
+TTFR = prima risposta HTTP qualsiasi su /api/ready; ready = primo 200 su /api/ready.
+"""
+import argparse, json, os, pathlib, shutil, signal, subprocess, sys, tempfile, time, urllib.error, urllib.request
+
+BACKEND = pathlib.Path(__file__).resolve().parent.parent
+
+def _copy_backend(dst: pathlib.Path):
+    for p in BACKEND.glob("*.py"):
+        shutil.copy2(p, dst / p.name)
+    shutil.copytree(BACKEND / "apscrypto", dst / "apscrypto", ignore=shutil.ignore_patterns("__pycache__"))
+
+def _probe(port: int):
+    """Status HTTP di /api/ready, oppure None se il server non accetta ancora connessioni."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/ready", timeout=1) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None
+
+def _run_once(workdir: pathlib.Path, port: int, fast: bool, timeout_s: float):
+    env = {**os.environ, "APS_PORT": str(port), "APS_FAST_START": "1" if fast else "0", "APS_ADMISSION": "off"}
+    env.pop("APS_LEDGER_FILE", None)
+    env.pop("APS_KEYSTORE_FILE", None)
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "app.py"], cwd=workdir, env=env, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ttfr = ready = None
+    try:
+        while time.perf_counter() - t0 < timeout_s:
+            status = _probe(port)
+            now = (time.perf_counter() - t0) * 1000.0
+            if status is not None and ttfr is None:
+                ttfr = now
+            if status == 200:
+                ready = now
+                break
+            time.sleep(0.005)
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)   # anche il processo figlio del reloader
+        proc.wait()
+    return {"ttfr_ms": ttfr, "ready_ms": ready}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=3, help="avvii per modalità (il primo a keystore vuoto)")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    args = ap.parse_args()
+
+    results = []
+    for fast in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            work = pathlib.Path(tmp)
+            _copy_backend(work)
+            for i in range(args.runs):
+                r = _run_once(work, args.port, fast, args.timeout)
+                results.append({"mode": "fast" if fast else "classic", "run": "cold" if i == 0 else "warm", **r})
+
+    fmt = lambda v: f"{v:>10.1f}" if v is not None else f"{'-':>10}"
+    print(f"{'modalità':>8} {'avvio':>6} {'TTFR ms':>10} {'ready ms':>10}")
+    for r in results:
+        print(f"{r['mode']:>8} {r['run']:>6} {fmt(r['ttfr_ms'])} {fmt(r['ready_ms'])}")
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
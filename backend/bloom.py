@@ -0,0 +1,115 @@
+# backend/bloom.py
+"""Filtri di Bloom per le lookup negative (reportId, destinatari, username inesistenti).
+
+`might_contain` = False è una risposta certa: la chiave non è mai stata aggiunta e la lookup costosa
+si può saltare. Il filtro è scalabile: quando lo stadio corrente raggiunge la capacità se ne aggiunge
+uno di capacità doppia (probabilità di falsi positivi complessiva limitata, nessuna ricostruzione).
+I falsi positivi osservati (filtro "forse" ma lookup vuota) sono riportati con `record_miss`.
+"""
+import base64, hashlib, math, threading
+from typing import Any, Dict, List
+
+class _Stage:
+    __slots__ = ("m", "k", "capacity", "count", "bits")
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = max(1, capacity)
+        self.m = max(64, int(math.ceil(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.k = max(1, int(round(self.m / self.capacity * math.log(2))))
+        self.count = 0
+        self.bits = bytearray((self.m + 7) // 8)
+
+    def _positions(self, h1: int, h2: int):
+        m = self.m
+        return ((h1 + i * h2) % m for i in range(self.k))
+
+    def add(self, h1: int, h2: int):
+        for p in self._positions(h1, h2):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def contains(self, h1: int, h2: int) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(h1, h2))
+
+    def fp_estimate(self) -> float:
+        return (1.0 - math.exp(-self.k * self.count / self.m)) ** self.k
+
+def _hashes(key: str):
+    d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+
+class BloomFilter:
+    def __init__(self, name: str, capacity: int = 1 << 14, fp_rate: float = 0.01):
+        self.name = name
+        self.fp_rate = fp_rate
+        self.lock = threading.Lock()
+        self.stages: List[_Stage] = [_Stage(capacity, fp_rate / 2)]
+        self.queries = 0
+        self.negatives = 0
+        self.false_positives = 0
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != "lock"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, key: str):
+        h1, h2 = _hashes(key)
+        with self.lock:
+            if any(s.contains(h1, h2) for s in self.stages):
+                return   # già presente (o falso positivo): non consuma capacità
+            cur = self.stages[-1]
+            if cur.count >= cur.capacity:
+                # stadi successivi con fp dimezzata: la somma resta sotto fp_rate
+                cur = _Stage(cur.capacity * 2, self.fp_rate / 2 ** (len(self.stages) + 1))
+                self.stages.append(cur)
+            cur.add(h1, h2)
+
+    def might_contain(self, key: str) -> bool:
+        h1, h2 = _hashes(key)
+        with self.lock:
+            self.queries += 1
+            hit = any(s.contains(h1, h2) for s in self.stages)
+            if not hit:
+                self.negatives += 1
+            return hit
+
+    def record_miss(self):
+        """Il filtro ha risposto "forse" ma la lookup vera non ha trovato nulla."""
+        with self.lock:
+            self.false_positives += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            absent = self.negatives + self.false_positives   # query per chiavi davvero assenti
+            return {
+                "items": sum(s.count for s in self.stages),
+                "stages": len(self.stages),
+                "bytes": sum(len(s.bits) for s in self.stages),
+                "queries": self.queries,
+                "negatives": self.negatives,
+                "falsePositives": self.false_positives,
+                "observedFpRate": round(self.false_positives / absent, 5) if absent else None,
+                "estimatedFpRate": round(1.0 - math.prod(1.0 - s.fp_estimate() for s in self.stages), 6),
+            }
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"fp": self.fp_rate, "stages": [
+                {"m": s.m, "k": s.k, "capacity": s.capacity, "count": s.count,
+                 "bits": base64.b64encode(bytes(s.bits)).decode("ascii")} for s in self.stages]}
+
+    @classmethod
+    def from_dict(cls, name: str, d: Dict[str, Any]) -> "BloomFilter":
+        bf = cls(name, fp_rate=float(d.get("fp", 0.01)))
+        stages = []
+        for sd in d["stages"]:
+            st = _Stage.__new__(_Stage)
+            st.m, st.k, st.capacity, st.count = int(sd["m"]), int(sd["k"]), int(sd["capacity"]), int(sd["count"])
+            st.bits = bytearray(base64.b64decode(sd["bits"]))
+            stages.append(st)
+        bf.stages = stages
+        return bf
@@ -19,6 +19,17 @@ def enroll(actorId: str, pub_pem: str) -> Dict[str, Any]:
     _save(db)
     return cert
 
+def rotate(actorId: str, pub_pem: str, generation: int) -> Dict[str, Any]:
+    """Nuovo certificato per la generazione di chiave successiva; il precedente va nello storico."""
+    db = _load()
+    prev = db["certs"].get(actorId)
+    if prev:
+        db.setdefault("history", {}).setdefault(actorId, []).append({**prev, "valid": False, "supersededAt": int(time.time())})
+    cert = {"actorId": actorId, "pub": pub_pem, "issuedAt": int(time.time()), "valid": True, "generation": generation}
+    db["certs"][actorId] = cert
+    _save(db)
+    return cert
+
 def revoke(actorId: str):
     db = _load()
     db["crl"].append({"actorId": actorId, "revokedAt": int(time.time())})
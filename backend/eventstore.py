@@ -0,0 +1,209 @@
+# backend/eventstore.py
+"""Rappresentazione compatta (colonnare) degli eventi del ledger in memoria.
+
+Un evento come dict Python costa ~1-2 KB (chiavi ripetute, firme e wrap base64). Qui ogni evento
+occupa qualche decina di byte in colonne `array`: tipo, ts, riferimenti a ID internati (reportId,
+attori) e posizione della riga nel log (shard, offset, lunghezza). Firme, chiavi incapsulate e
+gli altri campi pesanti non stanno in memoria: `Event.get()` li rilegge dalla riga quando servono.
+"""
+import heapq, itertools, json
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+TYPES = ("PUBLISH_REPORT", "REVOKE_REPORT", "UPDATE_REPORT", "GRANT", "GROUP_KEY")
+_TYPE_CODE = {t: i for i, t in enumerate(TYPES)}
+_OTHER = 255          # tipo sconosciuto (conservato solo nella riga)
+_NONE = -1            # riferimento assente
+READ_CHUNK = 1 << 20
+
+# campi leggeri per tipo → colonna: "ref" (reportId/oldReportId/groupId), "ref2", "src", "dst"
+_COLUMNS = {
+    "PUBLISH_REPORT": {"reportId": "ref", "labId": "src", "patientRef": "dst"},
+    "REVOKE_REPORT": {"reportId": "ref", "labId": "src"},
+    "UPDATE_REPORT": {"oldReportId": "ref", "newReportId": "ref2", "labId": "src"},
+    "GRANT": {"reportId": "ref", "from": "src", "to": "dst"},
+    "GROUP_KEY": {"groupId": "ref", "owner": "src"},
+}
+
+class Event:
+    """Vista su un evento: i campi leggeri vengono dalle colonne, il resto dalla riga (letta una volta)."""
+    __slots__ = ("_store", "i", "_full")
+
+    def __init__(self, store: "EventStore", i: int):
+        self._store = store
+        self.i = i
+        self._full: Optional[Dict[str, Any]] = None
+
+    @property
+    def type(self) -> Optional[str]:
+        code = self._store.types[self.i]
+        return TYPES[code] if code != _OTHER else self.get("type")
+
+    @property
+    def ts(self) -> int:
+        return self._store.ts[self.i]
+
+    @property
+    def offset(self) -> int:
+        return self._store.off[self.i]
+
+    def _light(self, key: str):
+        cols = _COLUMNS.get(self.type or "", {})
+        col = cols.get(key)
+        if col is None:
+            return _NONE, False
+        return getattr(self._store, col)[self.i], True
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "type":
+            code = self._store.types[self.i]
+            if code != _OTHER:
+                return TYPES[code]
+        elif key == "ts":
+            return self.ts
+        else:
+            ref, light = self._light(key)
+            if light:
+                return self._store.names[ref] if ref != _NONE else default
+        return self.to_dict().get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        sentinel = object()
+        v = self.get(key, sentinel)
+        if v is sentinel:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.to_dict()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Evento completo (rilettura della riga dal log, memorizzata nella vista)."""
+        if self._full is None:
+            self._full = self._store.load(self.i)
+        return self._full
+
+    def __repr__(self) -> str:
+        return f"Event({self.type}, {self.get('reportId') or self.get('oldReportId') or self.get('groupId')}, ts={self.ts})"
+
+class EventStore:
+    """Colonne parallele `array` + tabella di ID internati; aggiornamento incrementale per offset."""
+
+    def __init__(self, logs: Sequence[Any]):
+        self.logs = list(logs)               # SegmentedLog per shard
+        self.offsets = [0] * len(self.logs)  # offset logico già consumato per shard
+        self.ids: Dict[str, int] = {}        # ID (report, attore, gruppo) → riferimento
+        self.names: List[str] = []           # riferimento → ID
+        self.types = array("B")
+        self.ts = array("q")
+        self.ref = array("i")
+        self.ref2 = array("i")
+        self.src = array("i")
+        self.dst = array("i")
+        self.shard = array("B")
+        self.off = array("Q")
+        self.length = array("I")
+        self.rows = [array("I") for _ in self.logs]   # per shard: righe in ordine di log (quindi di ts)
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def _intern(self, s: Any) -> int:
+        if not s:
+            return _NONE
+        s = str(s)
+        ref = self.ids.get(s)
+        if ref is None:
+            ref = self.ids[s] = len(self.names)
+            self.names.append(s)
+        return ref
+
+    def add(self, ev: Dict[str, Any], shard: int, offset: int, length: int):
+        t = ev.get("type")
+        code = _TYPE_CODE.get(t, _OTHER)
+        cols = {"ref": _NONE, "ref2": _NONE, "src": _NONE, "dst": _NONE}
+        for key, col in _COLUMNS.get(t, {}).items():
+            cols[col] = self._intern(ev.get(key))
+        self.rows[shard].append(len(self.types))
+        self.types.append(code)
+        self.ts.append(int(ev.get("ts") or 0))
+        self.ref.append(cols["ref"])
+        self.ref2.append(cols["ref2"])
+        self.src.append(cols["src"])
+        self.dst.append(cols["dst"])
+        self.shard.append(shard)
+        self.off.append(offset)
+        self.length.append(length)
+
+    def refresh(self) -> int:
+        """Consuma le righe nuove di ogni shard; ritorna il numero di eventi aggiunti."""
+        before = len(self)
+        for s, log in enumerate(self.logs):
+            size = log.size()
+            if size < self.offsets[s]:
+                raise RuntimeError(f"shard {s} troncato: ricostruire l'EventStore")
+            while self.offsets[s] < size:
+                data = log.read(self.offsets[s], READ_CHUNK)
+                if not data:
+                    break
+                pos = self.offsets[s]
+                for raw in data.splitlines(keepends=True):
+                    if raw.strip():
+                        self.add(json.loads(raw), s, pos, len(raw))
+                    pos += len(raw)
+                self.offsets[s] += len(data)
+        return len(self) - before
+
+    def load(self, i: int) -> Dict[str, Any]:
+        raw = self.logs[self.shard[i]].read(self.off[i], self.length[i])
+        return json.loads(raw[: self.length[i]])
+
+    def select(self, type: Optional[str] = None, reportId: Optional[str] = None, actor: Optional[str] = None,
+               since: Optional[int] = None, until: Optional[int] = None, by_ts: bool = False) -> Iterator[Event]:
+        """
+        Eventi filtrati senza materializzare dict: confronti tra interi sulle colonne.
+        `reportId` cerca nei riferimenti (anche oldReportId/newReportId/groupId), `actor` in mittente/destinatario.
+        `by_ts` ordina per ts (ordine globale tra shard), altrimenti ordine di lettura: ogni shard è già in
+        ordine di ts, quindi basta fondere i cursori degli shard senza costruire la lista ordinata.
+        """
+        code = _TYPE_CODE.get(type, _OTHER) if type else None
+        rref = self.ids.get(reportId, _NONE) if reportId else None
+        aref = self.ids.get(actor, _NONE) if actor else None
+        if (reportId and rref == _NONE) or (actor and aref == _NONE):
+            return iter(())   # ID mai visto: nessuna scansione
+        types, ts, ref, ref2, src, dst = self.types, self.ts, self.ref, self.ref2, self.src, self.dst
+
+        def match(i: int) -> bool:
+            if code is not None and types[i] != code:
+                return False
+            if rref is not None and ref[i] != rref and ref2[i] != rref:
+                return False
+            if aref is not None and src[i] != aref and dst[i] != aref:
+                return False
+            if since is not None and ts[i] < since:
+                return False
+            if until is not None and ts[i] > until:
+                return False
+            return True
+
+        if by_ts and len(self.rows) > 1:
+            cursors = [itertools.islice(rows, len(rows)) for rows in self.rows]   # righe presenti ora
+            order = heapq.merge(*cursors, key=ts.__getitem__)
+        else:
+            order = range(len(self))
+        return (Event(self, i) for i in order if match(i))
+
+    def shard_events(self, shard: int, start: int = 0) -> Iterator[Event]:
+        """Eventi di uno shard in ordine di log a partire dal `start`-esimo (numerazione dei checkpoint)."""
+        rows = self.rows[shard]
+        return (Event(self, i) for i in itertools.islice(rows, start, len(rows)))
+
+    def memory(self) -> Dict[str, Any]:
+        """Byte occupati dalle colonne e (approssimati) dalla tabella degli ID."""
+        import sys
+        cols = sum(a.buffer_info()[1] * a.itemsize for a in
+                   (self.types, self.ts, self.ref, self.ref2, self.src, self.dst, self.shard, self.off, self.length,
+                    *self.rows))
+        ids = sys.getsizeof(self.ids) + sys.getsizeof(self.names) + sum(sys.getsizeof(s) for s in self.names)
+        return {"events": len(self), "ids": len(self.names), "columnBytes": cols, "idBytes": ids,
+                "bytesPerEvent": round((cols + ids) / len(self), 1) if len(self) else None}
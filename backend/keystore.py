@@ -0,0 +1,374 @@
+# backend/keystore.py
+"""Keystore unico: chiavi RSA in DER indicizzate per actorId (al posto di keys/<actor>_{priv,pub}.pem).
+
+Formato (un solo file append-only, default keystore.bin):
+  header   MAGIC (8 byte) + salt (16 byte)
+  record   "<4sHHIIBI" = b"KREC", len(id), generazione, len(pub), len(priv), flags, crc32(corpo)
+           corpo = id utf-8 | pub DER (SPKI) | priv DER (PKCS8, oppure nonce||AES-GCM se cifrata)
+Un record con generazione più alta per lo stesso attore sostituisce i precedenti come chiave corrente;
+le generazioni precedenti restano leggibili (`gen=`) per le chiavi incapsulate prima di una rotazione.
+
+All'apertura il file è mappato in memoria (mmap) e scandito una volta per costruire
+l'indice actorId → offset: una lookup è un accesso a dict + slicing, senza syscall.
+Con APS_KEYSTORE_MASTER_KEY (64 hex = chiave AES-256, altrimenti passphrase → scrypt
+con il salt del file) le chiavi private sono cifrate AES-256-GCM (AAD = actorId|generazione).
+"""
+import base64, binascii, hashlib, mmap, os, pathlib, secrets, struct, sys, threading, zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import apscrypto
+from apscrypto import (
+    gen_rsa_keypair,
+    load_private_der,
+    load_private_pem,
+    load_public_der,
+    load_public_pem,
+)
+from filelock import FileLock
+from singleflight import SingleFlight
+
+APP_DIR = pathlib.Path(__file__).parent
+KEYSTORE_FILE = pathlib.Path(os.environ.get("APS_KEYSTORE_FILE", str(APP_DIR / "keystore.bin")))
+LEGACY_DIR = APP_DIR / "keys"
+CACHE_SIZE = int(os.environ.get("APS_KEYSTORE_CACHE", "1024"))   # oggetti chiave deserializzati (LRU)
+
+_MAGIC = b"APSKS\x01\n\x00"
+_HEADER_BYTES = len(_MAGIC) + 16
+_REC = struct.Struct("<4sHHIIBI")
+_TAG = b"KREC"
+_ENCRYPTED = 0x01
+
+class KeystoreError(Exception):
+    pass
+
+def _master_key(secret: Optional[str], salt: bytes) -> Optional[bytes]:
+    if not secret:
+        return None
+    try:
+        raw = bytes.fromhex(secret)
+        if len(raw) == 32:
+            return raw
+    except ValueError:
+        pass
+    return hashlib.scrypt(secret.encode("utf-8"), salt=salt, n=1 << 14, r=8, p=1, dklen=32)
+
+def _aad(actor: str, gen: int) -> bytes:
+    return f"{actor}|{gen}".encode("utf-8")
+
+def _pem(label: str, der: bytes) -> str:
+    b64 = base64.b64encode(der).decode("ascii")
+    body = "\n".join(b64[i:i + 64] for i in range(0, len(b64), 64))
+    return f"-----BEGIN {label}-----\n{body}\n-----END {label}-----\n"
+
+def _pem_der(text: bytes, label: str) -> Optional[bytes]:
+    """DER da un PEM senza deserializzare la chiave (solo PKCS8/SPKI in chiaro)."""
+    begin, end = f"-----BEGIN {label}-----".encode(), f"-----END {label}-----".encode()
+    i, j = text.find(begin), text.find(end)
+    if i < 0 or j < 0:
+        return None
+    try:
+        return base64.b64decode(b"".join(text[i + len(begin):j].split()), validate=True)
+    except binascii.Error:
+        return None
+
+class Keystore:
+    def __init__(self, path: pathlib.Path, master_secret: Optional[str] = None, read_only: bool = False):
+        self.path = pathlib.Path(path)
+        self.read_only = read_only
+        self.lock = threading.RLock()
+        # actorId -> (generazione, off pub, len pub, off priv, len priv, flags)
+        self._index: Dict[str, Tuple[int, int, int, int, int, int]] = {}
+        self._older: Dict[str, List[Tuple[int, int, int, int, int, int]]] = {}   # generazioni superate (solo attori ruotati)
+        self._objs: "OrderedDict[Tuple[str, int, str], Any]" = OrderedDict()
+        self._objs_lock = threading.Lock()
+        self._keygen = SingleFlight("keygen")
+        self.hits = 0
+        self.misses = 0
+
+        # scritture esclusive tra processi (server, CLI, audit, pool di synth condividono il file)
+        self._flock = FileLock(self.path.with_name(self.path.name + ".lock"))
+        if read_only:
+            # nessuna creazione, nessun lock: il file (anche mancante) resta com'è
+            self._fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            self.created = False
+            if os.fstat(self._fd).st_size < _HEADER_BYTES:
+                os.close(self._fd)
+                raise KeystoreError(f"{self.path} non è un keystore")
+        else:
+            os.makedirs(self.path.parent, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o600)
+            with self._flock:
+                self.created = os.fstat(self._fd).st_size == 0
+                if self.created:
+                    os.write(self._fd, _MAGIC + secrets.token_bytes(16))
+                    os.fsync(self._fd)
+        self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(_MAGIC)] != _MAGIC:
+            raise KeystoreError(f"{self.path} non è un keystore")
+        self._master = _master_key(master_secret, self._mm[len(_MAGIC):_HEADER_BYTES])
+        self._size = _HEADER_BYTES
+        # una coda incompleta (append in corso altrove o crash) resta fuori dall'indice: la tronca solo put_many
+        self._scan()
+
+    # ---------- indice ----------
+
+    def _scan(self):
+        """Indicizza i record completi dopo self._size (file già mappato)."""
+        mm, pos, end = self._mm, self._size, len(self._mm)
+        while pos + _REC.size <= end:
+            tag, id_len, gen, pub_len, priv_len, flags, crc = _REC.unpack_from(mm, pos)
+            body = pos + _REC.size
+            stop = body + id_len + pub_len + priv_len
+            if tag != _TAG or stop > end or zlib.crc32(mm[body:stop]) != crc:
+                break
+            actor = mm[body:body + id_len].decode("utf-8")
+            prev = self._index.get(actor)
+            entry = (gen, body + id_len, pub_len, body + id_len + pub_len, priv_len, flags)
+            if prev is None or gen >= prev[0]:
+                self._index[actor] = entry
+                if prev is not None and prev[0] != gen:
+                    self._older.setdefault(actor, []).append(prev)
+            else:
+                self._older.setdefault(actor, []).append(entry)
+            pos = stop
+        self._size = pos
+
+    def refresh(self):
+        """Rilegge la coda del file se un altro processo (es. import da CLI) ha aggiunto record."""
+        with self.lock:
+            size = os.fstat(self._fd).st_size
+            if size != len(self._mm):   # anche più corto: coda incompleta troncata da put_many altrove
+                self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                self._scan()
+
+    def _entry(self, actor: str, gen: Optional[int] = None) -> Optional[Tuple[int, int, int, int, int, int]]:
+        e = self._index.get(actor)
+        if e is None:
+            self.refresh()   # solo sui miss: le hit non toccano il file
+            e = self._index.get(actor)
+        if gen is None or e is None or e[0] == gen:
+            return e
+        return next((o for o in self._older.get(actor, ()) if o[0] == gen), None)
+
+    def has(self, actor: str) -> bool:
+        return self._entry(actor) is not None
+
+    def actors(self) -> List[str]:
+        return list(self._index)
+
+    def generation(self, actor: str) -> Optional[int]:
+        e = self._entry(actor)
+        return e[0] if e is not None else None
+
+    def generations(self, actor: str) -> List[int]:
+        """Generazioni disponibili, dalla corrente alla più vecchia."""
+        e = self._entry(actor)
+        if e is None:
+            return []
+        return [e[0]] + sorted((o[0] for o in self._older.get(actor, ())), reverse=True)
+
+    # ---------- lettura ----------
+
+    def public_der(self, actor: str, gen: Optional[int] = None) -> Optional[bytes]:
+        e = self._entry(actor, gen)
+        if e is None:
+            return None
+        _, off, n, _, _, _ = e
+        return self._mm[off:off + n]
+
+    def public_pem(self, actor: str) -> Optional[str]:
+        der = self.public_der(actor)
+        return _pem("PUBLIC KEY", der) if der is not None else None
+
+    def private_der(self, actor: str, gen: Optional[int] = None) -> Optional[bytes]:
+        e = self._entry(actor, gen)
+        if e is None:
+            return None
+        gen, _, _, off, n, flags = e
+        blob = self._mm[off:off + n]
+        if not flags & _ENCRYPTED:
+            return blob
+        if self._master is None:
+            raise KeystoreError("chiave privata cifrata: APS_KEYSTORE_MASTER_KEY non impostata")
+        try:
+            return AESGCM(self._master).decrypt(blob[:12], blob[12:], _aad(actor, gen))
+        except InvalidTag:
+            raise KeystoreError("master key errata")
+
+    def _cached(self, actor: str, kind: str, build, gen: Optional[int] = None):
+        e = self._entry(actor, gen)
+        if e is None:
+            raise KeystoreError(f"nessuna chiave per {actor}" + (f" (generazione {gen})" if gen is not None else ""))
+        key = (actor, e[0], kind)
+        with self._objs_lock:
+            obj = self._objs.get(key)
+            if obj is not None:
+                self._objs.move_to_end(key)
+                self.hits += 1
+                return obj
+            self.misses += 1
+        obj = build(actor, e[0])
+        with self._objs_lock:
+            self._objs[key] = obj
+            while len(self._objs) > CACHE_SIZE:
+                self._objs.popitem(last=False)
+        return obj
+
+    def public_key(self, actor: str, gen: Optional[int] = None):
+        return self._cached(actor, "pub", lambda a, g: load_public_der(self.public_der(a, g)), gen)
+
+    def private_key(self, actor: str, gen: Optional[int] = None):
+        return self._cached(actor, "priv", lambda a, g: load_private_der(self.private_der(a, g)), gen)
+
+    # ---------- scrittura ----------
+
+    def _record(self, actor: str, gen: int, pub: bytes, priv: bytes) -> bytes:
+        aid = actor.encode("utf-8")
+        flags = 0
+        if self._master is not None:
+            nonce = secrets.token_bytes(12)
+            priv = nonce + AESGCM(self._master).encrypt(nonce, priv, _aad(actor, gen))
+            flags |= _ENCRYPTED
+        body = aid + pub + priv
+        return _REC.pack(_TAG, len(aid), gen, len(pub), len(priv), flags, zlib.crc32(body)) + body
+
+    def put_many(self, items: Iterable[Tuple[str, bytes, bytes]]) -> int:
+        """Append di coppie (actorId, pub DER, priv DER) con un solo write + fsync."""
+        if self.read_only:
+            raise KeystoreError(f"{self.path} aperto in sola lettura")
+        with self.lock, self._flock:
+            self.refresh()
+            if os.fstat(self._fd).st_size > self._size:
+                # con il lock nessun altro sta scrivendo: la coda incompleta è di un crash, si scarta
+                os.ftruncate(self._fd, self._size)
+            gens: Dict[str, int] = {}
+            out = []
+            for actor, pub, priv in items:
+                e = self._index.get(actor)
+                gens[actor] = gens.get(actor, e[0] if e else -1) + 1
+                out.append(self._record(actor, gens[actor], pub, priv))
+            if out:
+                data = memoryview(b"".join(out))
+                while data:
+                    data = data[os.write(self._fd, data):]
+                os.fsync(self._fd)
+                self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                self._scan()
+            return len(out)
+
+    def put(self, actor: str, priv, pub):
+        self.put_many([(actor, apscrypto.public_der(pub), apscrypto.private_der(priv))])
+
+    def ensure(self, actor: str) -> bool:
+        """Genera la coppia se l'attore non ha chiavi; True se generata ora. Keygen concorrenti coalescono."""
+        if self._entry(actor) is not None:
+            return False
+
+        def gen() -> bool:
+            if self._entry(actor) is not None:
+                return False
+            priv, pub = gen_rsa_keypair()
+            self.put(actor, priv, pub)
+            return True
+        return self._keygen.do(actor, gen)
+
+    def rotate(self, actor: str) -> int:
+        """Nuova coppia come generazione successiva (la precedente resta leggibile); ritorna la nuova generazione."""
+        if self._entry(actor) is None:
+            raise KeystoreError(f"nessuna chiave per {actor}")
+        priv, pub = gen_rsa_keypair()
+        with self.lock:
+            self.put(actor, priv, pub)
+            return self._index[actor][0]
+
+    def import_pem_dir(self, directory: pathlib.Path, batch: int = 1000) -> int:
+        """Import massivo da una directory keys/ (<actor>_priv.pem + <actor>_pub.pem); salta gli attori già presenti."""
+        directory = pathlib.Path(directory)
+        n, items = 0, []
+        for ppub in sorted(directory.glob("*_pub.pem")):
+            actor = ppub.name[:-len("_pub.pem")]
+            ppriv = directory / f"{actor}_priv.pem"
+            if actor in self._index or not ppriv.exists():
+                continue
+            pub = _pem_der(ppub.read_bytes(), "PUBLIC KEY") or apscrypto.public_der(load_public_pem(str(ppub)))
+            priv = _pem_der(ppriv.read_bytes(), "PRIVATE KEY") or apscrypto.private_der(load_private_pem(str(ppriv)))
+            items.append((actor, pub, priv))
+            if len(items) >= batch:
+                n += self.put_many(items)
+                items = []
+        return n + self.put_many(items)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "file": str(self.path),
+            "actors": len(self._index),
+            "rotatedActors": len(self._older),
+            "bytes": self._size,
+            "encrypted": self._master is not None,
+            "cachedKeys": len(self._objs),
+            "cacheHits": self.hits,
+            "cacheMisses": self.misses,
+        }
+
+# ---------- istanza di default (lazy) ----------
+
+_store: Optional[Keystore] = None
+_store_lock = threading.Lock()
+
+def store() -> Keystore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                ks = Keystore(KEYSTORE_FILE, os.environ.get("APS_KEYSTORE_MASTER_KEY"))
+                if ks.created and LEGACY_DIR.is_dir():
+                    ks.import_pem_dir(LEGACY_DIR)   # migrazione automatica dai PEM per attore
+                _store = ks
+    return _store
+
+def ensure(actor: str) -> bool:
+    return store().ensure(actor)
+
+def has(actor: str) -> bool:
+    return store().has(actor)
+
+def public_key(actor: str, gen: Optional[int] = None):
+    return store().public_key(actor, gen)
+
+def private_key(actor: str, gen: Optional[int] = None):
+    return store().private_key(actor, gen)
+
+def generation(actor: str) -> Optional[int]:
+    return store().generation(actor)
+
+def generations(actor: str) -> List[int]:
+    return store().generations(actor)
+
+def rotate(actor: str) -> int:
+    return store().rotate(actor)
+
+def public_pem(actor: str) -> Optional[str]:
+    return store().public_pem(actor)
+
+def public_der(actor: str, gen: Optional[int] = None) -> Optional[bytes]:
+    return store().public_der(actor, gen)
+
+def pem_of(der: bytes) -> str:
+    return _pem("PUBLIC KEY", der)
+
+def stats() -> Dict[str, Any]:
+    return store().stats()
+
+if __name__ == "__main__":
+    # python keystore.py import [dir]   → import massivo dei PEM (default: keys/)
+    # python keystore.py stats
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    ks = Keystore(KEYSTORE_FILE, os.environ.get("APS_KEYSTORE_MASTER_KEY"))
+    if cmd == "import":
+        src = pathlib.Path(sys.argv[2]) if len(sys.argv) > 2 else LEGACY_DIR
+        print(f"importati {ks.import_pem_dir(src)} attori da {src}")
+    print(ks.stats())
@@ -1,25 +1,611 @@
 # backend/ledger.py
-import hashlib, json, os, time, pathlib
-from typing import Dict, Any, List, Optional
+import hashlib, json, os, pickle, time, pathlib, threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
-LEDGER_FILE = pathlib.Path(__file__).parent / "ledger.jsonl"
+from segments import SegmentedLog
+from eventstore import Event, EventStore
+from bloom import BloomFilter
+from filelock import FileLock
+
+# il follower (APS_ROLE=follower) tiene una propria copia replicata del ledger
+_DEFAULT_LEDGER = "ledger.follower.jsonl" if os.environ.get("APS_ROLE", "").lower() == "follower" else "ledger.jsonl"
+LEDGER_FILE = pathlib.Path(os.environ.get("APS_LEDGER_FILE") or pathlib.Path(__file__).parent / _DEFAULT_LEDGER)
+READ_CHUNK = 1 << 20
+# partizioni per hash della radice della catena di versioni (1 = ledger unico, layout storico)
+SHARDS = max(1, int(os.environ.get("APS_LEDGER_SHARDS", "1")))
+
+# checkpoint dello stato "as of" ogni N eventi per shard (query storiche); 0 = disattivati.
+# L'intervallo cresce con il ledger (almeno eventi/KEEP) e restano al più KEEP file per shard.
+CHECKPOINT_EVERY = int(os.environ.get("APS_LEDGER_CHECKPOINT_EVERY", "10000"))
+CHECKPOINT_KEEP = max(2, int(os.environ.get("APS_LEDGER_CHECKPOINT_KEEP", "16")))
+
+# filtri di Bloom su tutti gli shard: ID mai visti nel ledger → risposta negativa senza toccare gli indici
+REPORT_BLOOM = BloomFilter("reports")        # reportId (PUBLISH/UPDATE/REVOKE/GRANT) e groupId
+RECIPIENT_BLOOM = BloomFilter("recipients")  # destinatari di GRANT e membri di gruppi
+
+class _LedgerIndex:
+    """Indici in memoria sul ledger, aggiornati leggendo solo le righe nuove (offset logico in byte)."""
+
+    def __init__(self, log: SegmentedLog):
+        self.log = log
+        self.lock = threading.RLock()
+        self.reset()
+
+    def __getstate__(self):
+        # serializzabile per la ricostruzione parallela (lock e file restano nel processo padre)
+        return {k: v for k, v in self.__dict__.items() if k not in ("lock", "log")}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.log = None
+
+    def reset(self):
+        self.offset = 0
+        self.seq = 0
+        self.tx: Dict[str, int] = {}                      # txId -> offset logico della riga
+        self.publish: Dict[str, Dict[str, Any]] = {}      # reportId -> primo PUBLISH_REPORT
+        self.grants: Dict[str, List[Dict[str, Any]]] = {} # reportId -> GRANT in ordine
+        self.revokes: Dict[str, List[int]] = {}           # reportId -> seq dei REVOKE_REPORT
+        # grafo delle versioni: solo UPDATE effettivi (da versione corrente verso ID nuovo)
+        self.next: Dict[str, str] = {}                    # oldReportId -> newReportId
+        self.prev: Dict[str, str] = {}                    # newReportId -> oldReportId
+        self.jump: Dict[str, str] = {}                    # puntatori compressi verso la testa della catena
+        self.update_ev: Dict[str, Dict[str, Any]] = {}    # newReportId -> evento UPDATE_REPORT
+        self.revoke_ev: Dict[str, Dict[str, Any]] = {}    # reportId -> ultimo REVOKE_REPORT
+        self.entry_seq: Dict[str, int] = {}               # newReportId -> seq dell'UPDATE che l'ha creata
+        self.patient_of: Dict[str, str] = {}              # reportId -> patientRef
+        self.by_patient: Dict[str, Dict[str, None]] = {}  # patientRef -> reportId (insieme ordinato)
+        self.by_recipient: Dict[str, Dict[str, None]] = {}# toId -> reportId con almeno un GRANT
+        self.groups: Dict[str, List[Dict[str, Any]]] = {}  # groupId -> GROUP_KEY per epoca (indice = epoca)
+        self.member_of: Dict[str, Dict[str, None]] = {}   # membro -> groupId in cui è (o è stato) membro
+
+    def _apply(self, ev: Dict[str, Any], offset: int):
+        seq = self.seq
+        self.seq += 1
+        self.tx[ev.get("txId")] = offset
+        t = ev.get("type")
+        for k in ("reportId", "oldReportId", "newReportId", "groupId"):
+            if ev.get(k):
+                REPORT_BLOOM.add(ev[k])
+        if t == "GRANT" and ev.get("to"):
+            RECIPIENT_BLOOM.add(ev["to"])
+        elif t == "GROUP_KEY":
+            for m in ev.get("members") or ():
+                RECIPIENT_BLOOM.add(m)
+        if t == "PUBLISH_REPORT":
+            rid = ev.get("reportId")
+            self.publish.setdefault(rid, ev)
+            pat = ev.get("patientRef")
+            if pat:
+                self.patient_of.setdefault(rid, pat)
+                self.by_patient.setdefault(pat, {})[rid] = None
+        elif t == "REVOKE_REPORT":
+            self.revokes.setdefault(ev.get("reportId"), []).append(seq)
+            self.revoke_ev[ev.get("reportId")] = ev
+        elif t == "UPDATE_REPORT":
+            old, new = ev.get("oldReportId"), ev.get("newReportId")
+            # UPDATE da una versione già aggiornata o verso un ID già in catena: non effettivo
+            if old == new or old in self.next or new in self.prev or new in self.next:
+                return
+            self.next[old] = new
+            self.prev[new] = old
+            self.jump[old] = new
+            self.update_ev[new] = ev
+            self.entry_seq[new] = seq
+            # la nuova versione appartiene allo stesso paziente della vecchia
+            pat = self.patient_of.get(old)
+            if pat and new not in self.patient_of:
+                self.patient_of[new] = pat
+                self.by_patient.setdefault(pat, {})[new] = None
+        elif t == "GRANT":
+            rid = ev.get("reportId")
+            self.grants.setdefault(rid, []).append(ev)
+            self.by_recipient.setdefault(ev.get("to"), {})[rid] = None
+        elif t == "GROUP_KEY":
+            gid = ev.get("groupId")
+            epochs = self.groups.get(gid, [])
+            if ev.get("epoch") != len(epochs):
+                return   # le epoche di un gruppo sono consecutive: evento fuori sequenza non effettivo
+            self.groups[gid] = epochs + [ev]
+            for m in ev.get("members") or ():
+                self.member_of.setdefault(m, {})[gid] = None
+
+    def refresh(self):
+        """Consuma le righe complete aggiunte dopo l'ultimo offset letto (anche da segmenti sigillati)."""
+        with self.lock:
+            size = self.log.size()
+            if size < self.offset:
+                # ledger troncato/ricreato: ricostruisci da capo (i checkpoint li scarta il _Checkpointer)
+                self.reset()
+            while self.offset < size:
+                data = self.log.read(self.offset, READ_CHUNK)
+                if not data:
+                    break
+                pos = self.offset
+                for raw in data.splitlines(keepends=True):
+                    if raw.strip():
+                        self._apply(json.loads(raw), pos)
+                    pos += len(raw)
+                self.offset += len(data)
+
+    def head(self, reportId: str) -> str:
+        """Testa della catena di versioni, con compressione dei cammini (quasi O(1) ammortizzato)."""
+        path = []
+        x = reportId
+        while x in self.jump:
+            path.append(x)
+            x = self.jump[x]
+        for p in path[:-1]:
+            self.jump[p] = x
+        return x
+
+    def root(self, reportId: str) -> str:
+        x = reportId
+        while x in self.prev:
+            x = self.prev[x]
+        return x
+
+    def is_revoked(self, reportId: str) -> bool:
+        """REVOKE valido solo se successivo all'ingresso della versione in catena."""
+        entry = self.entry_seq.get(reportId, -1)
+        return any(s > entry for s in self.revokes.get(reportId, ()))
+
+    def state(self, reportId: str) -> Dict[str, Any]:
+        latest = self.head(reportId)
+        if self.is_revoked(latest):
+            status = "REVOKED"
+        elif latest != reportId:
+            status = "UPDATED"
+        else:
+            status = "VALID" if reportId in self.publish else "UNKNOWN"
+        updated_chain = []
+        x = reportId
+        while x != latest:
+            x = self.next[x]
+            updated_chain.append(x)
+        return {"status": status, "currentReportId": latest, "updatedChain": updated_chain}
+
+    def history(self, reportId: str) -> List[Dict[str, Any]]:
+        """Lineage completa (dalla prima versione alla testa) con stato per versione."""
+        out = []
+        x = self.root(reportId)
+        while True:
+            pub = self.publish.get(x)
+            upd = self.update_ev.get(x)
+            nxt = self.next.get(x)
+            if nxt is not None:
+                status = "UPDATED"
+            elif self.is_revoked(x):
+                status = "REVOKED"
+            else:
+                status = "VALID" if (pub or upd) else "UNKNOWN"
+            out.append({
+                "reportId": x,
+                "version": len(out) + 1,
+                "status": status,
+                "supersededBy": nxt,
+                "publishTxId": pub.get("txId") if pub else None,
+                "updateTxId": upd.get("txId") if upd else None,
+                "revokeTxId": self.revoke_ev[x].get("txId") if status == "REVOKED" else None,
+                "ts": (upd or pub or {}).get("ts"),
+            })
+            if nxt is None:
+                return out
+            x = nxt
+
+def _checkpoint_dir(log: SegmentedLog) -> pathlib.Path:
+    return log.path.parent / f"{log.path.stem}_checkpoints"
+
+def _checkpoint_name(cp: Tuple[int, int, int]) -> str:
+    return f"asof-{cp[0]:012d}-{cp[1]:x}-{cp[2]}.pkl"
+
+def _scan_checkpoints(log: SegmentedLog) -> List[Tuple[int, int, int]]:
+    out = []
+    d = _checkpoint_dir(log)
+    if d.is_dir():
+        for p in d.glob("asof-*.pkl"):
+            try:
+                _, seq, off, ts = p.stem.split("-")
+                out.append((int(seq), int(off, 16), int(ts)))
+            except ValueError:
+                continue
+    return sorted(out)
+
+class _AsOfIndex:
+    """
+    Stato leggero per le query "as of": grafo delle versioni, REVOKE e offset dei GRANT, senza i dict
+    degli eventi né la mappa dei txId. È il contenuto dei checkpoint e l'indice su cui si riapplicano
+    gli eventi fino al punto richiesto; i GRANT si rileggono dal log solo per il referto interrogato.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.seq = 0
+        self.publish: Dict[str, None] = {}         # reportId pubblicati (solo appartenenza)
+        self.revokes: Dict[str, List[int]] = {}
+        self.next: Dict[str, str] = {}
+        self.prev: Dict[str, str] = {}
+        self.jump: Dict[str, str] = {}
+        self.entry_seq: Dict[str, int] = {}
+        self.grants: Dict[str, List[int]] = {}     # reportId -> offset delle righe GRANT
+
+    def _apply(self, ev: Dict[str, Any], offset: int):
+        # stesse regole di _LedgerIndex._apply, ristrette a ciò che serve a state() e ai GRANT
+        seq = self.seq
+        self.seq += 1
+        t = ev.get("type")
+        if t == "PUBLISH_REPORT":
+            self.publish.setdefault(ev.get("reportId"), None)
+        elif t == "REVOKE_REPORT":
+            self.revokes.setdefault(ev.get("reportId"), []).append(seq)
+        elif t == "UPDATE_REPORT":
+            old, new = ev.get("oldReportId"), ev.get("newReportId")
+            if old == new or old in self.next or new in self.prev or new in self.next:
+                return
+            self.next[old] = new
+            self.prev[new] = old
+            self.jump[old] = new
+            self.entry_seq[new] = seq
+        elif t == "GRANT":
+            self.grants.setdefault(ev.get("reportId"), []).append(offset)
+
+    head = _LedgerIndex.head
+    is_revoked = _LedgerIndex.is_revoked
+    state = _LedgerIndex.state
+
+CP_STATS = {"written": 0, "dropped": 0, "bytesWritten": 0, "lastBytes": 0, "lastMs": 0.0, "error": None}
+
+class _Checkpointer:
+    """
+    Checkpoint "as of" di uno shard, scritti da un thread di background che segue il log con un proprio
+    _AsOfIndex: nessun lock in comune con le richieste. Un nuovo checkpoint ogni max(CHECKPOINT_EVERY,
+    eventi/CHECKPOINT_KEEP) eventi; oltre CHECKPOINT_KEEP file si elimina quello più vicino al precedente,
+    così i punti restano distribuiti su tutta la storia e lo spazio su disco resta limitato.
+    """
+
+    def __init__(self, log: SegmentedLog):
+        self.log = log
+        self.lock = threading.Lock()
+        self.points: List[Tuple[int, int, int]] = _scan_checkpoints(log)   # (seq, offset, ts) ordinati
+        self.idx: Optional[_AsOfIndex] = None
+
+    def list(self) -> List[Tuple[int, int, int]]:
+        with self.lock:
+            return list(self.points)
+
+    def _resume(self) -> _AsOfIndex:
+        d = _checkpoint_dir(self.log)
+        if d.is_dir():
+            for old in d.glob("cp-*.pkl"):   # formato precedente (stato completo degli indici)
+                old.unlink(missing_ok=True)
+        for cp in reversed(self.list()):
+            try:
+                return _load_checkpoint(self.log, cp)
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+                self._drop(cp)
+        return _AsOfIndex()
+
+    def _drop(self, cp: Tuple[int, int, int]):
+        with self.lock:
+            if cp in self.points:
+                self.points.remove(cp)
+        (_checkpoint_dir(self.log) / _checkpoint_name(cp)).unlink(missing_ok=True)
+        with _CP_LOCK:
+            _CP_CACHE.pop(f"{self.log.path}|{_checkpoint_name(cp)}", None)
+        CP_STATS["dropped"] += 1
+
+    def _write(self, ts: int):
+        idx = self.idx
+        cp = (idx.seq, idx.offset, ts)
+        t0 = time.perf_counter()
+        raw = pickle.dumps(idx.__dict__, protocol=pickle.HIGHEST_PROTOCOL)
+        d = _checkpoint_dir(self.log)
+        d.mkdir(parents=True, exist_ok=True)
+        path = d / _checkpoint_name(cp)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(raw)
+        os.replace(tmp, path)
+        CP_STATS.update(written=CP_STATS["written"] + 1, bytesWritten=CP_STATS["bytesWritten"] + len(raw),
+                        lastBytes=len(raw), lastMs=round((time.perf_counter() - t0) * 1000.0, 1))
+        with self.lock:
+            if not self.points or self.points[-1][0] < cp[0]:
+                self.points.append(cp)
+            extra = len(self.points) - CHECKPOINT_KEEP
+        for _ in range(max(0, extra)):
+            with self.lock:
+                pts = self.points
+                i = min(range(len(pts) - 1), key=lambda k: pts[k][0] - (pts[k - 1][0] if k else 0))
+                victim = pts[i]
+            self._drop(victim)
+
+    def catch_up(self):
+        if self.idx is None:
+            self.idx = self._resume()
+        size = self.log.size()
+        if size < self.idx.offset:
+            # ledger troncato/ricreato: i checkpoint non valgono più
+            for cp in self.list():
+                self._drop(cp)
+            self.idx = _AsOfIndex()
+        idx = self.idx
+        last = self.points[-1][0] if self.points else 0
+        while idx.offset < size:
+            data = self.log.read(idx.offset, READ_CHUNK)
+            if not data:
+                break
+            pos = idx.offset
+            for raw in data.splitlines(keepends=True):
+                pos += len(raw)
+                if not raw.strip():
+                    continue
+                ev = json.loads(raw)
+                idx._apply(ev, pos - len(raw))
+                if idx.seq - last >= max(CHECKPOINT_EVERY, idx.seq // CHECKPOINT_KEEP):
+                    idx.offset = pos
+                    self._write(int(ev.get("ts") or 0))
+                    last = idx.seq
+            idx.offset = pos
+
+_CP_WAKE = threading.Event()
+_CP_THREAD: List[threading.Thread] = []
+_CP_THREAD_LOCK = threading.Lock()
+
+def _checkpoint_loop():
+    while True:
+        _CP_WAKE.wait()
+        _CP_WAKE.clear()
+        for cp in _CHECKPOINTERS:
+            try:
+                cp.catch_up()
+                CP_STATS["error"] = None
+            except Exception as exc:   # il thread non deve morire: si riprova al prossimo risveglio
+                CP_STATS["error"] = f"{type(exc).__name__}: {exc}"
+                cp.idx = None
+        time.sleep(0.2)   # al più ~5 giri al secondo sotto carico di scrittura
+
+def _wake_checkpoints():
+    """Segnala al thread dei checkpoint che il ledger è cresciuto (avviato al primo uso)."""
+    if not CHECKPOINT_EVERY:
+        return
+    if not _CP_THREAD:
+        with _CP_THREAD_LOCK:
+            if not _CP_THREAD:
+                t = threading.Thread(target=_checkpoint_loop, name="aps-ledger-checkpoints", daemon=True)
+                t.start()
+                _CP_THREAD.append(t)
+    _CP_WAKE.set()
+
+def _shard_path(base: pathlib.Path, i: int) -> pathlib.Path:
+    return base if SHARDS == 1 else base.parent / f"{base.stem}_shards" / f"shard-{i:02d}.jsonl"
+
+# ogni shard ha il proprio file (segmentato), lock di scrittura, indice e checkpoint "as of"
+_SHARDS: List[_LedgerIndex] = []
+_CHECKPOINTERS: List[_Checkpointer] = []
+for _i in range(SHARDS):
+    _SHARDS.append(_LedgerIndex(SegmentedLog(_shard_path(LEDGER_FILE, _i))))
+    _CHECKPOINTERS.append(_Checkpointer(_SHARDS[-1].log))
+
+# routing e append serializzati anche tra processi: lo shard di una famiglia dipende dagli UPDATE già scritti
+_APPEND_LOCK = FileLock(LEDGER_FILE.with_name(f"{LEDGER_FILE.stem}.lock"))
+
+def seal_pending():
+    """Completa le rotazioni interrotte da un crash. La chiamano i processi che scrivono (server, follower,
+    synth), non l'import: audit e strumenti di sola lettura non toccano i file del ledger.
+    Gli append proseguono: i sigillatori si escludono con il `seal.lock` di ogni log."""
+    for idx in _SHARDS:
+        idx.log.seal_pending()
+
+def _refresh_all():
+    for idx in _SHARDS:
+        idx.refresh()
+    _wake_checkpoints()
+
+def _family(reportId: str) -> str:
+    """Prima versione della catena: tutte le versioni di un referto stanno nello stesso shard."""
+    if SHARDS == 1:
+        return reportId
+    for idx in _SHARDS:
+        with idx.lock:
+            if reportId in idx.prev:
+                return idx.root(reportId)
+    return reportId
+
+def shard_of(familyId: str) -> int:
+    """Shard di una famiglia di versioni dato l'ID della prima versione (senza consultare gli indici)."""
+    if SHARDS == 1:
+        return 0
+    h = hashlib.sha256(familyId.encode("utf-8")).digest()
+    return int.from_bytes(h[:8], "big") % SHARDS
+
+def _shard_for(reportId: str) -> _LedgerIndex:
+    if SHARDS == 1:
+        return _SHARDS[0]
+    return _SHARDS[shard_of(_family(reportId))]
+
+def _index(reportId: str) -> _LedgerIndex:
+    _refresh_all()
+    return _shard_for(reportId)
+
+def tx_id_of(ev: Dict[str, Any]) -> str:
+    """txId = SHA256 della serializzazione canonica dell'evento (senza txId)."""
+    body = {k: v for k, v in ev.items() if k != "txId"}
+    line = json.dumps(body, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return hashlib.sha256(line.encode("utf-8")).hexdigest()
 
 def _append(event: Dict[str, Any]) -> Dict[str, Any]:
-    os.makedirs(LEDGER_FILE.parent, exist_ok=True)
-    ev = {"ts": int(time.time()), **event}
-    line = json.dumps(ev, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
-    ev["txId"] = hashlib.sha256(line.encode("utf-8")).hexdigest()
-    with LEDGER_FILE.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(ev, ensure_ascii=False, separators=(",", ":"), sort_keys=True) + "\n")
+    with _APPEND_LOCK:
+        if SHARDS > 1:
+            _refresh_all()   # UPDATE scritti da altri thread/processi spostano la famiglia nel suo shard
+        ev = {"ts": int(time.time()), **event}
+        ev["txId"] = tx_id_of(ev)
+        line = json.dumps(ev, ensure_ascii=False, separators=(",", ":"), sort_keys=True) + "\n"
+        idx = _shard_for(ev.get("reportId") or ev.get("oldReportId") or ev.get("groupId") or "")
+        idx.log.append(line.encode("utf-8"))
+    idx.refresh()
     return ev
 
-def _iter_all() -> List[Dict[str, Any]]:
-    if not LEDGER_FILE.exists():
-        return []
-    return [json.loads(l) for l in LEDGER_FILE.read_text(encoding="utf-8").splitlines() if l.strip()]
+def append_raw(data: bytes, shard: int = 0, refresh: bool = True):
+    """Accoda righe NDJSON già serializzate (replica, generatore sintetico): nessun nuovo ts/txId.
+    Con refresh=False l'indice dello shard si aggiorna alla prossima lettura."""
+    idx = _SHARDS[shard]
+    with _APPEND_LOCK:
+        idx.log.append(data)
+    if refresh:
+        idx.refresh()
 
-def publish_report(reportId: str, labId: str, patientRef: str, hash_referto: str, sig_lab: str, issuedAt: str) -> Dict[str, Any]:
-    return _append({
+def last_ts() -> int:
+    """ts dell'ultimo evento fra tutti gli shard (0 se vuoti), letto dalla coda dei log senza indici.
+    Chi scrive eventi con ts esplicito parte da qui: il replay di as_of presuppone ts non decrescenti."""
+    out = 0
+    for idx in _SHARDS:
+        size = idx.log.size()
+        off, tail = max(0, size - READ_CHUNK), b""
+        while off < size:
+            data = idx.log.read(off, size - off)
+            if not data:
+                break
+            tail = (tail + data)[-READ_CHUNK:]
+            off += len(data)
+        last = tail.rstrip(b"\n").rsplit(b"\n", 1)[-1]
+        if last:
+            out = max(out, int(json.loads(last).get("ts") or 0))
+    return out
+
+def read_raw(offset: int, max_bytes: int, shard: int = 0) -> Tuple[bytes, int]:
+    """Righe complete dall'offset logico `offset`, al più ~max_bytes. Ritorna (dati, dimensione logica)."""
+    log = _SHARDS[shard].log
+    return log.read(offset, max_bytes), log.size()
+
+def open_log(path, shard: int = 0) -> SegmentedLog:
+    """Accesso in lettura a un ledger (segmentato) di un altro processo, es. il primario."""
+    return SegmentedLog(_shard_path(pathlib.Path(path), shard))
+
+def get_by_txid(txId: str) -> Optional[Dict[str, Any]]:
+    """Evento per txId: offset dall'indice, poi lettura del solo blocco che lo contiene."""
+    _refresh_all()
+    for idx in _SHARDS:
+        with idx.lock:
+            off = idx.tx.get(txId)
+        if off is not None:
+            line = idx.log.read(off, 1)
+            return json.loads(line) if line else None
+    return None
+
+def rotate():
+    """Forza la chiusura dei segmenti attivi e ne attende la compressione."""
+    for idx in _SHARDS:
+        idx.log.rotate(wait=True)
+
+def version() -> str:
+    """Versione del ledger per le cache di risposta: dimensione logica di ogni shard (append-only)."""
+    return ".".join(f"{idx.log.size():x}" for idx in _SHARDS)
+
+def shard_stats(shard: int) -> Dict[str, Any]:
+    idx = _SHARDS[shard]
+    idx.refresh()
+    with idx.lock:
+        return {"file": str(idx.log.path), "bytes": idx.offset, "events": idx.seq, "segments": idx.log.info()}
+
+def stats() -> Dict[str, Any]:
+    per = [shard_stats(i) for i in range(SHARDS)]
+    out = {"file": str(LEDGER_FILE), "bytes": sum(x["bytes"] for x in per), "events": sum(x["events"] for x in per),
+           "shards": SHARDS}
+    if SHARDS == 1:
+        out["segments"] = per[0]["segments"]
+    else:
+        out["perShard"] = per
+    return out
+
+# -------------------- scansioni / ricostruzione parallela --------------------
+
+def _iter_log(log: SegmentedLog):
+    off = 0
+    while True:
+        data = log.read(off, READ_CHUNK)
+        if not data:
+            return
+        for l in data.splitlines():
+            if l.strip():
+                yield json.loads(l)
+        off += len(data)
+
+def _build_index(path: str) -> _LedgerIndex:
+    idx = _LedgerIndex(SegmentedLog(pathlib.Path(path)))
+    idx.refresh()
+    return idx
+
+def _scan_shard(path: str, fn):
+    return fn(_iter_log(SegmentedLog(pathlib.Path(path))))
+
+def _pool(processes: Optional[int]):
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=processes or min(SHARDS, os.cpu_count() or 1))
+
+def map_shards(fn, processes: Optional[int] = None) -> List[Any]:
+    """Applica fn(iteratore di eventi) a ogni shard in processi separati; un risultato per shard.
+    fn deve essere una funzione a livello di modulo (serializzabile con pickle)."""
+    paths = [str(idx.log.path) for idx in _SHARDS]
+    if SHARDS == 1 or processes == 1:
+        return [_scan_shard(p, fn) for p in paths]
+    with _pool(processes) as ex:
+        return list(ex.map(_scan_shard, paths, [fn] * len(paths)))
+
+def rebuild_indexes(processes: Optional[int] = None) -> float:
+    """Ricostruisce da zero gli indici di tutti gli shard, in parallelo. Ritorna i secondi impiegati."""
+    t0 = time.perf_counter()
+    paths = [str(idx.log.path) for idx in _SHARDS]
+    if SHARDS == 1 or processes == 1:
+        built = [_build_index(p) for p in paths]
+    else:
+        with _pool(processes) as ex:
+            built = list(ex.map(_build_index, paths))
+    for idx, new in zip(_SHARDS, built):
+        with idx.lock:
+            idx.__dict__.update(new.__getstate__())
+            _seed_blooms(idx)
+    return time.perf_counter() - t0
+
+def _seed_blooms(idx: _LedgerIndex):
+    """Gli indici costruiti in altri processi portano con sé solo i dict: ripopola i filtri del processo."""
+    for d in (idx.publish, idx.grants, idx.revoke_ev, idx.next, idx.prev, idx.groups):
+        for key in d:
+            REPORT_BLOOM.add(key)
+    for d in (idx.by_recipient, idx.member_of):
+        for key in d:
+            RECIPIENT_BLOOM.add(key)
+
+def _unknown_report(reportId: str) -> bool:
+    """True se reportId non è mai comparso nel ledger (certo: il filtro non ha falsi negativi)."""
+    _refresh_all()
+    return not REPORT_BLOOM.might_contain(reportId)
+
+def bloom_stats() -> Dict[str, Any]:
+    return {b.name: b.stats() for b in (REPORT_BLOOM, RECIPIENT_BLOOM)}
+
+# vista colonnare di tutti gli eventi (tutti gli shard), costruita al primo uso e aggiornata per offset
+_EVENTS: Optional[EventStore] = None
+_EVENTS_LOCK = threading.Lock()
+
+def event_store() -> EventStore:
+    global _EVENTS
+    with _EVENTS_LOCK:
+        if _EVENTS is None:
+            _EVENTS = EventStore([idx.log for idx in _SHARDS])
+        _EVENTS.refresh()
+        return _EVENTS
+
+def events(type: Optional[str] = None, reportId: Optional[str] = None, actor: Optional[str] = None,
+           since: Optional[int] = None, until: Optional[int] = None) -> Iterator[Event]:
+    """Scansione filtrata di tutto il ledger senza materializzare dict (ordine per ts se più shard)."""
+    return event_store().select(type, reportId, actor, since, until, by_ts=SHARDS > 1)
+
+def publish_report(reportId: str, labId: str, patientRef: str, hash_referto: str, sig_lab: str, issuedAt: str,
+                   batch: Optional[Dict[str, Any]] = None, sd_root: Optional[str] = None) -> Dict[str, Any]:
+    """`batch` (firma a lotti): {"root", "path"}; sig_lab è allora la firma della radice di Merkle.
+    `sd_root`: radice degli impegni per campo (divulgazione selettiva)."""
+    ev = {
         "type": "PUBLISH_REPORT",
         "reportId": reportId,
         "labId": labId,
@@ -27,7 +613,12 @@ def publish_report(reportId: str, labId: str, patientRef: str, hash_referto: str
         "hash": hash_referto,
         "sig_lab": sig_lab,
         "issuedAt": issuedAt,
-    })
+    }
+    if batch:
+        ev["batch"] = batch
+    if sd_root:
+        ev["sdRoot"] = sd_root
+    return _append(ev)
 
 def revoke_report(reportId: str, labId: str, reason: str = "") -> Dict[str, Any]:
     return _append({
@@ -45,41 +636,246 @@ def update_report(oldReportId: str, newReportId: str, labId: str) -> Dict[str, A
         "labId": labId,
     })
 
-def grant_access(reportId: str, patientId: str, toId: str, ek_to_b64: str, sig_pat: str) -> Dict[str, Any]:
-    return _append({
+def grant_access(reportId: str, patientId: str, toId: str, ek_to_b64: str, sig_pat: str,
+                 epoch: Optional[int] = None, key_gen: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    GRANT verso un attore (ek_to RSA-OAEP) o verso un gruppo (ek_to per la chiave dell'epoca `epoch`).
+    `key_gen` ({"from": g, "to": g}) è presente nei GRANT di sostituzione scritti da una rotazione di chiave.
+    """
+    ev = {
         "type": "GRANT",
         "reportId": reportId,
         "from": patientId,
         "to": toId,
         "ek_to": ek_to_b64,
         "sig_pat": sig_pat,
+    }
+    if epoch is not None:
+        ev["epoch"] = epoch
+    if key_gen:
+        ev["keyGen"] = key_gen
+    return _append(ev)
+
+def publish_group_key(groupId: str, epoch: int, owner: str, members: List[str], pub: str,
+                      ek_members: Dict[str, str], ek_prev: Optional[str], sig_owner: str) -> Dict[str, Any]:
+    """Nuova epoca della chiave di un gruppo (creazione o cambio di membri)."""
+    return _append({
+        "type": "GROUP_KEY",
+        "groupId": groupId,
+        "epoch": epoch,
+        "owner": owner,
+        "members": members,
+        "pub": pub,
+        "ek_members": ek_members,
+        "ek_prev": ek_prev,
+        "sig_owner": sig_owner,
     })
 
+def group_epochs(groupId: str) -> List[Dict[str, Any]]:
+    if _unknown_report(groupId):
+        return []
+    idx = _shard_for(groupId)
+    with idx.lock:
+        return list(idx.groups.get(groupId, ()))
+
+def group_current(groupId: str) -> Optional[Dict[str, Any]]:
+    epochs = group_epochs(groupId)
+    return epochs[-1] if epochs else None
+
+def groups_for_member(memberId: str) -> List[str]:
+    """Gruppi di cui l'attore è membro nell'epoca corrente."""
+    out = []
+    if not RECIPIENT_BLOOM.might_contain(memberId):
+        return out
+    for gid in _merge("member_of", memberId):
+        cur = group_current(gid)
+        if cur and memberId in (cur.get("members") or ()):
+            out.append(gid)
+    return out
+
 def state_of(reportId: str) -> Dict[str, Any]:
-    evs = _iter_all()
-    status = "UNKNOWN"
-    latest = reportId
-    updated_chain = []
-    for ev in evs:
-        if ev.get("type") == "PUBLISH_REPORT" and ev.get("reportId") == reportId and status == "UNKNOWN":
-            status = "VALID"
-        if ev.get("type") == "REVOKE_REPORT" and ev.get("reportId") == latest:
-            status = "REVOKED"
-        if ev.get("type") == "UPDATE_REPORT" and ev.get("oldReportId") == latest:
-            status = "UPDATED"
-            latest = ev.get("newReportId")
-            updated_chain.append(latest)
-    return {"status": status, "currentReportId": latest, "updatedChain": updated_chain}
+    if _unknown_report(reportId):
+        return {"status": "UNKNOWN", "currentReportId": reportId, "updatedChain": []}
+    idx = _shard_for(reportId)
+    with idx.lock:
+        st = idx.state(reportId)
+        if st["status"] == "UNKNOWN" and reportId not in idx.grants and reportId not in idx.revoke_ev:
+            REPORT_BLOOM.record_miss()
+        return st
 
 def lookup_grants(reportId: str, toId: str) -> List[Dict[str, Any]]:
-    return [ev for ev in _iter_all() if ev.get("type")=="GRANT" and ev.get("reportId")==reportId and ev.get("to")==toId]
+    if _unknown_report(reportId):
+        return []
+    idx = _shard_for(reportId)
+    with idx.lock:
+        return [ev for ev in idx.grants.get(reportId, ()) if ev.get("to")==toId]
 
 def lookup_grants_for_report(reportId: str) -> List[Dict[str, Any]]:
     """Tutti i GRANT per un report (qualsiasi destinatario)."""
-    return [ev for ev in _iter_all() if ev.get("type")=="GRANT" and ev.get("reportId")==reportId]
+    if _unknown_report(reportId):
+        return []
+    idx = _shard_for(reportId)
+    with idx.lock:
+        return list(idx.grants.get(reportId, ()))
 
 def get_publish(reportId: str) -> Optional[Dict[str, Any]]:
-    for ev in _iter_all():
-        if ev.get("type")=="PUBLISH_REPORT" and ev.get("reportId")==reportId:
-            return ev
+    if _unknown_report(reportId):
+        return None
+    idx = _shard_for(reportId)
+    with idx.lock:
+        return idx.publish.get(reportId)
+
+def in_version_chain(reportId: str) -> bool:
+    """True se reportId è già in una catena di UPDATE (versione precedente o successiva di un altro ID)."""
+    if _unknown_report(reportId):
+        return False
+    for idx in _SHARDS:
+        with idx.lock:
+            if reportId in idx.prev or reportId in idx.next:
+                return True
+    return False
+
+def current_version(reportId: str) -> str:
+    """ID della versione corrente (testa della catena di UPDATE)."""
+    if _unknown_report(reportId):
+        return reportId
+    idx = _shard_for(reportId)
+    with idx.lock:
+        return idx.head(reportId)
+
+def report_history(reportId: str) -> List[Dict[str, Any]]:
+    idx = _index(reportId)
+    with idx.lock:
+        return idx.history(reportId)
+
+def retention_info(reportId: str) -> Optional[Tuple[str, int]]:
+    """("superseded" | "revoked", ts da cui lo è) per versioni non più correnti; None se la versione è viva."""
+    if _unknown_report(reportId):
+        return None
+    idx = _shard_for(reportId)
+    with idx.lock:
+        nxt = idx.next.get(reportId)
+        if nxt is not None:
+            return "superseded", int(idx.update_ev[nxt].get("ts") or 0)
+        if idx.is_revoked(reportId):
+            return "revoked", int(idx.revoke_ev[reportId].get("ts") or 0)
     return None
+
+def retention_candidates(until: Dict[str, int]) -> List[str]:
+    """
+    ReportId superati da un UPDATE (`until["superseded"]`) o revocati (`until["revoked"]`) con ts <= soglia,
+    da una scansione delle colonne dell'EventStore; il tipo e il ts effettivi li conferma retention_info.
+    """
+    store = event_store()
+    out: Dict[str, None] = {}
+    for kind, t, key in (("superseded", "UPDATE_REPORT", "oldReportId"), ("revoked", "REVOKE_REPORT", "reportId")):
+        if kind in until:
+            for ev in store.select(type=t, until=until[kind]):
+                out[ev.get(key)] = None
+    out.pop(None, None)
+    return list(out)
+
+# -------------------- query storiche (as of) --------------------
+
+_CP_CACHE: "OrderedDict[str, bytes]" = OrderedDict()   # checkpoint letti di recente (byte pickle)
+_CP_CACHE_MAX = 8
+_CP_LOCK = threading.Lock()
+AS_OF_STATS = {"queries": 0, "fromCheckpoint": 0, "replayedEvents": 0}
+
+def _load_checkpoint(log: SegmentedLog, cp: Tuple[int, int, int]) -> _AsOfIndex:
+    name = _checkpoint_name(cp)
+    key = f"{log.path}|{name}"
+    with _CP_LOCK:
+        raw = _CP_CACHE.get(key)
+        if raw is not None:
+            _CP_CACHE.move_to_end(key)
+    if raw is None:
+        raw = (_checkpoint_dir(log) / name).read_bytes()
+        with _CP_LOCK:
+            _CP_CACHE[key] = raw
+            while len(_CP_CACHE) > _CP_CACHE_MAX:
+                _CP_CACHE.popitem(last=False)
+    idx = _AsOfIndex.__new__(_AsOfIndex)
+    idx.__dict__.update(pickle.loads(raw))   # copia indipendente: il replay non tocca la cache
+    return idx
+
+def _read_event(log: SegmentedLog, offset: int) -> Dict[str, Any]:
+    return json.loads(log.read(offset, 1).split(b"\n", 1)[0])
+
+def _index_as_of(reportId: str, ts: Optional[int] = None, txId: Optional[str] = None) -> Tuple[_AsOfIndex, SegmentedLog, Dict[str, Any]]:
+    """
+    Indice dello shard del referto com'era al tempo `ts` (eventi con ts <= ts) o subito dopo `txId`:
+    ultimo checkpoint utile + replay dei soli eventi successivi fino al punto richiesto.
+    """
+    _refresh_all()
+    idx = _shard_for(reportId)
+    stop_off = None
+    if txId is not None:
+        ev = get_by_txid(txId)
+        if ev is None:
+            raise KeyError(txId)
+        with idx.lock:
+            stop_off = idx.tx.get(txId)
+        if stop_off is None:
+            ts = int(ev.get("ts") or 0)   # evento di un altro shard: si usa il suo ts
+    cps = _CHECKPOINTERS[_SHARDS.index(idx)].list()
+    with idx.lock:
+        end = idx.offset
+    if stop_off is not None:
+        usable = [cp for cp in cps if cp[1] <= stop_off]
+    else:
+        usable = [cp for cp in cps if cp[2] <= ts]
+    AS_OF_STATS["queries"] += 1
+    if usable:
+        snap = _load_checkpoint(idx.log, usable[-1])
+        AS_OF_STATS["fromCheckpoint"] += 1
+    else:
+        snap = _AsOfIndex()
+    start_seq = snap.seq
+    # replay sulle colonne dell'EventStore (tipo, ts, riferimenti, offset): nessun json.loads per riga
+    for ev in event_store().shard_events(_SHARDS.index(idx), snap.seq):
+        pos = ev.offset
+        if pos >= end or (stop_off is not None and pos > stop_off):
+            break
+        if stop_off is None and ev.ts > ts:
+            break
+        snap._apply(ev, pos)
+    replayed = snap.seq - start_seq
+    AS_OF_STATS["replayedEvents"] += replayed
+    return snap, idx.log, {"ts": ts, "txId": txId, "events": snap.seq,
+                           "checkpointSeq": usable[-1][0] if usable else None, "replayedEvents": replayed}
+
+def state_as_of(reportId: str, ts: Optional[int] = None, txId: Optional[str] = None) -> Dict[str, Any]:
+    snap, _, info = _index_as_of(reportId, ts, txId)
+    return {**snap.state(reportId), "asOf": info}
+
+def grants_as_of(reportId: str, ts: Optional[int] = None, txId: Optional[str] = None) -> Dict[str, Any]:
+    """Stato al punto richiesto + GRANT della versione allora corrente (chi poteva aprire il referto)."""
+    snap, log, info = _index_as_of(reportId, ts, txId)
+    st = snap.state(reportId)
+    grants = [_read_event(log, off) for off in snap.grants.get(st["currentReportId"], ())]
+    return {**st, "grants": grants, "asOf": info}
+
+def checkpoint_stats() -> Dict[str, Any]:
+    return {**AS_OF_STATS, **CP_STATS, "every": CHECKPOINT_EVERY, "keep": CHECKPOINT_KEEP,
+            "perShard": [len(cp.list()) for cp in _CHECKPOINTERS]}
+
+def _merge(attr: str, key: str) -> List[str]:
+    """Letture trasversali agli shard: unione ordinata dei risultati di ogni indice."""
+    _refresh_all()
+    out: Dict[str, None] = {}
+    for idx in _SHARDS:
+        with idx.lock:
+            out.update(getattr(idx, attr).get(key, {}))
+    return list(out)
+
+def reports_for_patient(patientRef: str) -> List[str]:
+    """ReportId pubblicati per il paziente, incluse le nuove versioni da UPDATE."""
+    return _merge("by_patient", patientRef)
+
+def reports_for_recipient(toId: str) -> List[str]:
+    """ReportId per cui esiste almeno un GRANT verso il destinatario."""
+    _refresh_all()
+    if not RECIPIENT_BLOOM.might_contain(toId):
+        return []
+    return _merge("by_recipient", toId)
@@ -0,0 +1,89 @@
+# backend/profiler.py
+"""Profiler a campionamento su richiesta (solo stdlib).
+
+Per `seconds` secondi legge a intervalli regolari gli stack di tutti i thread (sys._current_frames)
+e li aggrega in formato "collapsed stack" (una riga per stack: `frame;frame;... conteggio`),
+direttamente utilizzabile con flamegraph.pl / speedscope. Nessun hook installato: quando non
+campiona il costo è nullo. La route di ogni campione è ricavata dallo stack stesso tramite `route_of`.
+"""
+import os, sys, threading, time
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+MAX_SECONDS = float(os.environ.get("APS_PROFILE_MAX_S", "60"))
+MAX_HZ = 1000.0
+NO_ROUTE = "(no route)"
+
+_busy = threading.Lock()   # un solo profilo alla volta
+
+class Busy(Exception):
+    pass
+
+def _label(code) -> str:
+    return f"{code.co_name}@{os.path.basename(code.co_filename)}:{code.co_firstlineno}"
+
+def sample(seconds: float, hz: float = 100.0, route_of: Optional[Callable[[Any], Optional[str]]] = None,
+           all_threads: bool = False) -> Dict[str, Any]:
+    """
+    Campiona gli stack per `seconds` secondi a `hz` campioni/s.
+    `route_of(frame)` → nome della route se il frame è il punto d'ingresso di una richiesta, altrimenti None.
+    Senza `all_threads` sono tenuti solo i thread che stanno servendo una route.
+    """
+    seconds = max(0.01, min(float(seconds), MAX_SECONDS))
+    interval = 1.0 / max(1.0, min(float(hz), MAX_HZ))
+    if not _busy.acquire(blocking=False):
+        raise Busy("profiler già in esecuzione")
+    try:
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        by_route: Counter = Counter()
+        ticks = 0
+        t0 = time.perf_counter()
+        deadline = t0 + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            ticks += 1
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                labels = []
+                route = None
+                f = frame
+                while f is not None:
+                    labels.append(_label(f.f_code))
+                    if route is None and route_of is not None:
+                        route = route_of(f)
+                    f = f.f_back
+                if route is None and not all_threads:
+                    continue
+                route = route or NO_ROUTE
+                labels.append(route)
+                stacks[";".join(reversed(labels))] += 1
+                by_route[route] += 1
+            time.sleep(max(0.0, interval - (time.perf_counter() - now)))
+        elapsed = time.perf_counter() - t0
+    finally:
+        _busy.release()
+
+    # tempo "self" (foglia) e "total" (presenza nello stack) per frame
+    self_t: Counter = Counter()
+    total_t: Counter = Counter()
+    for stack, n in stacks.items():
+        frames = stack.split(";")[1:]   # il primo elemento è la route
+        if frames:
+            self_t[frames[-1]] += n
+        for fr in set(frames):
+            total_t[fr] += n
+    samples = sum(stacks.values())
+    return {
+        "seconds": round(elapsed, 3),
+        "hz": round(1.0 / interval, 1),
+        "ticks": ticks,
+        "samples": samples,
+        "byRoute": dict(by_route.most_common()),
+        "topSelf": [{"frame": fr, "samples": n, "pct": round(100.0 * n / samples, 1)} for fr, n in self_t.most_common(25)],
+        "topTotal": [{"frame": fr, "samples": n, "pct": round(100.0 * n / samples, 1)} for fr, n in total_t.most_common(25)],
+        "collapsed": "\n".join(f"{s} {n}" for s, n in stacks.most_common()),
+    }
@@ -0,0 +1,127 @@
+# backend/replica.py
+"""Follower di sola lettura: replica il ledger del primario via log shipping.
+
+Sorgente (APS_PRIMARY):
+  * URL http(s) del primario → scarica blocchi da /api/ledger/segment
+  * percorso di un ledger.jsonl locale → lo segue in coda (tail), segmenti sigillati inclusi
+Ogni riga viene verificata (txId ricalcolato) prima di essere accodata al ledger locale;
+gli indici del follower si aggiornano come sul primario.
+"""
+import json, os, threading, time, urllib.request
+from typing import Any, Dict, Optional, Tuple
+
+import ledger
+
+PRIMARY = os.environ.get("APS_PRIMARY", "").strip()
+ENABLED = os.environ.get("APS_ROLE", "").strip().lower() == "follower" and bool(PRIMARY)
+POLL_S = float(os.environ.get("APS_REPLICA_POLL_S", "0.5"))
+# segreto condiviso: il primario serve /api/ledger/segment solo con header X-Replica-Token uguale
+TOKEN = os.environ.get("APS_REPLICA_TOKEN", "")
+CHUNK_BYTES = 1 << 20
+
+_STATE: Dict[str, Any] = {
+    "primary": PRIMARY,
+    "running": False,
+    "appliedBytes": 0,      # byte replicati = dimensione del ledger locale
+    "primaryBytes": None,   # ultima dimensione nota del ledger del primario
+    "primaryEvents": None,
+    "appliedEvents": 0,
+    "lastSyncAt": None,     # ultimo poll riuscito (epoch s)
+    "caughtUpAt": None,     # ultimo istante in cui il follower era allineato
+    "error": None,
+}
+_lock = threading.Lock()
+
+def _fetch(offset: int, shard: int) -> Tuple[bytes, int, Optional[int]]:
+    """Ritorna (righe complete da offset, dimensione ledger primario, eventi primario) per uno shard."""
+    if PRIMARY.startswith(("http://", "https://")):
+        url = f"{PRIMARY.rstrip('/')}/api/ledger/segment?shard={shard}&offset={offset}&max={CHUNK_BYTES}"
+        req = urllib.request.Request(url, headers={"X-Replica-Token": TOKEN})
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            shards = int(resp.headers.get("X-Ledger-Shards") or 1)
+            if shards != ledger.SHARDS:
+                raise ValueError(f"shard del primario ({shards}) diversi da APS_LEDGER_SHARDS ({ledger.SHARDS})")
+            data = resp.read()
+            size = int(resp.headers.get("X-Ledger-Size") or 0)
+            events = resp.headers.get("X-Ledger-Events")
+            return data, size, int(events) if events else None
+    log = _primary_log(shard)
+    return log.read(offset, CHUNK_BYTES), log.size(), None
+
+_PRIMARY_LOGS: Dict[int, Any] = {}
+
+def _primary_log(shard: int):
+    if shard not in _PRIMARY_LOGS:
+        _PRIMARY_LOGS[shard] = ledger.open_log(PRIMARY, shard)
+    return _PRIMARY_LOGS[shard]
+
+def _verify(data: bytes):
+    """Ricalcola il txId di ogni riga; solleva ValueError alla prima incoerenza."""
+    for raw in data.splitlines():
+        if not raw.strip():
+            continue
+        ev = json.loads(raw)
+        if ledger.tx_id_of(ev) != ev.get("txId"):
+            raise ValueError(f"txId non valido: {ev.get('txId')}")
+
+def sync_once() -> int:
+    """Un passo di replica su tutti gli shard. Ritorna i byte applicati."""
+    applied, primary_bytes, primary_events = 0, 0, 0
+    for shard in range(ledger.SHARDS):
+        offset = ledger.shard_stats(shard)["bytes"]
+        data, size, events = _fetch(offset, shard)
+        if size < offset:
+            raise ValueError("ledger del primario più corto della replica (troncato?)")
+        if data:
+            _verify(data)
+            ledger.append_raw(data, shard)
+            applied += len(data)
+        primary_bytes += size
+        primary_events = None if events is None or primary_events is None else primary_events + events
+    st = ledger.stats()
+    now = time.time()
+    with _lock:
+        _STATE.update({
+            "appliedBytes": st["bytes"],
+            "appliedEvents": st["events"],
+            "primaryBytes": primary_bytes,
+            "primaryEvents": primary_events,
+            "lastSyncAt": now,
+            "error": None,
+        })
+        if st["bytes"] >= primary_bytes:
+            _STATE["caughtUpAt"] = now
+    return applied
+
+def _loop():
+    while True:
+        try:
+            # se c'è arretrato non aspettare il prossimo poll
+            if sync_once() and status().get("lagBytes"):
+                continue
+        except Exception as exc:
+            with _lock:
+                _STATE["error"] = f"{exc}"
+        time.sleep(POLL_S)
+
+def start():
+    with _lock:
+        if _STATE["running"]:
+            return
+        _STATE["running"] = True
+    threading.Thread(target=_loop, name="ledger-replica", daemon=True).start()
+
+def status() -> Dict[str, Any]:
+    """Stato della replica con lag in byte, eventi e secondi."""
+    with _lock:
+        st = dict(_STATE)
+    st["enabled"] = ENABLED
+    if st["primaryBytes"] is not None:
+        st["lagBytes"] = max(0, st["primaryBytes"] - st["appliedBytes"])
+    if st["primaryEvents"] is not None:
+        st["lagEvents"] = max(0, st["primaryEvents"] - st["appliedEvents"])
+    if st.get("lagBytes") == 0:
+        st["lagSeconds"] = 0.0
+    else:
+        st["lagSeconds"] = (time.time() - st["caughtUpAt"]) if st["caughtUpAt"] else None
+    return st
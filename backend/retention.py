@@ -0,0 +1,289 @@
+# backend/retention.py
+"""Retention degli envelope non più vivi: versioni superate da un UPDATE e referti revocati.
+
+Regole in `retention.json` (o nel file indicato da APS_RETENTION_RULES), valutate in ordine:
+vince la prima che corrisponde al tipo di envelope ed è già scaduta.
+    [{"name": "superseded-90d", "match": "superseded", "olderThanDays": 90, "action": "drop_ciphertext"},
+     {"name": "revoked",        "match": "revoked",    "olderThanDays": 0,  "action": "archive"}]
+  * drop_ciphertext: ciphertext, nonce, chiavi incapsulate e aperture SD escono da store.json;
+    restano AAD, sig_lab, prova di batch e radice SD.
+  * archive: in store.json resta solo uno stub (AAD + riferimento all'archivio).
+Prima di toccare store.json l'envelope completo è scritto (con fsync) nell'archivio NDJSON
+`archive/envelopes-AAAAMM.ndjson`. Lo stub conserva H(ciphertext), confrontato con l'hash del ledger
+prima di archiviare: hash e firme restano verificabili (audit.py rilegge l'envelope dall'archivio).
+
+Il collector gira in un thread proprio e non deve pesare sulle richieste: lotti piccoli, tempo attivo
+limitato a una frazione (APS_RETENTION_DUTY), pausa finché ci sono richieste ammesse o in coda,
+e store.json riscritto, sotto il lock dello store, solo se nessun altro l'ha modificato durante il lotto
+(altrimenti si riprova).
+"""
+import hashlib, json, os, pathlib, threading, time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import ledger
+from apscrypto.utils import b64d
+
+APP_DIR = pathlib.Path(__file__).parent
+RULES_FILE = pathlib.Path(os.environ.get("APS_RETENTION_RULES") or APP_DIR / "retention.json")
+ARCHIVE_DIR = pathlib.Path(os.environ.get("APS_ARCHIVE_DIR") or APP_DIR / "archive")
+INTERVAL_S = float(os.environ.get("APS_RETENTION_INTERVAL_S", "3600"))   # pausa tra due passate complete
+BATCH = max(1, int(os.environ.get("APS_RETENTION_BATCH", "100")))        # envelope per riscrittura di store.json
+DUTY = min(1.0, max(0.01, float(os.environ.get("APS_RETENTION_DUTY", "0.05"))))   # frazione di tempo attivo
+IDLE_POLL_S = 0.05       # attesa tra due controlli quando ci sono richieste in corso
+MAX_YIELD_S = float(os.environ.get("APS_RETENTION_MAX_YIELD_S", "60"))   # oltre, un lotto parte comunque
+CONFLICT_RETRIES = 3     # tentativi per lotto se store.json cambia sotto il collector
+DAY_S = 86400
+
+MATCHES = ("superseded", "revoked")
+ACTIONS = ("drop_ciphertext", "archive")
+_HEAVY = ("ciphertext", "nonce", "ek_for")
+
+class RuleError(ValueError):
+    pass
+
+class Busy(Exception):
+    pass
+
+def parse_rules(raw: Any) -> List[Dict[str, Any]]:
+    if not isinstance(raw, list):
+        raise RuleError("le regole devono essere una lista")
+    rules = []
+    for i, r in enumerate(raw):
+        match, action = r.get("match"), r.get("action")
+        if match not in MATCHES:
+            raise RuleError(f"regola {i}: match deve essere uno di {MATCHES}")
+        if action not in ACTIONS:
+            raise RuleError(f"regola {i}: action deve essere una di {ACTIONS}")
+        days = float(r.get("olderThanDays", 0))
+        if days < 0:
+            raise RuleError(f"regola {i}: olderThanDays negativo")
+        rules.append({"name": str(r.get("name") or f"{match}-{action}"), "match": match,
+                      "olderThanDays": days, "action": action})
+    return rules
+
+def load_rules(path: pathlib.Path = RULES_FILE) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    return parse_rules(json.loads(path.read_text(encoding="utf-8")))
+
+def is_stub(env: Dict[str, Any]) -> bool:
+    return "retention" in env
+
+def _stub(env: Dict[str, Any], rule: Dict[str, Any], meta: Dict[str, Any]) -> Dict[str, Any]:
+    if rule["action"] == "archive":
+        return {"aad": env.get("aad"), "retention": meta}
+    stub = {k: v for k, v in env.items() if k not in _HEAVY}
+    if isinstance(stub.get("sd"), dict):
+        stub["sd"] = {k: v for k, v in stub["sd"].items() if k != "openings"}
+    stub["retention"] = meta
+    return stub
+
+# -------------------- archivio (NDJSON append-only) --------------------
+
+_ARCHIVE_LOCK = threading.Lock()
+
+def _archive_name(now: int) -> str:
+    return time.strftime("envelopes-%Y%m.ndjson", time.gmtime(now))
+
+def _append_archive(name: str, records: List[Dict[str, Any]]):
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    data = b"".join((json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8") for r in records)
+    with _ARCHIVE_LOCK, open(ARCHIVE_DIR / name, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def iter_archive(name: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    paths = [ARCHIVE_DIR / name] if name else sorted(ARCHIVE_DIR.glob("envelopes-*.ndjson"))
+    for path in paths:
+        if not path.exists():
+            continue
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def load_archive() -> Dict[str, Dict[str, Any]]:
+    """reportId → envelope archiviato (un record ripetuto dopo un conflitto è identico: vince l'ultimo)."""
+    return {rec["reportId"]: rec["envelope"] for rec in iter_archive()}
+
+def archived_envelope(stub: Dict[str, Any], report_id: str) -> Optional[Dict[str, Any]]:
+    """Envelope completo di uno stub, letto dal file d'archivio indicato nello stub."""
+    found = None
+    for rec in iter_archive((stub.get("retention") or {}).get("archive")):
+        if rec.get("reportId") == report_id:
+            found = rec["envelope"]
+    return found
+
+def archive_stats() -> Dict[str, Any]:
+    files = sorted(ARCHIVE_DIR.glob("envelopes-*.ndjson")) if ARCHIVE_DIR.exists() else []
+    return {"dir": str(ARCHIVE_DIR), "files": len(files), "bytes": sum(p.stat().st_size for p in files)}
+
+# -------------------- collector --------------------
+
+class Collector:
+    """
+    Applica le regole a store.json in lotti. `load_db`/`save_db`/`store_version`/`store_lock` sono quelli
+    dell'app; `busy()` → True se ci sono richieste in corso; `on_collected(reportId)` è chiamata per ogni
+    envelope ritirato.
+    """
+
+    def __init__(self, load_db: Callable[[], Dict[str, Any]], save_db: Callable[[Dict[str, Any]], None],
+                 store_version: Callable[[], str], busy: Optional[Callable[[], bool]] = None,
+                 on_collected: Optional[Callable[[str], None]] = None, store_lock: Any = None):
+        self.load_db = load_db
+        self.save_db = save_db
+        self.store_version = store_version
+        self.store_lock = store_lock if store_lock is not None else threading.RLock()
+        self.busy = busy
+        self.on_collected = on_collected
+        self._pass_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.counts = {"passes": 0, "collected": 0, "bytesFreed": 0, "conflicts": 0, "hashMismatch": 0,
+                       "yields": 0, "activeMs": 0.0}
+        self.by_rule: Dict[str, int] = {}
+        self.last_pass: Optional[Dict[str, Any]] = None
+        self.last_error: Optional[str] = None
+
+    def plan(self, db: Dict[str, Any], rules: List[Dict[str, Any]], now: int) -> List[Tuple[str, Dict[str, Any], str, int]]:
+        """(reportId, regola, tipo, ts) degli envelope vivi in store.json a cui una regola si applica già.
+        I candidati vengono dagli UPDATE/REVOKE abbastanza vecchi del ledger, non da tutto store.json."""
+        until: Dict[str, int] = {}
+        for rule in rules:
+            cutoff = now - rule["olderThanDays"] * DAY_S
+            until[rule["match"]] = max(until.get(rule["match"], cutoff), cutoff)
+        envelopes = db.get("envelopes", {})
+        out = []
+        for rid in ledger.retention_candidates(until):
+            env = envelopes.get(rid)
+            if env is None or is_stub(env):
+                continue
+            info = ledger.retention_info(rid)
+            if info is None:
+                continue
+            kind, since = info
+            for rule in rules:
+                if rule["match"] == kind and now - since >= rule["olderThanDays"] * DAY_S:
+                    out.append((rid, rule, kind, since))
+                    break
+        return out
+
+    def _throttle(self, worked_s: float):
+        """Duty cycle: dopo `worked_s` di lavoro pausa proporzionale, poi attende che non ci siano richieste."""
+        self.counts["activeMs"] += worked_s * 1000.0
+        self._stop.wait(worked_s * (1.0 - DUTY) / DUTY)
+        deadline = time.monotonic() + MAX_YIELD_S   # sotto carico continuo il GC avanza comunque, al duty cycle
+        while self.busy is not None and self.busy() and not self._stop.is_set() and time.monotonic() < deadline:
+            self.counts["yields"] += 1
+            self._stop.wait(IDLE_POLL_S)
+
+    def _apply(self, batch: List[Tuple[str, Dict[str, Any], str, int]], now: int) -> Optional[List[str]]:
+        """Un lotto: archivio, poi store.json. None se store.json è cambiato nel frattempo (da riprovare)."""
+        version = self.store_version()
+        db = self.load_db()
+        name = _archive_name(now)
+        records, stubs = [], {}
+        for rid, rule, kind, since in batch:
+            env = db["envelopes"].get(rid)
+            if env is None or is_stub(env):
+                continue
+            try:
+                ct_hash = hashlib.sha256(b64d(env["ciphertext"])).hexdigest()
+            except (KeyError, ValueError):
+                continue
+            pub = ledger.get_publish(rid)
+            if pub is not None and pub.get("hash") != ct_hash:
+                # envelope incoerente con il ledger: resta com'è, è materiale per l'audit
+                self.counts["hashMismatch"] += 1
+                continue
+            meta = {"rule": rule["name"], "action": rule["action"], "match": kind, "since": since,
+                    "at": now, "hash": ct_hash, "archive": name}
+            records.append({"reportId": rid, **{k: meta[k] for k in ("rule", "action", "at", "hash")}, "envelope": env})
+            stubs[rid] = _stub(env, rule, meta)
+        if not stubs:
+            return []
+        # prima l'archivio: un crash o un conflitto dopo questo punto lascia al massimo un record ripetuto
+        _append_archive(name, records)
+        freed = 0
+        # i writer tengono lo stesso lock da load_db a save_db: versione invariata qui = nessuna scrittura persa
+        with self.store_lock:
+            if self.store_version() != version:
+                self.counts["conflicts"] += 1
+                return None
+            for rid, stub in stubs.items():
+                freed += len(json.dumps(db["envelopes"][rid])) - len(json.dumps(stub))
+                db["envelopes"][rid] = stub
+            self.save_db(db)
+        self.counts["bytesFreed"] += freed
+        for rid, rule, _, _ in batch:
+            if rid in stubs:
+                self.counts["collected"] += 1
+                self.by_rule[rule["name"]] = self.by_rule.get(rule["name"], 0) + 1
+                if self.on_collected is not None:
+                    self.on_collected(rid)
+        return list(stubs)
+
+    def run_pass(self, dry_run: bool = False, throttle: bool = True, now: Optional[int] = None) -> Dict[str, Any]:
+        """Una passata completa sulle regole correnti (rilette dal file a ogni passata)."""
+        if not self._pass_lock.acquire(blocking=False):
+            raise Busy("passata di retention già in corso")
+        try:
+            now = int(now if now is not None else time.time())
+            t0 = time.perf_counter()
+            rules = load_rules()
+            candidates = self.plan(self.load_db(), rules, now) if rules else []
+            if dry_run:
+                return {"dryRun": True, "rules": rules, "candidates": [
+                    {"reportId": rid, "rule": rule["name"], "action": rule["action"], "match": kind,
+                     "ageDays": round((now - since) / DAY_S, 2)} for rid, rule, kind, since in candidates]}
+            collected: List[str] = []
+            for i in range(0, len(candidates), BATCH):
+                if self._stop.is_set():
+                    break
+                if throttle:
+                    self._throttle(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                batch = candidates[i:i + BATCH]
+                for _ in range(CONFLICT_RETRIES):
+                    done = self._apply(batch, now)
+                    if done is not None:
+                        collected += done
+                        break
+            self.counts["activeMs"] += (time.perf_counter() - t0) * 1000.0
+            self.counts["passes"] += 1
+            self.last_pass = {"at": now, "candidates": len(candidates), "collected": len(collected)}
+            return {"dryRun": False, "rules": rules, **self.last_pass, "reportIds": collected}
+        finally:
+            self._pass_lock.release()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pass()
+                self.last_error = None
+            except Busy:
+                pass
+            except Exception as exc:   # regole illeggibili, I/O: il thread resta vivo e riprova
+                self.last_error = f"{type(exc).__name__}: {exc}"
+            self._wake.wait(INTERVAL_S)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="aps-retention", daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"running": self._thread is not None and self._thread.is_alive(), "duty": DUTY, "batch": BATCH,
+                "intervalS": INTERVAL_S, **self.counts, "activeMs": round(self.counts["activeMs"], 1),
+                "byRule": dict(self.by_rule), "lastPass": self.last_pass, "lastError": self.last_error,
+                "archive": archive_stats()}
@@ -0,0 +1,284 @@
+# backend/rotation.py
+"""Rotazione della chiave RSA di un paziente o di un destinatario (HOSP/DOC) con re-wrap incrementale.
+
+`start(actor)` genera la generazione successiva nel keystore, la registra presso la CA e pianifica un job:
+ogni referto che ha una chiave incapsulata per l'attore (`ek_for` in store.json, `ek_to` dei GRANT verso
+l'attore) viene sbloccato una sola volta con la chiave vecchia e reincapsulato con la nuova; i GRANT
+interessati sono sostituiti da GRANT nuovi in coda al ledger (`keyGen` indica le generazioni usate).
+Per un paziente i GRANT che ha firmato sono rifirmati con la chiave nuova.
+
+Il job gira in un thread in background, a lotti e con un limite di referti al secondo; lo stato
+(cursore compreso) è salvato dopo ogni lotto in `rotation_state.json`, quindi riparte dopo un riavvio.
+Ogni passo è idempotente (`ek_gen` nell'envelope, `keyGen` nei GRANT): un lotto ripetuto non duplica nulla.
+Durante la rotazione le letture funzionano con entrambe le chiavi: `unwrap_any` / `verify_any` provano
+la generazione indicata, poi la corrente, poi le precedenti.
+"""
+import json, os, pathlib, threading, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import keystore
+import ledger
+from ca import rotate as ca_rotate
+from apscrypto import sign_bytes, verify_signature
+from apscrypto.hybrid import _unwrap_key, _wrap_key
+from apscrypto.utils import dumps
+
+APP_DIR = pathlib.Path(__file__).parent
+STATE_FILE = pathlib.Path(os.environ.get("APS_ROTATION_STATE") or APP_DIR / "rotation_state.json")
+RATE = max(0.1, float(os.environ.get("APS_ROTATION_RATE", "20")))      # referti al secondo
+BATCH = max(1, int(os.environ.get("APS_ROTATION_BATCH", "25")))        # referti per salvataggio di stato/store
+MAX_ERRORS = 100
+
+KEY_GEN_STATS = {"fallbackUnwraps": 0, "fallbackVerifies": 0}
+
+class Busy(Exception):
+    pass
+
+# -------------------- letture con più generazioni --------------------
+
+def _order(actor: str, gen: Optional[int]) -> List[int]:
+    gens = keystore.generations(actor)
+    if gen in gens and gens[0] != gen:
+        gens = [gen] + [g for g in gens if g != gen]
+    return gens
+
+def unwrap_any(actor: str, b64wrap: str, gen: Optional[int] = None) -> bytes:
+    """Unwrap RSA-OAEP con la generazione `gen` (se nota), poi con la corrente e le precedenti."""
+    err: Optional[Exception] = None
+    for i, g in enumerate(_order(actor, gen)):
+        try:
+            key = _unwrap_key(keystore.private_key(actor, g), b64wrap)
+        except Exception as exc:
+            err = exc
+            continue
+        if i:
+            KEY_GEN_STATS["fallbackUnwraps"] += 1
+        return key
+    raise err or keystore.KeystoreError(f"nessuna chiave per {actor}")
+
+def verify_any(actor: str, msg: bytes, sig: str, gen: Optional[int] = None) -> bool:
+    """Firma valida con una qualsiasi generazione della chiave dell'attore (prima `gen`, poi la corrente)."""
+    for i, g in enumerate(_order(actor, gen)):
+        if verify_signature(keystore.public_key(actor, g), msg, sig):
+            if i:
+                KEY_GEN_STATS["fallbackVerifies"] += 1
+            return True
+    return False
+
+def _grant_message(ev: Dict[str, Any]) -> bytes:
+    keys = ("reportId", "from", "to", "ek_to") + (("epoch",) if ev.get("epoch") is not None else ())
+    return dumps({k: ev.get(k) for k in keys}).encode("utf-8")
+
+def _latest_by(grants: List[Dict[str, Any]], field: str) -> Dict[str, Dict[str, Any]]:
+    out: Dict[str, Dict[str, Any]] = {}
+    for g in grants:
+        out[str(g.get(field))] = g
+    return out
+
+# -------------------- job --------------------
+
+class Rotator:
+    """Job di re-wrap per attore; `load_db`/`save_db`/`store_lock` sono quelli dell'app."""
+
+    def __init__(self, load_db: Callable[[], Dict[str, Any]], save_db: Callable[[Dict[str, Any]], None],
+                 store_lock: Any = None):
+        self.load_db = load_db
+        self.save_db = save_db
+        self.store_lock = store_lock if store_lock is not None else threading.RLock()
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, Dict[str, Any]] = self._load_state()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _load_state() -> Dict[str, Dict[str, Any]]:
+        if not STATE_FILE.exists():
+            return {}
+        return json.loads(STATE_FILE.read_text(encoding="utf-8")).get("jobs", {})
+
+    def _save_state(self):
+        with self.lock:
+            data = json.dumps({"v": 1, "jobs": self.jobs}, ensure_ascii=False, separators=(",", ":"))
+        tmp = STATE_FILE.with_suffix(".tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, STATE_FILE)
+
+    def _plan(self, actor: str) -> List[str]:
+        """Referti con una chiave incapsulata per l'attore o con GRANT da/verso l'attore."""
+        rids = {rid for rid, env in self.load_db().get("envelopes", {}).items() if actor in (env.get("ek_for") or {})}
+        rids.update(ledger.reports_for_recipient(actor))
+        rids.update(ledger.reports_for_patient(actor))
+        return sorted(rids)
+
+    def start(self, actor: str) -> Dict[str, Any]:
+        """Nuova generazione (keystore + CA) e job di re-wrap. Busy se l'attore ha già una rotazione in corso."""
+        with self.lock:
+            job = self.jobs.get(actor)
+            if job is not None and job["status"] in ("pending", "running"):
+                raise Busy(f"rotazione già in corso per {actor}")
+            self.jobs[actor] = {"actor": actor, "status": "pending"}
+        try:
+            old = keystore.generation(actor)
+            new = keystore.rotate(actor)
+            ca_rotate(actor, keystore.public_pem(actor), new)
+            items = self._plan(actor)
+        except Exception:
+            with self.lock:
+                if job is None:
+                    self.jobs.pop(actor, None)
+                else:
+                    self.jobs[actor] = job
+            raise
+        job = {"actor": actor, "status": "running", "fromGen": old, "toGen": new, "startedAt": int(time.time()),
+               "finishedAt": None, "items": items, "total": len(items), "cursor": 0,
+               "rewrapped": 0, "grantsReplaced": 0, "grantsResigned": 0, "errors": 0, "conflicts": 0, "lastErrors": []}
+        with self.lock:
+            self.jobs[actor] = job
+        self._save_state()
+        self.ensure_running()
+        self._wake.set()
+        return self.progress(actor)
+
+    def _rotate_report(self, db: Dict[str, Any], job: Dict[str, Any], rid: str,
+                       env_wraps: Dict[str, Tuple[str, str]], events: List[Dict[str, Any]], tally: Dict[str, int]):
+        """Un referto: una sola unwrap con la chiave vecchia, poi ek_for e GRANT verso/da l'attore.
+
+        I contatori vanno in `tally`: il job li somma solo quando il lotto è scritto.
+        """
+        actor, old, new = job["actor"], job["fromGen"], job["toGen"]
+        cache: Dict[str, str] = {}
+
+        def rewrap(wrap: str, hint: Optional[int]) -> str:
+            if "w" not in cache:
+                aes = unwrap_any(actor, wrap, old if hint is None else hint)
+                cache["w"] = _wrap_key(keystore.public_key(actor, new), aes)
+                tally["rewrapped"] += 1
+            return cache["w"]
+
+        env = db["envelopes"].get(rid) or {}
+        wrap = (env.get("ek_for") or {}).get(actor)
+        if wrap and (env.get("ek_gen") or {}).get(actor) != new:
+            env_wraps[rid] = (wrap, rewrap(wrap, (env.get("ek_gen") or {}).get(actor)))
+
+        grants = ledger.lookup_grants_for_report(rid)
+        # GRANT diretti verso l'attore (l'ultimo per referto): nuovo ek_to, rifirmato dal paziente
+        direct = [g for g in grants if g.get("to") == actor and g.get("epoch") is None]
+        last_to = direct[-1] if direct else None
+        if last_to and (last_to.get("keyGen") or {}).get("to") != new:
+            pat = str(last_to.get("from") or "")
+            ev = {"reportId": rid, "from": pat, "to": actor,
+                  "ek_to": rewrap(last_to["ek_to"], (last_to.get("keyGen") or {}).get("to"))}
+            ev["sig_pat"] = sign_bytes(keystore.private_key(pat), _grant_message(ev))
+            ev["keyGen"] = {"from": keystore.generation(pat), "to": new}
+            events.append(ev)
+            tally["grantsReplaced"] += 1
+        # GRANT firmati dall'attore (paziente): l'ultimo per destinatario, rifirmato con la chiave nuova
+        for to, g in _latest_by([g for g in grants if g.get("from") == actor], "to").items():
+            if (g.get("keyGen") or {}).get("from") == new:
+                continue
+            ev = {k: g.get(k) for k in ("reportId", "from", "to", "ek_to")}
+            if g.get("epoch") is not None:
+                ev["epoch"] = g["epoch"]
+            ev["sig_pat"] = sign_bytes(keystore.private_key(actor, new), _grant_message(ev))
+            ev["keyGen"] = {**(g.get("keyGen") or {}), "from": new}
+            events.append(ev)
+            tally["grantsResigned"] += 1
+
+    def _apply_store(self, actor: str, new: int, env_wraps: Dict[str, Tuple[str, str]]) -> bool:
+        """Scrive i wrap nuovi in store.json sotto il lock dello store.
+
+        False (nulla scritto) se un wrap dell'attore è cambiato dopo la lettura del lotto, es. per un UPDATE:
+        il wrap nuovo cifrerebbe la chiave vecchia. Envelope spariti o senza l'attore sono saltati.
+        """
+        with self.store_lock:
+            db = self.load_db()
+            for rid, (src, _) in env_wraps.items():
+                env = db["envelopes"].get(rid) or {}
+                if (env.get("ek_for") or {}).get(actor, src) != src:
+                    return False
+            for rid, (_, wrap) in env_wraps.items():
+                env = db["envelopes"].get(rid)
+                if env is None or actor not in (env.get("ek_for") or {}):
+                    continue
+                env["ek_for"][actor] = wrap
+                env.setdefault("ek_gen", {})[actor] = new
+            self.save_db(db)
+        return True
+
+    def _step(self, job: Dict[str, Any]):
+        """Un lotto di referti dal cursore; il cursore avanza solo dopo store.json e ledger aggiornati."""
+        t0 = time.perf_counter()
+        batch = job["items"][job["cursor"]:job["cursor"] + BATCH]
+        db = self.load_db()
+        env_wraps: Dict[str, Tuple[str, str]] = {}
+        events: List[Dict[str, Any]] = []
+        tally = {"rewrapped": 0, "grantsReplaced": 0, "grantsResigned": 0}
+        errors: List[Dict[str, str]] = []
+        for rid in batch:
+            try:
+                self._rotate_report(db, job, rid, env_wraps, events, tally)
+            except Exception as exc:   # un referto illeggibile non ferma il job: resta negli errori
+                errors.append({"reportId": rid, "error": f"{type(exc).__name__}: {exc}"})
+        if not env_wraps or self._apply_store(job["actor"], job["toGen"], env_wraps):
+            for ev in events:
+                ledger.grant_access(ev["reportId"], ev["from"], ev["to"], ev["ek_to"], ev["sig_pat"],
+                                    epoch=ev.get("epoch"), key_gen=ev["keyGen"])
+            with self.lock:
+                for k, n in tally.items():
+                    job[k] += n
+                job["errors"] += len(errors)
+                job["lastErrors"] = (job["lastErrors"] + errors)[-MAX_ERRORS:]
+                job["cursor"] += len(batch)
+                if job["cursor"] >= job["total"]:
+                    job["status"] = "done"
+                    job["finishedAt"] = int(time.time())
+            self._save_state()
+        else:
+            job["conflicts"] = job.get("conflicts", 0) + 1   # il lotto si ripete al giro successivo (passi idempotenti)
+        # limite di velocità: al massimo RATE referti al secondo, anche quando il lotto va ripetuto
+        self._stop.wait(max(0.0, len(batch) / RATE - (time.perf_counter() - t0)))
+
+    def _loop(self):
+        while not self._stop.is_set():
+            with self.lock:
+                running = [j for j in self.jobs.values() if j.get("status") == "running"]
+            if not running:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            for job in running:
+                if self._stop.is_set():
+                    break
+                self._step(job)
+
+    def ensure_running(self):
+        """Avvia il thread del job (anche per riprendere job interrotti da un riavvio)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="aps-rotation", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def progress(self, actor: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(actor)
+            if job is None:
+                return None
+            out = {k: v for k, v in job.items() if k != "items"}
+        if out.get("status") == "running":
+            left = out["total"] - out["cursor"]
+            out["pct"] = round(100.0 * out["cursor"] / out["total"], 1) if out["total"] else 100.0
+            out["etaS"] = round(left / RATE, 1)
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            actors = list(self.jobs)
+        jobs = [self.progress(a) for a in actors]
+        return {"rate": RATE, "batch": BATCH, **KEY_GEN_STATS,
+                "running": sum(1 for j in jobs if j and j.get("status") == "running"),
+                "done": sum(1 for j in jobs if j and j.get("status") == "done"),
+                "jobs": [j for j in jobs if j and j.get("status") != "done"][:20]}
@@ -0,0 +1,284 @@
+# backend/segments.py
+"""Ledger segmentato: segmento attivo in chiaro + segmenti sigillati compressi a blocchi.
+
+Layout (accanto al file attivo, es. ledger.jsonl):
+  ledger.jsonl                      segmento attivo (append veloce, NDJSON in chiaro)
+  ledger_segments/manifest.json     elenco segmenti sigillati + indice sparso per blocco
+  ledger_segments/seg-000000.jsonl.xz   blocchi lzma/gzip decomprimibili indipendentemente
+  ledger_segments/seg-000001.pending    segmento in chiusura (rinominato, non ancora compresso)
+
+Gli offset sono *logici*: posizione in byte nel flusso NDJSON non compresso
+(segmenti sigillati, poi pending, poi attivo), quindi identici tra primario e follower.
+La rotazione nel percorso di append è solo il rename in .pending; la compressione gira in un thread in
+background senza tenere il lock del log (un solo sigillatore per log, anche tra processi: `seal.lock`).
+"""
+import bisect, gzip, json, lzma, os, pathlib, sys, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from filelock import FileLock
+
+SEGMENT_BYTES = int(os.environ.get("APS_LEDGER_SEGMENT_BYTES", str(8 << 20)))
+SEGMENT_SECONDS = int(os.environ.get("APS_LEDGER_SEGMENT_SECONDS", "0"))   # 0 = solo rotazione per dimensione
+BLOCK_BYTES = int(os.environ.get("APS_LEDGER_BLOCK_BYTES", str(256 << 10)))
+CODEC = os.environ.get("APS_LEDGER_CODEC", "xz").lower()
+
+_CODECS = {
+    "xz": (lambda b: lzma.compress(b, preset=6), lzma.decompress),
+    "gz": (lambda b: gzip.compress(b, compresslevel=6, mtime=0), gzip.decompress),
+}
+
+class SegmentedLog:
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.dir = self.path.parent / f"{self.path.stem}_segments"
+        self.manifest_path = self.dir / "manifest.json"
+        self.lock = threading.RLock()
+        self._manifest: Optional[Dict[str, Any]] = None
+        self._manifest_mtime = None
+        self._blocks: Dict[Tuple[str, int], bytes] = {}   # piccola cache di blocchi decompressi
+        self._active_started: Optional[float] = None
+        self._seal_lock = FileLock(self.dir / "seal.lock")
+        self._seal_state = threading.Lock()
+        self._seal_wanted = False
+        self._sealer: Optional[threading.Thread] = None
+
+    # ---------- manifest ----------
+
+    def manifest(self) -> Dict[str, Any]:
+        try:
+            mtime = self.manifest_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._manifest is None or mtime != self._manifest_mtime:
+            if mtime is None:
+                self._manifest = {"version": 1, "segments": []}
+            else:
+                self._manifest = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def _save_manifest(self, m: Dict[str, Any]):
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(m, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, self.manifest_path)
+        self._manifest, self._manifest_mtime = m, self.manifest_path.stat().st_mtime_ns
+
+    def _sealed(self) -> Tuple[int, int]:
+        """(byte logici, eventi) coperti dai segmenti sigillati."""
+        segs = self.manifest()["segments"]
+        if not segs:
+            return 0, 0
+        last = segs[-1]
+        return last["start"] + last["bytes"], last["firstSeq"] + last["events"]
+
+    def _pending(self, include_sealed: bool = False) -> List[pathlib.Path]:
+        """Segmenti .pending; salvo include_sealed, esclusi quelli già nel manifest (unlink non ancora fatto)."""
+        files = sorted(self.dir.glob("seg-*.pending")) if self.dir.exists() else []
+        if include_sealed or not files:
+            return files
+        m = self.manifest()
+        return [p for p in files if not _in_manifest(p, m)]
+
+    # ---------- lettura ----------
+
+    @staticmethod
+    def _fsize(p: pathlib.Path) -> int:
+        try:
+            return p.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _sources(self) -> List[Tuple[int, pathlib.Path]]:
+        """File in chiaro dopo i sigillati (pending, poi attivo): [(start logico, path)]."""
+        with self.lock:
+            pos, _ = self._sealed()
+            out = []
+            for p in self._pending():
+                out.append((pos, p))
+                pos += self._fsize(p)
+            out.append((pos, self.path))
+            return out
+
+    def size(self) -> int:
+        start, p = self._sources()[-1]
+        return start + self._fsize(p)
+
+    def _block(self, seg: Dict[str, Any], blk: Dict[str, Any]) -> bytes:
+        key = (seg["file"], blk["off"])
+        data = self._blocks.get(key)
+        if data is None:
+            with (self.dir / seg["file"]).open("rb") as f:
+                f.seek(blk["off"])
+                raw = f.read(blk["len"])
+            data = _CODECS[seg.get("codec", "xz")][1](raw)
+            if len(self._blocks) >= 8:
+                self._blocks.pop(next(iter(self._blocks)))
+            self._blocks[key] = data
+        return data
+
+    def read(self, offset: int, max_bytes: int) -> bytes:
+        """Righe complete a partire dall'offset logico (al più ~max_bytes, almeno una riga)."""
+        with self.lock:
+            sealed_bytes, _ = self._sealed()
+            if offset < sealed_bytes:
+                segs = self.manifest()["segments"]
+                seg = segs[bisect.bisect_right([s["start"] for s in segs], offset) - 1]
+                blocks = seg["blocks"]
+                blk = blocks[bisect.bisect_right([b["start"] for b in blocks], offset) - 1]
+                data = self._block(seg, blk)[offset - blk["start"]:]
+                return _trim(data, max_bytes)
+            for start, p in reversed(self._sources()):
+                if offset >= start:
+                    return _read_plain(p, offset - start, max_bytes)
+            return b""
+
+    # ---------- scrittura / rotazione ----------
+
+    def append(self, data: bytes):
+        with self.lock:
+            os.makedirs(self.path.parent, exist_ok=True)
+            with self.path.open("ab") as f:
+                f.write(data)
+            if self._active_started is None:
+                self._active_started = time.time()
+            if self._should_rotate():
+                self.rotate()
+
+    def _should_rotate(self) -> bool:
+        size = self._fsize(self.path)
+        if size == 0:
+            return False
+        if SEGMENT_BYTES and size >= SEGMENT_BYTES:
+            return True
+        return bool(SEGMENT_SECONDS) and self._active_started is not None and time.time() - self._active_started >= SEGMENT_SECONDS
+
+    def rotate(self, wait: bool = False):
+        """Chiude il segmento attivo con un rename atomico in .pending; la compressione a blocchi avviene
+        in background (con wait=True qui, prima di ritornare)."""
+        with self.lock:
+            if self._fsize(self.path) == 0:
+                return
+            os.makedirs(self.dir, exist_ok=True)
+            n = len(self.manifest()["segments"]) + len(self._pending())
+            os.replace(self.path, self.dir / f"seg-{n:06d}.pending")
+            self._active_started = None
+        if wait:
+            self.seal_pending()
+        else:
+            self._seal_async()
+
+    def _seal_async(self):
+        with self._seal_state:
+            self._seal_wanted = True
+            if self._sealer is not None:
+                return
+            self._sealer = threading.Thread(target=self._seal_loop, name=f"aps-seal-{self.path.stem}", daemon=True)
+            self._sealer.start()
+
+    def _seal_loop(self):
+        while True:
+            with self._seal_state:
+                if not self._seal_wanted:
+                    self._sealer = None
+                    return
+                self._seal_wanted = False
+            try:
+                self.seal_pending()
+            except Exception as exc:   # il .pending resta leggibile: lo sigilla la prossima rotazione o il riavvio
+                print(f"[segments] {self.path.name}: sigillatura fallita: {type(exc).__name__}: {exc}", file=sys.stderr)
+
+    def seal_pending(self):
+        """Comprime i segmenti .pending, in ordine (anche dopo un crash a metà rotazione).
+
+        `self.lock` è tenuto solo per leggere e aggiornare il manifest: durante la compressione letture e
+        append proseguono e leggono il .pending in chiaro, che resta valido finché il manifest non lo copre.
+        """
+        with self._seal_lock:
+            while True:
+                with self.lock:
+                    pending = self._pending(include_sealed=True)
+                    if not pending:
+                        return
+                    p = pending[0]
+                    if _in_manifest(p, self.manifest()):
+                        p.unlink()   # già sigillato prima di un crash: resta solo da rimuovere il pending
+                        continue
+                    start, first_seq = self._sealed()
+                seg = self._compress(p, start, first_seq)
+                with self.lock:
+                    m = self.manifest()
+                    self._save_manifest({**m, "segments": m["segments"] + [seg]})
+                    p.unlink()
+
+    def _compress(self, p: pathlib.Path, start: int, first_seq: int) -> Dict[str, Any]:
+        """Scrive il segmento compresso a blocchi di un .pending (immutabile) e ne ritorna la voce di manifest."""
+        data = p.read_bytes()
+        name = f"{p.stem}.jsonl.{CODEC}"
+        blocks, out, off, pos, seq = [], bytearray(), 0, 0, first_seq
+        first_ts = last_ts = None
+        while pos < len(data):
+            end = data.rfind(b"\n", pos, pos + BLOCK_BYTES)
+            if end < 0:
+                end = data.find(b"\n", pos + BLOCK_BYTES)
+                end = len(data) - 1 if end < 0 else end
+            chunk = data[pos:end + 1]
+            lines = [l for l in chunk.splitlines() if l.strip()]
+            comp = _CODECS[CODEC][0](chunk)
+            blocks.append({"off": off, "len": len(comp), "start": start + pos, "bytes": len(chunk),
+                           "firstSeq": seq, "events": len(lines)})
+            if lines:
+                first_ts = first_ts if first_ts is not None else json.loads(lines[0]).get("ts")
+                last_ts = json.loads(lines[-1]).get("ts")
+            out += comp
+            off += len(comp)
+            seq += len(lines)
+            pos = end + 1
+        tmp = self.dir / f"{name}.tmp"
+        with tmp.open("wb") as f:
+            f.write(out)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.dir / name)
+        return {"file": name, "codec": CODEC, "start": start, "bytes": len(data), "compressedBytes": len(out),
+                "firstSeq": first_seq, "events": seq - first_seq, "firstTs": first_ts, "lastTs": last_ts,
+                "sealedAt": int(time.time()), "blocks": blocks}
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            segs = self.manifest()["segments"]
+            return {
+                "segments": len(segs),
+                "sealedBytes": sum(s["bytes"] for s in segs),
+                "compressedBytes": sum(s["compressedBytes"] for s in segs),
+                "activeBytes": self._fsize(self.path),
+                "pending": len(self._pending()),
+                "codec": CODEC,
+            }
+
+def _in_manifest(p: pathlib.Path, m: Dict[str, Any]) -> bool:
+    return any(seg["file"].startswith(f"{p.stem}.") for seg in m["segments"])
+
+def _trim(data: bytes, max_bytes: int) -> bytes:
+    if len(data) <= max_bytes:
+        return data
+    end = data.rfind(b"\n", 0, max_bytes)
+    if end < 0:
+        end = data.find(b"\n")
+    return data[:end + 1] if end >= 0 else b""
+
+def _read_plain(p: pathlib.Path, offset: int, max_bytes: int) -> bytes:
+    try:
+        f = p.open("rb")
+    except FileNotFoundError:
+        return b""
+    with f:
+        f.seek(offset)
+        data = f.read(max_bytes)
+        if data and not data.endswith(b"\n"):
+            # estendi fino a fine riga se la prima riga è più lunga di max_bytes
+            end = data.rfind(b"\n")
+            if end >= 0:
+                return data[:end + 1]
+            data += f.readline()
+            return data if data.endswith(b"\n") else b""
+        return data
@@ -0,0 +1,139 @@
+# backend/sessions.py
+"""Token di sessione stateless firmati HMAC-SHA256.
+
+Formato: v1.<kid>.<payload b64url>.<mac b64url>, payload = {"uid","role","iat","exp","jti"}.
+La verifica usa la memoria (keyring + lista di revoca) e uno stat del file delle chiavi, nessun accesso a
+store.json: se un altro processo (worker, follower) ha scritto chiavi o revoche, il file è riletto.
+Le chiavi ruotano ogni APS_SESSION_ROTATE_S; le precedenti restano valide finché
+possono esistere token firmati con esse (rotazione + TTL).
+Il file contiene i segreti HMAC: permessi 0600, fuori da git, percorso configurabile con APS_SESSION_KEYS.
+"""
+import base64, hashlib, hmac, json, os, pathlib, secrets, threading, time
+from typing import Any, Dict, Optional
+
+from filelock import FileLock
+
+KEYS_FILE = pathlib.Path(os.environ.get("APS_SESSION_KEYS") or pathlib.Path(__file__).parent / "session_keys.json")
+TTL_S = int(os.environ.get("APS_SESSION_TTL_S", str(8 * 3600)))
+ROTATE_S = int(os.environ.get("APS_SESSION_ROTATE_S", str(24 * 3600)))
+
+class InvalidToken(Exception):
+    pass
+
+_lock = threading.Lock()
+_keys: Dict[str, Dict[str, Any]] = {}   # kid -> {"secret": bytes, "createdAt": int}
+_current: Optional[str] = None
+_revoked: Dict[str, int] = {}            # jti -> exp (basta tenerli fino alla scadenza)
+_mtime: Optional[int] = None             # mtime_ns del file all'ultima lettura
+_file_lock = FileLock(KEYS_FILE.with_name(KEYS_FILE.name + ".lock"))   # scritture tra processi
+
+def _b64u(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+def _b64u_dec(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+def _sync():
+    """Unisce chiavi e revoche del file se è cambiato dall'ultima lettura (scritto anche da altri processi)."""
+    global _current, _mtime
+    try:
+        mtime = KEYS_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == _mtime:
+        return
+    db = json.loads(KEYS_FILE.read_text(encoding="utf-8"))
+    for kid, k in db.get("keys", {}).items():
+        _keys.setdefault(kid, {"secret": _b64u_dec(k["secret"]), "createdAt": k["createdAt"]})
+    _revoked.update(db.get("revoked", {}))
+    if db.get("current") in _keys:
+        _current = db["current"]
+    _mtime = mtime
+
+def _load():
+    _sync()
+    if _current not in _keys:
+        with _file_lock:
+            _sync()
+            if _current not in _keys:
+                _rotate()
+
+def _save():
+    """Riscrive il file (0600, temporaneo + replace) sotto il lock, dopo aver unito le scritture altrui;
+    scarta chiavi e revoche che non possono più servire."""
+    global _current, _mtime
+    with _file_lock:
+        current = _current
+        _sync()
+        _current = current
+        now = int(time.time())
+        for old in [k for k, v in _keys.items() if k != _current and now - v["createdAt"] > ROTATE_S + TTL_S]:
+            del _keys[old]
+        for jti in [j for j, exp in _revoked.items() if exp < now]:
+            del _revoked[jti]
+        db = {
+            "current": _current,
+            "keys": {kid: {"secret": _b64u(k["secret"]), "createdAt": k["createdAt"]} for kid, k in _keys.items()},
+            "revoked": _revoked,
+        }
+        tmp = KEYS_FILE.with_name(KEYS_FILE.name + ".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json.dumps(db, indent=2))
+        os.replace(tmp, KEYS_FILE)
+        _mtime = KEYS_FILE.stat().st_mtime_ns
+
+def _rotate():
+    """Nuova chiave corrente; elimina quelle che non possono più validare token non scaduti."""
+    global _current
+    now = int(time.time())
+    kid = secrets.token_hex(4)
+    _keys[kid] = {"secret": secrets.token_bytes(32), "createdAt": now}
+    _current = kid
+    _save()
+
+def _mac(secret: bytes, msg: str) -> bytes:
+    return hmac.new(secret, msg.encode("ascii"), hashlib.sha256).digest()
+
+def issue(uid: str, role: str) -> Dict[str, Any]:
+    with _lock:
+        _load()
+        if int(time.time()) - _keys[_current]["createdAt"] >= ROTATE_S:
+            _rotate()
+        kid, secret = _current, _keys[_current]["secret"]
+    now = int(time.time())
+    claims = {"uid": uid, "role": role, "iat": now, "exp": now + TTL_S, "jti": secrets.token_hex(8)}
+    body = f"v1.{kid}.{_b64u(json.dumps(claims, separators=(',', ':')).encode('utf-8'))}"
+    return {"token": f"{body}.{_b64u(_mac(secret, body))}", "expiresAt": claims["exp"]}
+
+def verify(token: str) -> Dict[str, Any]:
+    """Claims del token, oppure InvalidToken: HMAC + scadenza + lista di revoca (riletta se il file cambia)."""
+    try:
+        ver, kid, payload, mac = token.split(".")
+    except ValueError:
+        raise InvalidToken("malformed token")
+    with _lock:
+        _load()
+        key = _keys.get(kid)
+    if ver != "v1" or key is None:
+        raise InvalidToken("unknown token key")
+    try:
+        if not hmac.compare_digest(_mac(key["secret"], f"{ver}.{kid}.{payload}"), _b64u_dec(mac)):
+            raise InvalidToken("bad token signature")
+        claims = json.loads(_b64u_dec(payload))
+    except (ValueError, UnicodeError):
+        raise InvalidToken("malformed token")
+    if claims.get("exp", 0) < time.time():
+        raise InvalidToken("token expired")
+    with _lock:
+        revoked = claims.get("jti") in _revoked
+    if revoked:
+        raise InvalidToken("token revoked")
+    return claims
+
+def revoke(claims: Dict[str, Any]):
+    """Nega un token prima della scadenza (logout)."""
+    with _lock:
+        _load()
+        _revoked[claims["jti"]] = int(claims.get("exp", time.time()))
+        _save()
@@ -0,0 +1,53 @@
+# backend/singleflight.py
+"""Coalescenza di richieste identiche concorrenti (single-flight).
+
+Mentre un calcolo per una chiave è in corso, le chiamate con la stessa chiave
+attendono e ricevono lo stesso risultato (o la stessa eccezione) invece di ripeterlo.
+"""
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+class _Call:
+    __slots__ = ("done", "result", "exc")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc = None
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.executed = 0    # calcoli effettivamente eseguiti
+        self.coalesced = 0   # richieste servite dal calcolo di un'altra
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.exc is not None:
+                raise call.exc
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as exc:
+            call.exc = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"executed": self.executed, "coalesced": self.coalesced, "inFlight": len(self._calls)}
@@ -0,0 +1,431 @@
+# backend/synth.py
+"""Generatore di dataset sintetici per test di carico e di capacità.
+
+Uso (dalla cartella backend, a server fermo):
+    python synth.py                                          # dataset piccolo con i default
+    python synth.py --labs 20 --patients 50000 --hospitals 200 --doctors 2000 --reports-per-lab 15000
+    python synth.py --reports-per-lab 500 --prefix T1 --seed 7 --processes 8 --key-bits 2048
+Dal server (dev): POST /api/dev/synth con gli stessi parametri in camelCase e header X-Admin-Token
+(limite APS_SYNTH_MAX_REPORTS).
+
+Crea attori LAB/PAT/HOSP/DOC (con utente di login, password "synth"), referti per lab con fan-out casuale
+di GRANT verso HOSP/DOC, catene di UPDATE e revoche, su un arco di `days` giorni che termina adesso e non
+inizia prima dell'ultimo evento già nel ledger (as_of presuppone ts non decrescenti): se l'arco si accorcia
+il riepilogo lo segnala in `warnings`, se non resta nulla la generazione è rifiutata.
+
+- Chiavi: pool pre-generato e riusato tra le esecuzioni (`keypool-<bits>.bin`, stesso formato del keystore,
+  generato in parallelo). L'attore riceve la coppia scelta da crc32(actorId): più attori condividono la
+  stessa chiave (solo dati di test) ed entrano nel keystore con un solo append.
+- Envelope, aperture SD, firma del lab (una radice di Merkle per lab e lotto, come /lab/emit_batch), wrap e
+  firme dei GRANT sono calcolati da un pool di processi, a lotti di CHUNK referti.
+- Il processo principale riordina gli eventi per ts (restano in memoria solo quelli differiti: UPDATE,
+  REVOKE e i loro GRANT), li accoda agli shard del ledger a blocchi di APPEND_BYTES senza aggiornare gli
+  indici e scrive store.json una volta sola alla fine (dalla CLI in streaming, dagli envelope in spool),
+  sotto lo stesso `store.lock` degli altri scrittori.
+"""
+import argparse, heapq, json, os, pathlib, random, sys, tempfile, time, zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from werkzeug.security import generate_password_hash
+
+import keystore
+import ledger
+from filelock import FileLock
+from apscrypto import (
+    commit_fields,
+    encrypt_for_recipients,
+    gen_rsa_keypair,
+    leaf_hash,
+    load_private_der,
+    load_public_der,
+    merkle_path,
+    merkle_root,
+    merkle_tree,
+    private_der,
+    public_der,
+    root_message,
+    sd_message,
+    sha256_bytes,
+    sign_bytes,
+)
+from apscrypto.hybrid import _wrap_key
+from apscrypto.utils import b64d, b64e, dumps
+
+APP_DIR = pathlib.Path(__file__).parent
+STORE_FILE = APP_DIR / "store.json"
+USERS_BLOOM_FILE = APP_DIR / "users.bloom.json"   # filtro degli username del server (app.py)
+KEYPOOL_DIR = pathlib.Path(os.environ.get("APS_KEYPOOL_DIR", str(APP_DIR)))
+CHUNK = 256                  # referti per task del pool di processi
+APPEND_BYTES = 8 << 20       # righe NDJSON accumulate per shard prima di un append
+DAY_S = 86400
+PASSWORD = "synth"
+
+DEFAULTS: Dict[str, Any] = {
+    "labs": 5, "patients": 1000, "hospitals": 20, "doctors": 100, "reportsPerLab": 200,
+    "maxFanout": 3,          # GRANT per versione: da 0 a maxFanout destinatari (HOSP/DOC)
+    "updateRate": 0.1,       # frazione di referti con una catena di UPDATE
+    "maxChain": 3,           # versioni aggiunte al massimo per catena
+    "revokeRate": 0.03,      # frazione di referti revocati (sulla versione corrente)
+    "days": 365.0,           # arco temporale delle emissioni (fino ad adesso)
+    "maxDelayDays": 30.0,    # ritardo massimo di UPDATE/REVOKE rispetto alla versione precedente
+    "seed": 1, "prefix": "SYN", "poolSize": 32, "keyBits": 3072, "processes": 0,
+}
+EXAMS = (("Emocromo", "g/dL", 12.0, 17.0), ("Glicemia", "mg/dL", 70.0, 140.0),
+         ("Colesterolo LDL", "mg/dL", 60.0, 190.0), ("TSH", "mUI/L", 0.3, 5.0), ("Creatinina", "mg/dL", 0.5, 1.4))
+
+class SynthError(ValueError):
+    pass
+
+def params(raw: Dict[str, Any]) -> Dict[str, Any]:
+    p = {**DEFAULTS, **{k: v for k, v in raw.items() if k in DEFAULTS and v is not None}}
+    try:
+        for k, default in DEFAULTS.items():
+            p[k] = type(default)(p[k])
+    except (TypeError, ValueError) as exc:
+        raise SynthError(f"parametro non valido: {exc}")
+    p["prefix"] = p["prefix"].strip().upper()
+    if not p["prefix"].isalnum():
+        raise SynthError("prefix deve essere alfanumerico")
+    if min(p["labs"], p["patients"], p["reportsPerLab"], p["poolSize"]) < 1 or p["hospitals"] + p["doctors"] < 1:
+        raise SynthError("servono almeno un lab, un paziente, un referto per lab, un destinatario e una chiave nel pool")
+    if not (0 <= p["updateRate"] <= 1 and 0 <= p["revokeRate"] <= 1) or min(p["maxFanout"], p["maxChain"]) < 0:
+        raise SynthError("updateRate/revokeRate in [0, 1], maxFanout/maxChain >= 0")
+    if p["keyBits"] < 2048 or p["days"] < 0 or p["maxDelayDays"] < 0:
+        raise SynthError("keyBits >= 2048, days/maxDelayDays >= 0")
+    p["processes"] = p["processes"] or os.cpu_count() or 1
+    return p
+
+# -------------------- pool di chiavi --------------------
+
+def _gen_pair(bits: int) -> Tuple[bytes, bytes]:
+    priv, pub = gen_rsa_keypair(bits)
+    return public_der(pub), private_der(priv)
+
+def key_pool(size: int, bits: int, processes: int) -> List[Tuple[bytes, bytes]]:
+    """Coppie (pub DER, priv DER) del pool; genera in parallelo solo quelle che mancano."""
+    ks = keystore.Keystore(KEYPOOL_DIR / f"keypool-{bits}.bin")
+    have = len(ks.actors())
+    if have < size:
+        with ProcessPoolExecutor(max_workers=processes) as ex:
+            pairs = list(ex.map(_gen_pair, [bits] * (size - have)))
+        ks.put_many((f"POOL-{have + i:05d}", pub, priv) for i, (pub, priv) in enumerate(pairs))
+    return [(ks.public_der(f"POOL-{i:05d}"), ks.private_der(f"POOL-{i:05d}")) for i in range(size)]
+
+def _slot(actor: str, n: int) -> int:
+    return zlib.crc32(actor.encode("utf-8")) % n
+
+# -------------------- piano (deterministico dato il seed) --------------------
+
+def _actor_ids(p: Dict[str, Any]) -> Dict[str, List[str]]:
+    pre = p["prefix"]
+    return {role: [f"{role}-{pre}{i:06d}" for i in range(p[key])]
+            for role, key in (("LAB", "labs"), ("PAT", "patients"), ("HOSP", "hospitals"), ("DOC", "doctors"))}
+
+def _plan(p: Dict[str, Any], actors: Dict[str, List[str]], start: int, end: int) -> Iterator[Dict[str, Any]]:
+    """Specifiche dei referti in ordine di emissione: versioni (ts, destinatari dei GRANT) ed eventuale revoca."""
+    rng = random.Random(p["seed"])
+    recipients = actors["HOSP"] + actors["DOC"]
+    n = p["labs"] * p["reportsPerLab"]
+    max_delay = max(3600, int(p["maxDelayDays"] * DAY_S))
+    for i in range(n):
+        ts = start + (end - start) * i // n
+        rid = f"{p['prefix']}-R{i:08d}"
+        chain = rng.randint(1, p["maxChain"]) if p["maxChain"] and rng.random() < p["updateRate"] else 0
+        versions = []
+        for v in range(chain + 1):
+            if v:
+                ts = min(end, ts + rng.randint(3600, max_delay))
+            versions.append({"rid": rid if v == 0 else f"{rid}-v{v + 1}", "ts": ts,
+                             "grants": rng.sample(recipients, rng.randint(0, min(p["maxFanout"], len(recipients)))),
+                             "exam": rng.randrange(len(EXAMS)), "value": round(rng.random(), 3)})
+        revoke_ts = min(end, ts + rng.randint(600, max_delay)) if rng.random() < p["revokeRate"] else None
+        yield {"lab": actors["LAB"][rng.randrange(len(actors["LAB"]))],
+               "patient": actors["PAT"][rng.randrange(len(actors["PAT"]))],
+               "versions": versions, "revokeTs": revoke_ts}
+
+# -------------------- worker: envelope, firme, eventi --------------------
+
+_W: Dict[str, Any] = {}
+
+def _worker_init(pool: List[Tuple[bytes, bytes]]):
+    _W.update(pool=pool, pub={}, priv={})
+
+def _key(actor: str, kind: str):
+    i = _slot(actor, len(_W["pool"]))
+    cache = _W[kind]
+    if i not in cache:
+        pub, priv = _W["pool"][i]
+        cache[i] = load_public_der(pub) if kind == "pub" else load_private_der(priv)
+    return cache[i]
+
+def _line(event: Dict[str, Any], ts: int) -> bytes:
+    """Stessa serializzazione di ledger._append, con ts esplicito."""
+    ev = {"ts": ts, **event}
+    ev["txId"] = ledger.tx_id_of(ev)
+    return (json.dumps(ev, ensure_ascii=False, separators=(",", ":"), sort_keys=True) + "\n").encode("utf-8")
+
+def _lab_message(env: Dict[str, Any]) -> bytes:
+    return sha256_bytes(b64d(env["ciphertext"])) + dumps(env["aad"]).encode("utf-8")
+
+def _build_chunk(specs: List[Dict[str, Any]]) -> Tuple[List[str], List[Tuple[int, int, str, bytes]]]:
+    """Envelope serializzati ('"reportId":{...}') ed eventi (ts, ordine, famiglia, riga NDJSON) di un lotto."""
+    built = []   # (spec, versione, envelope, chiave AES)
+    for spec in specs:
+        lab, pat = spec["lab"], spec["patient"]
+        for ver in spec["versions"]:
+            exam, unit, lo, hi = EXAMS[ver["exam"]]
+            issued_at = datetime.fromtimestamp(ver["ts"], timezone.utc).isoformat()
+            aad = {"reportId": ver["rid"], "labId": lab, "patientRef": pat, "issuedAt": issued_at,
+                   "examType": exam, "resultShort": "nella norma" if ver["value"] < 0.8 else "fuori range"}
+            content = {"esame": exam, "valore": round(lo + (hi - lo) * ver["value"], 2), "unita": unit}
+            aes_key = AESGCM.generate_key(bit_length=256)
+            env = encrypt_for_recipients(json.dumps(content).encode("utf-8"), aad, {pat: _key(pat, "pub")},
+                                         aes_key=aes_key)
+            # come _seal_sd in app.py: impegni su campi AAD + content.*, aperture cifrate con la chiave del referto
+            fields = {**aad, **{f"content.{k}": v for k, v in content.items()}}
+            root, openings = commit_fields(fields)
+            nonce = os.urandom(12)
+            sealed = AESGCM(aes_key).encrypt(nonce, dumps(openings).encode("utf-8"), f"APS-SD|{ver['rid']}".encode("utf-8"))
+            env["sd"] = {"root": root, "fields": sorted(fields), "openings": b64e(nonce + sealed)}
+            built.append((spec, ver, env, aes_key))
+
+    # una firma per lab nel lotto: foglie H(ct)||AAD poi radici SD, come /lab/emit_batch
+    by_lab: Dict[str, List[Dict[str, Any]]] = {}
+    for spec, _, env, _ in built:
+        by_lab.setdefault(spec["lab"], []).append(env)
+    for lab, envs in by_lab.items():
+        n = len(envs)
+        levels = merkle_tree([leaf_hash(_lab_message(e)) for e in envs] +
+                             [leaf_hash(sd_message(e["sd"]["root"])) for e in envs])
+        root = merkle_root(levels).hex()
+        sig = sign_bytes(_key(lab, "priv"), root_message(root))
+        for i, env in enumerate(envs):
+            env["sig_lab"] = sig
+            env["batch"] = {"root": root, "path": merkle_path(levels, i)}
+            env["sd"].update({"sig": sig, "batch": {"root": root, "path": merkle_path(levels, n + i)}})
+
+    envelopes: List[str] = []
+    events: List[Tuple[int, int, str, bytes]] = []
+
+    def emit(ts: int, family: str, event: Dict[str, Any]):
+        events.append((ts, len(events), family, _line(event, ts)))
+
+    prev = None
+    for spec, ver, env, aes_key in built:
+        family, lab, pat, rid, ts = spec["versions"][0]["rid"], spec["lab"], spec["patient"], ver["rid"], ver["ts"]
+        envelopes.append(json.dumps(rid) + ":" + json.dumps(env, ensure_ascii=False, separators=(",", ":")))
+        emit(ts, family, {"type": "PUBLISH_REPORT", "reportId": rid, "labId": lab, "patientRef": pat,
+                          "hash": sha256_bytes(b64d(env["ciphertext"])).hex(), "sig_lab": env["sig_lab"],
+                          "issuedAt": env["aad"]["issuedAt"], "batch": env["batch"], "sdRoot": env["sd"]["root"]})
+        if rid != family:
+            emit(ts, family, {"type": "UPDATE_REPORT", "oldReportId": prev, "newReportId": rid, "labId": lab})
+        for to in ver["grants"]:
+            grant = {"reportId": rid, "from": pat, "to": to, "ek_to": _wrap_key(_key(to, "pub"), aes_key)}
+            grant["sig_pat"] = sign_bytes(_key(pat, "priv"), dumps(grant).encode("utf-8"))
+            emit(ts, family, {"type": "GRANT", **grant})
+        prev = rid
+        if ver is spec["versions"][-1] and spec["revokeTs"] is not None:
+            emit(max(spec["revokeTs"], ts), family,
+                 {"type": "REVOKE_REPORT", "reportId": rid, "labId": lab, "reason": "revoca sintetica"})
+    return envelopes, events
+
+# -------------------- generazione --------------------
+
+def _chunks(it: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _users(p: Dict[str, Any], actors: Dict[str, List[str]]) -> Dict[str, Dict[str, Any]]:
+    pw = generate_password_hash(PASSWORD)
+    pre = p["prefix"].lower()
+    out = {}
+    for role, ids in actors.items():
+        for i, uid in enumerate(ids):
+            username = f"{pre}-{role.lower()}-{i}"
+            out[username] = {"uid": uid, "role": role, "displayName": f"{role} sintetico {i}",
+                             "email": f"{username}@example.com", "password": pw, "hasKeys": True}
+    return out
+
+def generate(raw: Dict[str, Any],
+             load_db: Optional[Callable[[], Dict[str, Any]]] = None,
+             save_db: Optional[Callable[[Dict[str, Any]], None]] = None,
+             progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+             store_lock: Any = None) -> Dict[str, Any]:
+    """
+    Genera il dataset descritto da `raw` (chiavi di DEFAULTS) e ritorna un riepilogo con conteggi e tempi.
+    Con load_db/save_db (server) lo store si aggiorna in memoria; senza, store.json è riscritto in streaming.
+    La scrittura finale avviene sotto `store_lock` (dal server il suo STORE_LOCK, dalla CLI `store.lock`).
+    """
+    p = params(raw)
+    t0 = time.perf_counter()
+    actors = _actor_ids(p)
+    envelopes_before = (load_db() if load_db else _load_store()).get("envelopes", {})
+    if f"{p['prefix']}-R{0:08d}" in envelopes_before:
+        raise SynthError(f"prefix {p['prefix']} già usato in store.json")
+    del envelopes_before
+
+    pool = key_pool(p["poolSize"], p["keyBits"], p["processes"])
+    ks = keystore.store()
+    new_keys = []
+    for ids in actors.values():
+        for a in ids:
+            pub, priv = pool[_slot(a, len(pool))]
+            if not ks.has(a):
+                new_keys.append((a, pub, priv))
+            elif ks.public_der(a) != pub:
+                raise SynthError(f"{a} esiste già con un'altra chiave: usare un altro prefix")
+    ks.put_many(new_keys)
+    t_keys = time.perf_counter()
+
+    end = int(time.time())
+    wanted = end - int(p["days"] * DAY_S)
+    last = ledger.last_ts()
+    start = min(end, max(wanted, last))
+    warnings: List[str] = []
+    if start > wanted:
+        if start >= end:
+            raise SynthError("il ledger ha già eventi fino ad adesso: nessun arco temporale libero per i ts (riprovare più tardi)")
+        warnings.append(f"arco ridotto a {(end - start) / DAY_S:.4g} giorni invece di {p['days']:g}: il ledger ha già "
+                        f"eventi fino a {datetime.fromtimestamp(last, timezone.utc).isoformat()} e i ts non possono decrescere")
+    counts = {"reports": 0, "versions": 0, "events": 0}
+    heap: List[Tuple[int, int, int, int, bytes]] = []   # (ts, lotto, ordine, shard, riga) non ancora scritti
+    bufs: Dict[int, List[bytes]] = {}
+    buf_bytes: Dict[int, int] = {}
+    spool = tempfile.TemporaryFile(dir=APP_DIR)
+    last_report = [t0]
+
+    def write(shard: int, line: bytes):
+        bufs.setdefault(shard, []).append(line)
+        buf_bytes[shard] = buf_bytes.get(shard, 0) + len(line)
+        counts["events"] += 1
+        if buf_bytes[shard] >= APPEND_BYTES:
+            ledger.append_raw(b"".join(bufs.pop(shard)), shard, refresh=False)
+            buf_bytes[shard] = 0
+
+    def flush(until: Optional[int]):
+        while heap and (until is None or heap[0][0] < until):
+            _, _, _, shard, line = heapq.heappop(heap)
+            write(shard, line)
+
+    def collect(k: int, specs: List[Dict[str, Any]], result):
+        envelopes, events = result
+        spool.write(("\n".join(envelopes) + "\n").encode("utf-8"))
+        for ts, seq, family, line in events:
+            heapq.heappush(heap, (ts, k, seq, ledger.shard_of(family), line))
+        counts["reports"] += len(specs)
+        counts["versions"] += len(envelopes)
+        # i lotti successivi non emettono nulla prima della prima versione del loro primo referto
+        flush(specs[-1]["versions"][0]["ts"])
+        now = time.perf_counter()
+        if progress is not None and now - last_report[0] >= 2.0:
+            last_report[0] = now
+            progress({**counts, "pending": len(heap), "elapsed_s": round(now - t0, 1)})
+
+    with ProcessPoolExecutor(max_workers=p["processes"], initializer=_worker_init, initargs=(pool,)) as ex:
+        inflight: List[Tuple[int, List[Dict[str, Any]], Any]] = []
+        for k, specs in enumerate(_chunks(_plan(p, actors, start, end), CHUNK)):
+            inflight.append((k, specs, ex.submit(_build_chunk, specs)))
+            # finestra limitata di lotti in volo: memoria costante anche per milioni di eventi
+            while len(inflight) > 2 * p["processes"]:
+                kk, ss, fut = inflight.pop(0)
+                collect(kk, ss, fut.result())
+        for kk, ss, fut in inflight:
+            collect(kk, ss, fut.result())
+    flush(None)
+    for shard, buf in bufs.items():
+        ledger.append_raw(b"".join(buf), shard, refresh=False)
+    t_ledger = time.perf_counter()
+
+    spool.seek(0)
+    users = _users(p, actors)
+    with store_lock if store_lock is not None else FileLock(STORE_FILE.with_name("store.lock")):
+        if load_db and save_db:
+            db = load_db()
+            for raw_line in spool:
+                rid, _, env = raw_line.decode("utf-8").partition(":")
+                db["envelopes"][json.loads(rid)] = json.loads(env)
+            for username, rec in users.items():
+                db["actors"].setdefault(username, rec)
+            save_db(db)
+        else:
+            _stream_store(spool, users)
+    spool.close()
+    t_end = time.perf_counter()
+    return {
+        "params": p,
+        "actors": {role: len(ids) for role, ids in actors.items()},
+        "users": sorted(users)[:4] + (["..."] if len(users) > 4 else []),
+        "newKeys": len(new_keys),
+        "timeline": {"from": start, "to": end, "days": round((end - start) / DAY_S, 4), "requestedDays": p["days"]},
+        "warnings": warnings,
+        **counts,
+        "timings_s": {"keys": round(t_keys - t0, 2), "ledger": round(t_ledger - t_keys, 2),
+                      "store": round(t_end - t_ledger, 2), "total": round(t_end - t0, 2)},
+        "eventsPerSecond": round(counts["events"] / max(t_ledger - t_keys, 1e-9), 1),
+    }
+
+# -------------------- store.json (CLI) --------------------
+
+def _load_store() -> Dict[str, Any]:
+    if STORE_FILE.exists():
+        return json.loads(STORE_FILE.read_text(encoding="utf-8"))
+    return {"envelopes": {}, "actors": {}, "revoked": {}}
+
+def _stream_store(spool, users: Dict[str, Dict[str, Any]]):
+    """Riscrive store.json accodando gli envelope in spool senza materializzarli (file temporaneo + replace)."""
+    db = _load_store()
+    for username, rec in users.items():
+        db["actors"].setdefault(username, rec)
+    tmp = STORE_FILE.with_suffix(".synth.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write('{"envelopes": {')
+        sep = ""
+        for rid, env in db.pop("envelopes", {}).items():
+            f.write(sep + json.dumps(rid) + ":" + json.dumps(env, ensure_ascii=False))
+            sep = ",\n"
+        for raw_line in spool:
+            f.write(sep + raw_line.decode("utf-8").rstrip("\n"))
+            sep = ",\n"
+        f.write("}")
+        for key, value in db.items():
+            f.write(f",\n{json.dumps(key)}: " + json.dumps(value, ensure_ascii=False, indent=2))
+        f.write("}\n")
+    os.replace(tmp, STORE_FILE)
+    USERS_BLOOM_FILE.unlink(missing_ok=True)   # utenti nuovi: il server ricostruisce il filtro al primo login
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Generatore di dataset sintetici APS")
+    for key, default in DEFAULTS.items():
+        flag = "--" + "".join("-" + c.lower() if c.isupper() else c for c in key)
+        ap.add_argument(flag, dest=key, type=type(default), default=None,
+                        help="default: numero di CPU" if key == "processes" else f"default: {default}")
+    ap.add_argument("--quiet", action="store_true", help="niente avanzamento su stderr")
+    args = vars(ap.parse_args(argv))
+    quiet = args.pop("quiet")
+
+    def progress(st: Dict[str, Any]):
+        print(f"[synth] referti {st['reports']}  eventi {st['events']}  in attesa {st['pending']}  "
+              f"{st['events'] / max(st['elapsed_s'], 1e-9):.0f} ev/s", file=sys.stderr)
+
+    ledger.seal_pending()   # a server fermo nessun altro completa una rotazione interrotta
+    try:
+        summary = generate(args, progress=None if quiet else progress)
+    except SynthError as exc:
+        print(f"errore: {exc}", file=sys.stderr)
+        return 2
+    finally:
+        ledger.seal_pending()   # i segmenti ruotati durante la generazione si comprimono in background
+    for w in summary["warnings"]:
+        print(f"avviso: {w}", file=sys.stderr)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
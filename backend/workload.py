@@ -0,0 +1,425 @@
+# backend/workload.py
+"""Registrazione del traffico reale e replay deterministico contro una nuova build.
+
+Registrazione (opt-in, nel livello di `measure`): APS_RECORD=1 all'avvio del server oppure
+POST /api/workload/record {"action": "start"} (admin). Ogni richiesta misurata diventa una riga di una
+traccia NDJSON compressa (`traces/trace-AAAAMMGG-HHMMSS.ndjson.gz`):
+    {"t": ms dall'inizio, "m": metodo, "p": path?query, "r": route, "st": status, "ms": latenza,
+     "in": byte richiesta, "out": byte risposta, "b": corpo JSON}
+Nei corpi restano in chiaro solo le stringhe dei campi in KEEP_KEYS (identificativi e parametri delle route);
+ogni altra stringa (password, token, PEM, `content`, campi AAD come `examType`/`resultShort`/`note`, nomi,
+email...) è sostituita da {"$redacted": lunghezza}. Nei sottoalberi di SENSITIVE_KEYS (`envelope`, `aad`,
+`disclosure`, `fields`...) sono redatti anche i numeri; restano i nomi dei campi. Il replay rimette un
+riempitivo della stessa lunghezza (0 per i numeri), quindi dimensioni e costo crittografico restano quelli
+registrati (i login falliscono: per il replay usare APS_AUTH=optional e utenti con password nota, es. quelli
+di synth.py). Le righe passano da una
+coda limitata a un thread di scrittura: la richiesta non attende mai il disco (coda piena → riga scartata).
+
+Replay e confronto (dalla cartella backend):
+    python workload.py replay traces/trace-....ndjson.gz                     # test client in-process
+    python workload.py replay TRACE --target http://127.0.0.1:8000 --concurrency 32 --time-scale 2
+    python workload.py replay TRACE --time-scale 0 --out run.json            # a ciclo chiuso, più veloce possibile
+    python workload.py diff baseline.json run.json --threshold 10            # exit 1 se ci sono regressioni
+Le richieste partono nell'ordine della traccia, ciascuna a t / time-scale dall'inizio (0 = senza attese).
+Il report ha latenze p50/p95/p99 e throughput per route, errori (5xx o connessione) e status diversi da quelli
+registrati. Il replay scrive: va fatto su una copia dei dati.
+"""
+import argparse, gzip, json, os, pathlib, queue, sys, threading, time, zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+APP_DIR = pathlib.Path(__file__).parent
+TRACE_DIR = pathlib.Path(os.environ.get("APS_TRACE_DIR", str(APP_DIR / "traces")))
+QUEUE_MAX = int(os.environ.get("APS_RECORD_QUEUE", "10000"))
+FLUSH_S = 1.0
+TRACE_VERSION = 1
+# allow-list: campi i cui valori (stringhe, anche in liste) restano in chiaro nella traccia
+KEEP_KEYS = frozenset({
+    "reportId", "oldReportId", "newReportId", "labId", "patientRef", "patientId", "hospitalId", "actorId",
+    "ownerId", "groupId", "from", "to", "ids", "actors", "members", "add", "remove", "subsetKeys",
+    "username", "role", "format", "action", "prefix", "sdRoot",
+})
+# sottoalberi con dati clinici o crittografici: dentro sono redatti anche i numeri (tranne i campi di KEEP_KEYS)
+SENSITIVE_KEYS = frozenset({"envelope", "envelopes", "aad", "disclosure", "fields", "sd", "batch"})
+SKIP_ROUTES = ("/api/workload/record",)
+FILLER = "A"   # base64 valido per lunghezze multiple di 4 (content con contentIsBase64)
+
+class Busy(Exception):
+    pass
+
+def redact(obj: Any, keep: bool = False, deep: bool = False) -> Any:
+    """Copia di un corpo JSON in cui resta in chiaro solo ciò che KEEP_KEYS ammette (vedi docstring del modulo)."""
+    if isinstance(obj, dict):
+        return {k: redact(v, k in KEEP_KEYS, deep or k in SENSITIVE_KEYS) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [redact(v, keep, deep) for v in obj]
+    if keep or obj is None or isinstance(obj, bool):
+        return obj
+    if isinstance(obj, str):
+        return {"$redacted": len(obj)}
+    return {"$redacted": len(str(obj)), "type": "number"} if deep else obj
+
+def unredact(obj: Any) -> Any:
+    """Corpo da inviare nel replay: ogni {"$redacted": n} diventa un riempitivo di n caratteri (0 se numero)."""
+    if isinstance(obj, dict):
+        if "$redacted" in obj and set(obj) <= {"$redacted", "type"}:
+            return 0 if obj.get("type") == "number" else FILLER * int(obj["$redacted"])
+        return {k: unredact(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [unredact(v) for v in obj]
+    return obj
+
+def _status_size(rv: Any) -> Tuple[int, Optional[int]]:
+    """Status e byte della risposta da un valore di ritorno Flask (Response, tupla o stringa)."""
+    if rv is None:
+        return 500, None   # eccezione nel handler
+    resp, status = rv, None
+    if isinstance(rv, tuple):
+        resp = rv[0]
+        if len(rv) > 1 and isinstance(rv[1], int):
+            status = rv[1]
+    if isinstance(resp, (str, bytes)):
+        return status or 200, len(resp.encode("utf-8") if isinstance(resp, str) else resp)
+    size = getattr(resp, "content_length", None)
+    if size is None and not getattr(resp, "direct_passthrough", True):
+        size = len(resp.get_data())
+    return status or getattr(resp, "status_code", 200), size
+
+# -------------------- registrazione --------------------
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False       # letto senza lock nel percorso caldo di measure
+        self.path: Optional[pathlib.Path] = None
+        self.q: "queue.Queue[Optional[str]]" = queue.Queue(maxsize=QUEUE_MAX)
+        self.thread: Optional[threading.Thread] = None
+        self.t0 = 0.0
+        self.started_at: Optional[float] = None
+        self.recorded = 0
+        self.dropped = 0
+
+    def start(self, path: Optional[str] = None) -> pathlib.Path:
+        with self.lock:
+            if self.active:
+                raise Busy(f"registrazione già attiva su {self.path}")
+            if path:
+                self.path = pathlib.Path(path)
+            else:
+                self.path = TRACE_DIR / time.strftime("trace-%Y%m%d-%H%M%S.ndjson.gz")
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.q = queue.Queue(maxsize=QUEUE_MAX)
+            self.recorded = self.dropped = 0
+            self.t0, self.started_at = time.perf_counter(), time.time()
+            header = {"v": TRACE_VERSION, "startedAt": self.started_at}
+            self.thread = threading.Thread(target=self._writer, args=(self.path, self.q, header),
+                                           name="aps-recorder", daemon=True)
+            self.thread.start()
+            self.active = True
+            return self.path
+
+    def stop(self) -> Dict[str, Any]:
+        with self.lock:
+            if not self.active:
+                raise Busy("nessuna registrazione attiva")
+            self.active = False
+            self.q.put(None)
+            thread = self.thread
+        thread.join()
+        return self.stats()
+
+    def record(self, route: str, req, rv: Any, t_start: float, ms: float):
+        """Chiamato da measure a fine richiesta (solo con registrazione attiva)."""
+        if route in SKIP_ROUTES:
+            return
+        status, out = _status_size(rv)
+        entry: Dict[str, Any] = {"t": round((t_start - self.t0) * 1000.0, 1), "m": req.method, "r": route,
+                                 "p": req.full_path.rstrip("?"), "st": status, "ms": round(ms, 2),
+                                 "in": req.content_length or 0}
+        if out is not None:
+            entry["out"] = out
+        body = req.get_json(silent=True) if req.is_json else (dict(req.form) if req.form else None)
+        if body:
+            entry["b"] = redact(body)
+        try:
+            self.q.put_nowait(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def _writer(path: pathlib.Path, q: "queue.Queue[Optional[str]]", header: Dict[str, Any]):
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(json.dumps(header) + "\n")
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    line = q.get(timeout=FLUSH_S)
+                except queue.Empty:
+                    line = ""
+                if line is None:
+                    break
+                if line:
+                    f.write(line + "\n")
+                if time.monotonic() - last_flush >= FLUSH_S:
+                    # flush di sync: una traccia interrotta resta leggibile fino all'ultimo secondo
+                    f.flush()
+                    f.buffer.flush(zlib.Z_SYNC_FLUSH)
+                    last_flush = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"active": self.active, "file": str(self.path) if self.path else None,
+                "startedAt": self.started_at, "recorded": self.recorded, "dropped": self.dropped,
+                "queued": self.q.qsize()}
+
+RECORDER = Recorder()
+
+# -------------------- tracce --------------------
+
+def load_trace(path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Header e richieste in ordine di arrivo (le righe sono scritte a fine richiesta). Tollera una coda troncata."""
+    header: Dict[str, Any] = {}
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    break   # ultima riga parziale
+                if i == 0 and "v" in obj:
+                    header = obj
+                else:
+                    entries.append(obj)
+        except (EOFError, OSError):
+            pass   # traccia di un server ancora attivo o interrotto
+    entries.sort(key=lambda e: e["t"])
+    return header, entries
+
+# -------------------- replay --------------------
+
+class _InProcess:
+    """Flask test client: un client per thread sulla stessa app (nessuna rete, stesso processo)."""
+
+    def __init__(self, headers: Dict[str, str]):
+        sys.path.insert(0, str(APP_DIR))
+        import app as aps
+        self.app = aps.app
+        self.headers = headers
+        self.local = threading.local()
+
+    def send(self, method: str, path: str, body: Any) -> Tuple[int, int]:
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        resp = client.open(path, method=method, json=body, headers=self.headers)
+        return resp.status_code, len(resp.get_data())
+
+class _Http:
+    """HTTP/1.1 con keep-alive, una connessione per thread."""
+
+    def __init__(self, base: str, headers: Dict[str, str]):
+        from urllib.parse import urlsplit
+        u = urlsplit(base)
+        self.host, self.port = u.hostname or "127.0.0.1", u.port or 80
+        self.headers = headers
+        self.local = threading.local()
+
+    def send(self, method: str, path: str, body: Any) -> Tuple[int, int]:
+        import http.client
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        headers = dict(self.headers)
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        for attempt in (0, 1):
+            conn = getattr(self.local, "conn", None)
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                return resp.status, len(resp.read())
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self.local.conn = None   # keep-alive chiusa dal server: un solo nuovo tentativo
+                if attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+def _pct(vals: List[float], p: float) -> Optional[float]:
+    if not vals:
+        return None
+    s = sorted(vals)
+    k = (len(s) - 1) * p
+    f = int(k)
+    c = min(f + 1, len(s) - 1)
+    return round(s[f] + (s[c] - s[f]) * (k - f), 2)
+
+def _summary(lat: List[float], duration: float) -> Dict[str, Any]:
+    return {"count": len(lat), "rps": round(len(lat) / duration, 2) if duration > 0 else None,
+            "avg_ms": round(sum(lat) / len(lat), 2) if lat else None,
+            "p50_ms": _pct(lat, 0.50), "p95_ms": _pct(lat, 0.95), "p99_ms": _pct(lat, 0.99),
+            "max_ms": round(max(lat), 2) if lat else None}
+
+def replay(trace: str, target: str = "app", concurrency: int = 8, time_scale: float = 1.0,
+           limit: Optional[int] = None, admin_token: str = "",
+           progress: Optional[Any] = None) -> Dict[str, Any]:
+    """Rigioca la traccia e ritorna il report (latenze/throughput per route, errori, status diversi)."""
+    header, entries = load_trace(trace)
+    if limit:
+        entries = entries[:limit]
+    headers = {"X-Admin-Token": admin_token} if admin_token else {}
+    client = _InProcess(headers) if target == "app" else _Http(target, headers)
+    results: List[Optional[Tuple[float, int, float, Optional[str]]]] = [None] * len(entries)
+    cursor = [0]
+    cursor_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with cursor_lock:
+                i = cursor[0]
+                cursor[0] += 1
+            if i >= len(entries):
+                return
+            e = entries[i]
+            lag = 0.0
+            if time_scale > 0:
+                due = t_start + e["t"] / 1000.0 / time_scale
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    lag = -wait * 1000.0   # partita in ritardo: client o server saturi
+            t0 = time.perf_counter()
+            err = None
+            try:
+                status, _ = client.send(e["m"], e["p"], unredact(e["b"]) if "b" in e else None)
+            except Exception as exc:
+                status, err = 0, f"{type(exc).__name__}: {exc}"
+            results[i] = ((time.perf_counter() - t0) * 1000.0, status, lag, err)
+            if progress is not None and i and i % 1000 == 0:
+                progress(i, len(entries))
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f"replay-{n}", daemon=True) for n in range(max(1, concurrency))]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    duration = time.perf_counter() - t_start
+
+    routes: Dict[str, Dict[str, Any]] = {}
+    all_lat, lags, errors = [], [], []
+    for e, res in zip(entries, results):
+        ms, status, lag, err = res
+        r = routes.setdefault(e["r"], {"lat": [], "rec": [], "errors": 0, "statusMismatch": 0})
+        r["lat"].append(ms)
+        r["rec"].append(e["ms"])
+        all_lat.append(ms)
+        lags.append(lag)
+        if status == 0 or status >= 500:
+            r["errors"] += 1
+            if err and len(errors) < 20:
+                errors.append({"route": e["r"], "error": err})
+        if status != e["st"]:
+            r["statusMismatch"] += 1
+    return {
+        "trace": str(trace), "traceStartedAt": header.get("startedAt"), "target": target,
+        "concurrency": concurrency, "timeScale": time_scale, "durationS": round(duration, 3),
+        "recordedSpanS": round(entries[-1]["t"] / 1000.0, 3) if entries else 0.0,
+        "total": {**_summary(all_lat, duration),
+                  "errors": sum(r["errors"] for r in routes.values()),
+                  "statusMismatch": sum(r["statusMismatch"] for r in routes.values()),
+                  "lagP95Ms": _pct(lags, 0.95)},
+        "routes": {name: {**_summary(r["lat"], duration), "errors": r["errors"], "statusMismatch": r["statusMismatch"],
+                          "recordedP50Ms": _pct(r["rec"], 0.50), "recordedP95Ms": _pct(r["rec"], 0.95)}
+                   for name, r in sorted(routes.items())},
+        "sampleErrors": errors,
+    }
+
+# -------------------- confronto con una baseline --------------------
+
+def diff(base: Dict[str, Any], cur: Dict[str, Any], threshold_pct: float = 10.0, min_count: int = 20) -> Dict[str, Any]:
+    """Variazioni % di p50/p95/p99 e throughput per route; regressione se p95 peggiora oltre la soglia."""
+    def delta(a: Optional[float], b: Optional[float]) -> Optional[float]:
+        return round((b - a) / a * 100.0, 1) if a and b is not None else None
+
+    rows = {}
+    regressions = []
+    for name in sorted(set(base["routes"]) | set(cur["routes"])):
+        a, b = base["routes"].get(name), cur["routes"].get(name)
+        if a is None or b is None:
+            rows[name] = {"only": "baseline" if b is None else "current"}
+            continue
+        row = {k: delta(a.get(k), b.get(k)) for k in ("p50_ms", "p95_ms", "p99_ms", "rps")}
+        row.update(count=b["count"], p95Base=a["p95_ms"], p95Cur=b["p95_ms"], errors=b["errors"] - a["errors"])
+        rows[name] = row
+        if min(a["count"], b["count"]) >= min_count and ((row["p95_ms"] or 0) > threshold_pct or row["errors"] > 0):
+            regressions.append(name)
+    total = {k: delta(base["total"].get(k), cur["total"].get(k)) for k in ("p50_ms", "p95_ms", "p99_ms", "rps")}
+    return {"thresholdPct": threshold_pct, "total": total, "routes": rows, "regressions": regressions}
+
+def _print_diff(d: Dict[str, Any]):
+    def fmt(v):
+        return "   n/a" if v is None else f"{v:+6.1f}"
+    print(f"{'route':<34} {'n':>6} {'p50 %':>7} {'p95 %':>7} {'p99 %':>7} {'rps %':>7}")
+    for name, row in d["routes"].items():
+        if "only" in row:
+            print(f"{name:<34} solo in {row['only']}")
+            continue
+        flag = "  <-- regressione" if name in d["regressions"] else ""
+        print(f"{name:<34} {row['count']:>6} {fmt(row['p50_ms']):>7} {fmt(row['p95_ms']):>7} "
+              f"{fmt(row['p99_ms']):>7} {fmt(row['rps']):>7}{flag}")
+    t = d["total"]
+    print(f"{'TOTALE':<34} {'':>6} {fmt(t['p50_ms']):>7} {fmt(t['p95_ms']):>7} {fmt(t['p99_ms']):>7} {fmt(t['rps']):>7}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Replay di tracce di traffico APS e confronto con una baseline")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rp = sub.add_parser("replay", help="rigioca una traccia")
+    rp.add_argument("trace")
+    rp.add_argument("--target", default="app", help="'app' (test client in-process) o http://host:porta")
+    rp.add_argument("--concurrency", type=int, default=8, help="richieste in volo al massimo (default 8)")
+    rp.add_argument("--time-scale", type=float, default=1.0,
+                    help="velocità rispetto alla registrazione (2 = doppia, 0 = senza attese)")
+    rp.add_argument("--limit", type=int, default=None, help="solo le prime N richieste")
+    rp.add_argument("--admin-token", default=os.environ.get("APS_ADMIN_TOKEN", ""), help="per le route admin")
+    rp.add_argument("--out", default=None, help="scrive il report JSON su file invece che su stdout")
+    rp.add_argument("--baseline", default=None, help="report di riferimento: stampa il confronto")
+    rp.add_argument("--threshold", type=float, default=10.0, help="soglia di regressione sul p95 in %% (default 10)")
+    dp = sub.add_parser("diff", help="confronta due report di replay")
+    dp.add_argument("baseline")
+    dp.add_argument("current")
+    dp.add_argument("--threshold", type=float, default=10.0)
+    dp.add_argument("--json", action="store_true", help="output JSON invece della tabella")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "replay":
+        report = replay(args.trace, args.target, args.concurrency, args.time_scale, args.limit, args.admin_token,
+                        progress=lambda i, n: print(f"[replay] {i}/{n}", file=sys.stderr))
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.out:
+            pathlib.Path(args.out).write_text(text, encoding="utf-8")
+        else:
+            print(text)
+        t = report["total"]
+        print(f"[replay] {t['count']} richieste in {report['durationS']} s ({t['rps']} req/s), "
+              f"p50 {t['p50_ms']} ms, p95 {t['p95_ms']} ms, errori {t['errors']}, status diversi {t['statusMismatch']}",
+              file=sys.stderr)
+        if args.baseline:
+            d = diff(json.loads(pathlib.Path(args.baseline).read_text(encoding="utf-8")), report, args.threshold)
+            _print_diff(d)
+            return 1 if d["regressions"] else 0
+        return 0
+    base = json.loads(pathlib.Path(args.baseline).read_text(encoding="utf-8"))
+    cur = json.loads(pathlib.Path(args.current).read_text(encoding="utf-8"))
+    d = diff(base, cur, args.threshold)
+    if args.json:
+        print(json.dumps(d, ensure_ascii=False, indent=2))
+    else:
+        _print_diff(d)
+    return 1 if d["regressions"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
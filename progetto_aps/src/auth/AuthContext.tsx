@@ -3,7 +3,7 @@ import React, { createContext, useContext, useEffect, useMemo, useState } from "
 import type { Role } from "./utils";
 import { isRecord, asString, asBool } from "./utils";
 import type { AuthUser } from "./types";
-import { api } from "../lib/api";
+import { api, TOKEN_KEY } from "../lib/api";
 
 type AuthContextValue = {
     user: AuthUser | null;
@@ -16,6 +16,12 @@ type AuthContextValue = {
 const AuthContext = createContext<AuthContextValue | undefined>(undefined);
 const STORAGE_KEY = "auth:user";
 
+function storeSession(payload: { session?: { token?: unknown } }): void {
+    const token = payload.session?.token;
+    if (typeof token === "string" && token) localStorage.setItem(TOKEN_KEY, token);
+    else localStorage.removeItem(TOKEN_KEY);
+}
+
 function normalizeUser(raw: unknown): AuthUser {
     const r = isRecord(raw) ? raw : {};
     const uid = asString(r.uid) || asString(r.id) || asString(r.username) || "USER";
@@ -42,6 +48,7 @@ export const AuthProvider: React.FC<React.PropsWithChildren> = ({ children }) =>
     async function login(username: string, password: string): Promise<AuthUser> {
         const payload = await api.post("/auth/login", { username, password });
         if (payload.ok !== true) throw new Error(payload.error || "Credenziali errate");
+        storeSession(payload);
         const u = normalizeUser(payload.user);
         localStorage.setItem(STORAGE_KEY, JSON.stringify(u));
         setUser(u);
@@ -51,6 +58,7 @@ export const AuthProvider: React.FC<React.PropsWithChildren> = ({ children }) =>
     async function register(role: Role, username: string, name: string, email: string, password: string): Promise<AuthUser> {
         const payload = await api.post("/auth/register", { role, username, name, email, password });
         if (payload.ok !== true) throw new Error(payload.error || "Registrazione fallita");
+        storeSession(payload);
         const u = normalizeUser(payload.user);
         localStorage.setItem(STORAGE_KEY, JSON.stringify(u));
         setUser(u);
@@ -58,6 +66,8 @@ export const AuthProvider: React.FC<React.PropsWithChildren> = ({ children }) =>
     }
 
     function logout(): void {
+        if (localStorage.getItem(TOKEN_KEY)) void api.post("/auth/logout").catch(() => undefined);
+        localStorage.removeItem(TOKEN_KEY);
         localStorage.removeItem(STORAGE_KEY);
         setUser(null);
     }
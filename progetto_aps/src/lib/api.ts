@@ -1,4 +1,11 @@
 const API_BASE = "/api";
+export const TOKEN_KEY = "auth:token";
+
+/** Header Authorization con il token di sessione (se presente). */
+export function authHeaders(): Record<string, string> {
+    const token = localStorage.getItem(TOKEN_KEY);
+    return token ? { Authorization: `Bearer ${token}` } : {};
+}
 
 async function parseSmart(resp: Response) {
     const text = await resp.text();
@@ -18,7 +25,7 @@ function raise(msg: string, status?: number): never {
 
 export const api = {
     async get<T = any>(path: string): Promise<T> {
-        const resp = await fetch(`${API_BASE}${path}`, { method: "GET" });
+        const resp = await fetch(`${API_BASE}${path}`, { method: "GET", headers: authHeaders() });
         const parsed = await parseSmart(resp);
         if (!parsed.ok) raise((parsed.data?.error as string) || parsed.raw || `HTTP ${parsed.status}`, parsed.status);
         return parsed.data as T;
@@ -26,7 +33,7 @@ export const api = {
     async post<T = any>(path: string, body?: unknown): Promise<T> {
         const resp = await fetch(`${API_BASE}${path}`, {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
+            headers: { "Content-Type": "application/json", ...authHeaders() },
             body: body ? JSON.stringify(body) : undefined,
         });
         const parsed = await parseSmart(resp);
@@ -4,6 +4,7 @@ import { useReports } from "../store/ReportsContext";
 import type { Status } from "../store/ReportsContext";
 import { useAuth } from "../auth/AuthContext";
 import ExpandableList from "../components/ui/ExpandableList";
+import { authHeaders } from "../lib/api";
 
 const API_BASE = "/api";
 
@@ -122,14 +123,14 @@ export default function Hospital() {
                 onOpenReport={async (reportId) => {
                     await fetch(`${API_BASE}/keys/init`, {
                         method: "POST",
-                        headers: { "Content-Type": "application/json" },
+                        headers: { "Content-Type": "application/json", ...authHeaders() },
                         body: JSON.stringify({ actors: [HOSP_ID] }), // non serve il labId
                     }).catch(() => {});
                     let resp: Response;
                     try {
                         resp = await fetch(`${API_BASE}/hosp/open`, {
                             method: "POST",
-                            headers: { "Content-Type": "application/json" },
+                            headers: { "Content-Type": "application/json", ...authHeaders() },
                             body: JSON.stringify({ reportId, hospitalId: HOSP_ID }),
                         });
                     } catch {
@@ -4,6 +4,7 @@ import { useReports } from "../store/ReportsContext";
 import type { Report } from "../store/ReportsContext";
 import { useAuth } from "../auth/AuthContext";
 import ExpandableList from "../components/ui/ExpandableList";
+import { authHeaders } from "../lib/api";
 
 const API_BASE = "/api";
 
@@ -41,13 +42,13 @@ export default function Lab() {
         try {
             await fetch(`${API_BASE}/keys/init`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({ actors: [LAB_ID, p] }),
             });
             const content = `Referto ${reportId}\nTipo: ${et}\nNote: ${note || "—"}\nEsito: ${resultShort || "—"}`;
             const resp = await fetch(`${API_BASE}/lab/emit`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({
                     reportId,
                     labId: LAB_ID,
@@ -79,7 +80,7 @@ export default function Lab() {
         try {
             const resp = await fetch(`${API_BASE}/lab/revoke`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({ reportId: revokeTarget.reportId, labId: LAB_ID, reason: "Revoca da console LAB" }),
             });
             const text = await resp.text();
@@ -103,7 +104,7 @@ export default function Lab() {
 
             const emitResp = await fetch(`${API_BASE}/lab/emit`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({
                     reportId: newId,
                     labId: LAB_ID,
@@ -120,7 +121,7 @@ export default function Lab() {
 
             const linkResp = await fetch(`${API_BASE}/lab/update`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({ oldReportId: oldId, newReportId: newId, labId: LAB_ID, envelope }),
             });
             const linkText = await linkResp.text();
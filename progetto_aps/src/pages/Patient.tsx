@@ -4,6 +4,7 @@ import { useReports } from "../store/ReportsContext";
 import type { Report } from "../store/ReportsContext";
 import { useAuth } from "../auth/AuthContext";
 import ExpandableList from "../components/ui/ExpandableList";
+import { authHeaders } from "../lib/api";
 
 const API_BASE = "/api";
 
@@ -30,13 +31,13 @@ export default function Patient() {
         try {
             await fetch(`${API_BASE}/keys/init`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({ actors: [PAT_ID, hospId.trim()] }),
             }).catch(() => {});
             // IMPORTANT: condivido sempre sulla VERSIONE CORRENTE
             const resp = await fetch(`${API_BASE}/patient/share`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({ reportId: shareFor.currentId, patientId: PAT_ID, hospitalId: hospId.trim() }),
             });
             if (!resp.ok) throw new Error("Impossibile condividere adesso. Riprova più tardi.");
@@ -242,7 +243,7 @@ function RevokeConfirmModal({
         try {
             const resp = await fetch(`/api/patient/unshare`, {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
+                headers: { "Content-Type": "application/json", ...authHeaders() },
                 body: JSON.stringify({ reportId, patientId, hospitalId: hospId }),
             });
             const text = await resp.text();
@@ -1,5 +1,7 @@
 /* eslint-disable react-refresh/only-export-components */
 import { createContext, useCallback, useContext, useEffect, useMemo, useState } from "react";
+import { useAuth } from "../auth/AuthContext";
+import { authHeaders } from "../lib/api";
 
 export type Status = "VALID" | "UPDATED" | "REVOKED";
 
@@ -46,6 +48,16 @@ type EnvelopeItem = {
 type EnvelopesResponse = { ok: boolean; items?: EnvelopeItem[]; error?: string; };
 type GrantsResponse = { ok: boolean; items?: { reportId?: string; from?: string; to?: string; ts?: number }[]; error?: string; };
 type StateResponse  = { ok?: boolean; status?: Status | "UNKNOWN"; currentReportId?: string; };
+/** Struttura che arriva da /api/patient/<id>/reports e /api/recipient/<id>/reports */
+type ActorReportItem = EnvelopeItem & {
+    status?: Status | "UNKNOWN";
+    currentReportId?: string;
+    grants?: { from?: string; to?: string; ts?: number }[];
+    currentEkFor?: string[];
+    currentGrants?: { from?: string; to?: string; ts?: number }[];
+    revoked?: string[];
+};
+type ActorReportsResponse = { ok: boolean; items?: ActorReportItem[]; error?: string; };
 type ActorsResponse = { ok: boolean; items?: { username?: string; uid?: string; role?: string; displayName?: string; hasKeys?: boolean }[]; error?: string; };
 
 function normalizeIso(value: unknown): string {
@@ -70,8 +82,44 @@ function parseBaseEnvelope(raw: EnvelopeItem) {
     };
 }
 
+function grantTargets(items: unknown): string[] {
+    if (!Array.isArray(items)) return [];
+    return items.map((g) => (typeof g?.to === "string" ? g.to : "")).filter(Boolean);
+}
+
+/** Converte un elemento della lista per attore (già aggregato dal backend) in Report. */
+function reportFromActorItem(raw: ActorReportItem): Report | null {
+    const base = parseBaseEnvelope(raw);
+    if (!base.reportId) return null;
+    const status = (raw.status === "VALID" || raw.status === "UPDATED" || raw.status === "REVOKED") ? raw.status : "VALID";
+    const currentId = typeof raw.currentReportId === "string" && raw.currentReportId ? raw.currentReportId : base.reportId;
+    const revokedNow = new Set(Array.isArray(raw.revoked) ? raw.revoked : []);
+    const ekForCurrent = Array.isArray(raw.currentEkFor) ? raw.currentEkFor : [];
+    const accessLocal = Array.from(new Set([...base.ekFor.filter((x) => x && x !== base.patientRef), ...grantTargets(raw.grants)]))
+        .filter((u) => !revokedNow.has(u)).sort();
+    const access = Array.from(new Set([...ekForCurrent.filter((x) => x && x !== base.patientRef), ...grantTargets(raw.currentGrants)]))
+        .filter((u) => !revokedNow.has(u)).sort();
+    return {
+        reportId: base.reportId,
+        currentId,
+        isCurrent: currentId === base.reportId,
+        labId: base.labId,
+        patientRef: base.patientRef,
+        issuedAt: base.issuedAt,
+        status,
+        access,
+        accessLocal,
+        ekFor: base.ekFor,
+        examType: base.examType,
+        resultShort: base.resultShort,
+        note: base.note,
+        hasSig: base.hasSig,
+        cipherLen: base.cipherLen,
+    };
+}
+
 async function getJson<T>(url: string): Promise<{ ok: boolean; status: number; json: T | null; text: string }> {
-    const resp = await fetch(url);
+    const resp = await fetch(url, { headers: authHeaders() });
     const text = await resp.text();
     let json: T | null = null;
     try { json = text ? (JSON.parse(text) as T) : null; } catch { json = null; }
@@ -79,6 +127,7 @@ async function getJson<T>(url: string): Promise<{ ok: boolean; status: number; j
 }
 
 export function ReportsProvider({ children }: { children: React.ReactNode }) {
+    const { user } = useAuth();
     const [reports, setReports] = useState<Report[]>([]);
     const [hospitals, setHospitals] = useState<string[]>([]);
     const [recipientRoles, setRecipientRoles] = useState<Record<string, "HOSP" | "DOC">>({});
@@ -89,69 +138,85 @@ export function ReportsProvider({ children }: { children: React.ReactNode }) {
         setLoading(true);
         setError(null);
         try {
-            // 1) envelopes
-            const envRes = await getJson<EnvelopesResponse>(`${API_BASE}/debug/envelopes`);
-            const envBody = envRes.json;
-            if (!envRes.ok || !envBody || envBody.ok !== true || !Array.isArray(envBody.items)) {
-                const msg = envBody?.error ?? `HTTP ${envRes.status}`;
-                throw new Error(msg || "Caricamento referti fallito");
+            // 0) PAT / HOSP / DOC: una sola richiesta servita dagli indici per attore
+            const actorPath = user?.role === "PAT"
+                ? `${API_BASE}/patient/${encodeURIComponent(user.uid)}/reports`
+                : (user?.role === "HOSP" || user?.role === "DOC")
+                    ? `${API_BASE}/recipient/${encodeURIComponent(user.uid)}/reports`
+                    : null;
+            let results: Report[] | null = null;
+            if (actorPath) {
+                const res = await getJson<ActorReportsResponse>(actorPath);
+                if (res.ok && res.json?.ok === true && Array.isArray(res.json.items)) {
+                    results = res.json.items.map(reportFromActorItem).filter((r): r is Report => r !== null);
+                }
             }
-            const baseItems = envBody.items.map(parseBaseEnvelope);
-            const envById = new Map(baseItems.map((e) => [e.reportId, e]));
-
-            // 2) per ogni report originario calcola stato, currentId, accessLocal ed access (sul current)
-            const results: Report[] = [];
-            for (const base of baseItems) {
-                if (!base.reportId) continue;
-
-                const stRes = await getJson<StateResponse>(`${API_BASE}/report/state/${encodeURIComponent(base.reportId)}`);
-                const status = (stRes.json?.status === "VALID" || stRes.json?.status === "UPDATED" || stRes.json?.status === "REVOKED")
-                    ? stRes.json.status
-                    : "VALID";
-                const currentId = typeof stRes.json?.currentReportId === "string" && stRes.json.currentReportId
-                    ? stRes.json.currentReportId
-                    : base.reportId;
-                const isCurrent = currentId === base.reportId;
-
-                // revoked sul current
-                const revRes = await getJson<{ ok: boolean; items?: string[] }>(`${API_BASE}/report/revoked/${encodeURIComponent(currentId)}`);
-                const revokedNow = revRes.ok && Array.isArray(revRes.json?.items) ? new Set(revRes.json!.items!) : new Set<string>();
-
-                // accessLocal = ek_for(this) ∪ grants(this) \ revoked(current)
-                const ekForLocal = (envById.get(base.reportId)?.ekFor || []).filter((x) => x && x !== base.patientRef);
-                const grantsLocalRes = await getJson<GrantsResponse>(`${API_BASE}/report/grants/${encodeURIComponent(base.reportId)}`);
-                const grantLocalTos = (grantsLocalRes.ok && grantsLocalRes.json?.ok === true && Array.isArray(grantsLocalRes.json.items))
-                    ? grantsLocalRes.json.items!.map((g) => (typeof g?.to === "string" ? g.to : "")).filter(Boolean)
-                    : [];
-                const accessLocal = Array.from(new Set([...ekForLocal, ...grantLocalTos])).filter((u) => !revokedNow.has(u)).sort();
-
-                // access sul current = ek_for(current) ∪ grants(current) \ revoked(current)
-                const ekForCurrent = (envById.get(currentId)?.ekFor || []).filter((x) => x && x !== base.patientRef);
-                const grantsRes = await getJson<GrantsResponse>(`${API_BASE}/report/grants/${encodeURIComponent(currentId)}`);
-                const grantTos = (grantsRes.ok && grantsRes.json?.ok === true && Array.isArray(grantsRes.json.items))
-                    ? Array.from(new Set(grantsRes.json.items
-                        .map((g) => (typeof g?.to === "string" ? g.to : ""))
-                        .filter(Boolean)))
-                    : [];
-                const access = Array.from(new Set([...ekForCurrent, ...grantTos])).filter((u) => !revokedNow.has(u)).sort();
-
-                results.push({
-                    reportId: base.reportId,
-                    currentId,
-                    isCurrent,
-                    labId: base.labId,
-                    patientRef: base.patientRef,
-                    issuedAt: base.issuedAt,
-                    status,
-                    access,
-                    accessLocal,
-                    ekFor: base.ekFor,
-                    examType: base.examType,
-                    resultShort: base.resultShort,
-                    note: base.note,
-                    hasSig: base.hasSig,
-                    cipherLen: base.cipherLen,
-                });
+
+            if (results === null) {
+                // 1) envelopes
+                const envRes = await getJson<EnvelopesResponse>(`${API_BASE}/debug/envelopes`);
+                const envBody = envRes.json;
+                if (!envRes.ok || !envBody || envBody.ok !== true || !Array.isArray(envBody.items)) {
+                    const msg = envBody?.error ?? `HTTP ${envRes.status}`;
+                    throw new Error(msg || "Caricamento referti fallito");
+                }
+                const baseItems = envBody.items.map(parseBaseEnvelope);
+                const envById = new Map(baseItems.map((e) => [e.reportId, e]));
+
+                // 2) per ogni report originario calcola stato, currentId, accessLocal ed access (sul current)
+                results = [];
+                for (const base of baseItems) {
+                    if (!base.reportId) continue;
+
+                    const stRes = await getJson<StateResponse>(`${API_BASE}/report/state/${encodeURIComponent(base.reportId)}`);
+                    const status = (stRes.json?.status === "VALID" || stRes.json?.status === "UPDATED" || stRes.json?.status === "REVOKED")
+                        ? stRes.json.status
+                        : "VALID";
+                    const currentId = typeof stRes.json?.currentReportId === "string" && stRes.json.currentReportId
+                        ? stRes.json.currentReportId
+                        : base.reportId;
+                    const isCurrent = currentId === base.reportId;
+
+                    // revoked sul current
+                    const revRes = await getJson<{ ok: boolean; items?: string[] }>(`${API_BASE}/report/revoked/${encodeURIComponent(currentId)}`);
+                    const revokedNow = revRes.ok && Array.isArray(revRes.json?.items) ? new Set(revRes.json!.items!) : new Set<string>();
+
+                    // accessLocal = ek_for(this) ∪ grants(this) \ revoked(current)
+                    const ekForLocal = (envById.get(base.reportId)?.ekFor || []).filter((x) => x && x !== base.patientRef);
+                    const grantsLocalRes = await getJson<GrantsResponse>(`${API_BASE}/report/grants/${encodeURIComponent(base.reportId)}`);
+                    const grantLocalTos = (grantsLocalRes.ok && grantsLocalRes.json?.ok === true && Array.isArray(grantsLocalRes.json.items))
+                        ? grantsLocalRes.json.items!.map((g) => (typeof g?.to === "string" ? g.to : "")).filter(Boolean)
+                        : [];
+                    const accessLocal = Array.from(new Set([...ekForLocal, ...grantLocalTos])).filter((u) => !revokedNow.has(u)).sort();
+
+                    // access sul current = ek_for(current) ∪ grants(current) \ revoked(current)
+                    const ekForCurrent = (envById.get(currentId)?.ekFor || []).filter((x) => x && x !== base.patientRef);
+                    const grantsRes = await getJson<GrantsResponse>(`${API_BASE}/report/grants/${encodeURIComponent(currentId)}`);
+                    const grantTos = (grantsRes.ok && grantsRes.json?.ok === true && Array.isArray(grantsRes.json.items))
+                        ? Array.from(new Set(grantsRes.json.items
+                            .map((g) => (typeof g?.to === "string" ? g.to : ""))
+                            .filter(Boolean)))
+                        : [];
+                    const access = Array.from(new Set([...ekForCurrent, ...grantTos])).filter((u) => !revokedNow.has(u)).sort();
+
+                    results.push({
+                        reportId: base.reportId,
+                        currentId,
+                        isCurrent,
+                        labId: base.labId,
+                        patientRef: base.patientRef,
+                        issuedAt: base.issuedAt,
+                        status,
+                        access,
+                        accessLocal,
+                        ekFor: base.ekFor,
+                        examType: base.examType,
+                        resultShort: base.resultShort,
+                        note: base.note,
+                        hasSig: base.hasSig,
+                        cipherLen: base.cipherLen,
+                    });
+                }
             }
 
             // 3) ordina per data
@@ -183,7 +248,7 @@ export function ReportsProvider({ children }: { children: React.ReactNode }) {
         } finally {
             setLoading(false);
         }
-    }, []);
+    }, [user?.uid, user?.role]);
 
     useEffect(() => { void refresh(); }, [refresh]);
 